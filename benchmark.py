@@ -0,0 +1,414 @@
+""" Reproducible benchmarks for the drawing editor.
+
+    python benchmark.py generate drawing.txt --shapes 100000
+    python benchmark.py run --sizes 1000,10000,100000 --gui --xvfb -o results.json
+    python benchmark.py compare baseline.json results.json
+
+Drawings are generated from a seed in the editor's text format, so two runs
+with the same options measure the same input.  Headless benchmarks exercise
+the document, index and file formats directly; ``--gui`` adds the Tk paths
+(open_file_via_arg, save_file, export_to_xml, clicks and drags), which need a
+display: ``--xvfb`` starts a private Xvfb server for them.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import statistics
+import subprocess
+import tempfile
+
+import drawing_editor as de
+
+COLORS = tuple(de.COLOR_CODES.values())  # The only colours the text format can store
+
+
+def generate_drawing(file, shapes, line_ratio=0.5, extent=None, max_size=80, round_ratio=0.2, seed=0):
+    """ Write ``shapes`` random shapes in the text format.
+
+    Shapes are spread over a square of side ``extent`` (by default sized so the
+    density stays roughly constant as the count grows), with sides of at most
+    ``max_size`` units.
+    """
+    rng = random.Random(seed)
+    extent = extent or max(1000, int((shapes * 2500) ** 0.5))
+    lines = []
+    for i in range(shapes):
+        x, y = rng.uniform(0, extent), rng.uniform(0, extent)
+        x2, y2 = x + rng.uniform(-max_size, max_size), y + rng.uniform(-max_size, max_size)
+        color = rng.choice(COLORS)
+        if rng.random() < line_ratio:
+            lines.append(de.format_shape_line("line", x, y, x2, y2, color, "square"))
+        else:
+            corner = "round" if rng.random() < round_ratio else "square"
+            lines.append(de.format_shape_line("rectangle", x, y, x2, y2, color, corner))
+        if len(lines) >= 4096:
+            file.write("".join(lines))
+            lines.clear()
+    file.write("".join(lines))
+
+
+def group_document(document, size=10, nesting=10):
+    """ Group every ``size`` consecutive shapes, and every ``nesting`` groups into a parent. """
+    groups = document.groups
+    shapes = list(document)
+    leaves = [groups.create(shapes[i:i + size]) for i in range(0, len(shapes), size)]
+    for i in range(0, len(leaves), nesting):
+        groups.create(group_ids=leaves[i:i + nesting])
+    return leaves
+
+
+def measure(function, repeat=3, setup=None):
+    """ Seconds taken by ``function()`` on each of ``repeat`` runs; ``setup()`` runs untimed first. """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(name, shapes, times, operations=1, **extra):
+    best = min(times)
+    return dict({"benchmark": name, "shapes": shapes, "operations": operations, "repeat": len(times),
+                 "min_s": best, "median_s": statistics.median(times), "max_s": max(times),
+                 "per_op_us": best / operations * 1e6}, **extra)
+
+
+def random_points(document, count, rng):
+    """ Points near random shapes, so hit tests mostly have something to find. """
+    sids = list(document)
+    points = []
+    for sid in rng.sample(sids, min(count, len(sids))):
+        x1, y1, x2, y2 = document.get_coords(sid)
+        points.append(((x1 + x2) / 2 + rng.uniform(-3, 3), (y1 + y2) / 2 + rng.uniform(-3, 3)))
+    return points
+
+
+def run_headless(path, shapes, repeat, workdir, seed=0):
+    """ Benchmarks of the Tk-free core on one generated drawing. """
+    results = []
+    document = de.Document()
+
+    def load():
+        nonlocal document
+        with open(path) as file:
+            document = de.read_text(file)
+
+    results.append(result("load_text", shapes, measure(load, repeat)))
+    text_out = os.path.join(workdir, "out.txt")
+    xml_out = os.path.join(workdir, "out.xml")
+    binary_out = os.path.join(workdir, "out" + de.BINARY_SUFFIX)
+
+    def save_text():
+        with open(text_out, "w") as file:
+            de.write_text(document, file)
+
+    def export_xml():
+        with open(xml_out, "w") as file:
+            de.write_xml(document, file)
+
+    def save_binary():
+        with open(binary_out, "wb") as file:
+            de.write_binary(document, file)
+
+    results.append(result("save_text", shapes, measure(save_text, repeat)))
+    results.append(result("export_xml", shapes, measure(export_xml, repeat)))
+    results.append(result("save_binary", shapes, measure(save_binary, repeat)))
+    results.append(result("load_binary", shapes, measure(lambda: de.read_binary(binary_out), repeat)))
+
+    def load_xml():
+        with open(xml_out, "rb") as file:
+            de.read_xml(file)
+
+    results.append(result("load_xml", shapes, measure(load_xml, repeat)))
+
+    index = de.SpatialIndex(document)
+    results.append(result("index_build", shapes, measure(lambda: index.build(), 1, setup=lambda: index.__init__(document))))
+    rng = random.Random(seed)
+    points = random_points(document, 1000, rng)
+    results.append(result("hit_test", shapes, measure(lambda: [index.nearest(x, y, 10) for x, y in points], repeat),
+                          len(points)))
+
+    results.append(result("snap_vertex", shapes, measure(lambda: [index.nearest_vertex(x, y, 8) for x, y in points],
+                                                         repeat), len(points)))
+    results.append(result("line_intersections", shapes, measure(lambda: de.line_intersections(document), repeat)))
+    results.append(result("rectangle_overlaps", shapes, measure(lambda: de.rectangle_overlaps(document), repeat)))
+    near = rng.sample(list(document), min(200, len(document)))
+    results.append(result("shapes_within", shapes, measure(lambda: [index.within(sid, 20) for sid in near], repeat),
+                          len(near)))
+
+    group_document(document)
+    groups = document.groups
+    sids = rng.sample(list(document), min(1000, len(document)))
+    results.append(result("group_lookup", shapes, measure(lambda: [groups.shapes(groups.top_level(sid))
+                                                                   for sid in sids], repeat), len(sids)))
+
+    moved = sids[:min(1000, len(sids))]
+
+    def drag():
+        # What a release does: the canvas moved the items, the document and index catch up once
+        command = de.MoveShapes(moved, 5.0, 5.0)
+        command.apply(document)
+        for sid in moved:
+            index.update(sid)
+
+    results.append(result("drag_release", shapes, measure(drag, repeat), moved=len(moved)))
+    return results
+
+
+class Event:
+    """ Stand-in for a Tk event; the handlers only read these fields. """
+
+    def __init__(self, x, y, state=0):
+        self.x, self.y, self.state = x, y, state
+        self.delta, self.num = 0, 0
+        self.width, self.height = 800, 600
+
+
+def run_gui(path, shapes, repeat, workdir, seed=0):
+    """ Benchmarks of the Tk application; needs a display. """
+    import tkinter as tk
+    results = []
+    root = tk.Tk()
+    root.geometry("800x600")
+    app = de.DrawingApp(root, autosave_path=None)
+    root.update()
+    target = {}
+    from tkinter import filedialog
+    filedialog.asksaveasfilename = lambda **kwargs: target["path"]
+
+    def load():
+        app.open_file_via_arg(path)
+        while app.loader is not None:
+            root.update()
+        root.update_idletasks()
+
+    try:
+        results.append(result("gui_open_file", shapes, measure(load, repeat), items=len(app.items)))
+        target["path"] = os.path.join(workdir, "gui.txt")
+        results.append(result("gui_save_file", shapes, measure(app.save_file, repeat)))
+        target["path"] = os.path.join(workdir, "gui.xml")
+        results.append(result("gui_export_to_xml", shapes, measure(app.export_to_xml, repeat)))
+
+        rng = random.Random(seed)
+        visible = [sid for sid in app.items]
+        rng.shuffle(visible)
+        clicks = [Event(*app.viewport.to_screen(*app.document.get_coords(sid)[:2])) for sid in visible[:200]]
+        results.append(result("gui_hit_test", shapes, measure(lambda: [app.find_item_at(*app.world(event))
+                                                                       for event in clicks], repeat), len(clicks)))
+
+        group_document(app.document)
+        app.show_document(app.document)  # Re-render so items carry their group tags
+        app.select_tool("select")
+
+        def click_groups():
+            for event in clicks:
+                app.select_object(event)
+                app.release_object(event)
+            root.update_idletasks()
+
+        results.append(result("gui_group_select", shapes, measure(click_groups, repeat), len(clicks)))
+
+        app.select_matching(color="red")
+        selected = len(app.selection)
+
+        def drag():
+            start = Event(400, 300)
+            app.begin_drag(start, "selected", list(app.selection))
+            for frame in range(1, 61):
+                app.move_object(Event(400 + frame, 300 + frame))
+                root.update_idletasks()
+            app.release_object(Event(460, 360))
+            root.update_idletasks()
+
+        results.append(result("gui_drag_selection", shapes, measure(drag, repeat), 60, moved=selected))
+        results.append({"benchmark": "gui_handler_stats", "shapes": shapes,
+                        "handlers": app.instrumentation.report()["handlers"]})
+    finally:
+        root.destroy()
+    return results
+
+
+GUI_MODULES = ("tkinter", "_tkinter", "xml.etree.ElementTree")
+
+IMPORT_PROBE = "import sys, drawing_editor; print(' '.join(m for m in {!r} if m in sys.modules))"
+
+
+def import_time(runs=5):
+    """ Cold-start cost of ``import drawing_editor`` in fresh interpreters, per ``-X importtime``.
+
+    Returns the cumulative import times in seconds and the GUI modules the import
+    pulled in, which should be none.  Bytecode is written by a warm-up run first,
+    so the numbers reflect a normal launch rather than compiling the module.
+    """
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    here = os.path.dirname(os.path.abspath(__file__))
+    command = [sys.executable, "-X", "importtime", "-c", IMPORT_PROBE.format(GUI_MODULES)]
+    times, loaded = [], []
+    for run in range(runs + 1):
+        process = subprocess.run(command, capture_output=True, text=True, check=True, cwd=here, env=env)
+        if run == 0:
+            continue
+        for line in process.stderr.splitlines():
+            fields = [field.strip() for field in line.split("|")]
+            if len(fields) == 3 and fields[2] == "drawing_editor":
+                times.append(int(fields[1]) / 1e6)
+        loaded = process.stdout.split()
+    return times, loaded
+
+
+def startup(args):
+    """ Check the import time of the core against a budget; exit 1 if it is over or loads Tk. """
+    times, loaded = import_time(args.runs)
+    median = statistics.median(times)
+    print(f"import drawing_editor: median {median * 1000:.1f} ms, best {min(times) * 1000:.1f} ms "
+          f"(budget {args.threshold_ms:.0f} ms)")
+    if loaded:
+        print(f"GUI modules loaded at import: {', '.join(loaded)}")
+    return 1 if loaded or median * 1000 > args.threshold_ms else 0
+
+
+def start_xvfb():
+    """ Start a private Xvfb server and point DISPLAY at it; returns the process. """
+    executable = shutil.which("Xvfb")
+    if executable is None:
+        raise RuntimeError("Xvfb not found; install it or run with a display")
+    for number in range(99, 140):
+        if not os.path.exists(f"/tmp/.X11-unix/X{number}") and not os.path.exists(f"/tmp/.X{number}-lock"):
+            break
+    process = subprocess.Popen([executable, f":{number}", "-screen", "0", "1280x1024x24", "-nolisten", "tcp"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while not os.path.exists(f"/tmp/.X11-unix/X{number}"):
+        if process.poll() is not None or time.time() > deadline:
+            process.kill()
+            raise RuntimeError("Xvfb did not start")
+        time.sleep(0.05)
+    os.environ["DISPLAY"] = f":{number}"
+    return process
+
+
+def environment():
+    """ What produced the numbers, so results from different versions can be compared. """
+    info = {"python": platform.python_version(), "implementation": platform.python_implementation(),
+            "platform": platform.platform(), "machine": platform.machine(), "cpus": os.cpu_count(),
+            "numpy": de.load_numpy() is not None, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+    try:
+        info["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                                        cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info["commit"] = None
+    return info
+
+
+def run(args):
+    sizes = [int(size) for size in args.sizes.split(",")]
+    report = {"environment": environment(), "options": vars(args).copy(), "results": []}
+    times, loaded = import_time()
+    report["results"].append(result("import_core", 0, times, gui_modules=loaded))
+    xvfb = None
+    if args.gui and args.xvfb:
+        xvfb = start_xvfb()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for shapes in sizes:
+                path = os.path.join(workdir, f"drawing_{shapes}.txt")
+                with open(path, "w") as file:
+                    generate_drawing(file, shapes, args.line_ratio, seed=args.seed)
+                results = run_headless(path, shapes, args.repeat, workdir, args.seed)
+                if args.gui:
+                    if os.environ.get("DISPLAY"):
+                        results += run_gui(path, shapes, args.repeat, workdir, args.seed)
+                    else:
+                        results.append({"benchmark": "gui", "shapes": shapes, "skipped": "no display"})
+                for entry in results:
+                    report["results"].append(entry)
+                    if "min_s" in entry:
+                        print(f"{entry['benchmark']:<22}{shapes:>9} shapes  {entry['min_s'] * 1000:>10.2f} ms"
+                              f"  {entry['per_op_us']:>10.1f} us/op", file=sys.stderr)
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+            xvfb.wait()
+    try:
+        import resource
+        report["environment"]["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+def compare(args):
+    """ Report benchmarks that got slower than ``threshold`` times the baseline; exit 1 if any did. """
+    def load(filename):
+        with open(filename) as file:
+            return {(r["benchmark"], r["shapes"]): r for r in json.load(file)["results"] if "min_s" in r}
+
+    baseline, current = load(args.baseline), load(args.current)
+    regressions = 0
+    for key in sorted(baseline.keys() & current.keys()):
+        ratio = current[key]["min_s"] / max(baseline[key]["min_s"], 1e-12)
+        flag = ""
+        if ratio > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{key[0]:<22}{key[1]:>9} shapes  {ratio:>6.2f}x{flag}")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the drawing editor on synthetic drawings.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="write a synthetic drawing in the text format")
+    generate.add_argument("path")
+    generate.add_argument("--shapes", type=int, default=10000)
+    generate.add_argument("--line-ratio", type=float, default=0.5, help="fraction of shapes that are lines")
+    generate.add_argument("--seed", type=int, default=0)
+
+    bench = commands.add_parser("run", help="run the benchmarks and print JSON results")
+    bench.add_argument("--sizes", default="1000,10000,100000", help="comma-separated shape counts")
+    bench.add_argument("--repeat", type=int, default=3)
+    bench.add_argument("--line-ratio", type=float, default=0.5)
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--gui", action="store_true", help="also time the Tk application")
+    bench.add_argument("--xvfb", action="store_true", help="run the GUI benchmarks on a private Xvfb display")
+    bench.add_argument("-o", "--output", help="write results here instead of stdout")
+
+    check = commands.add_parser("compare", help="compare two result files")
+    check.add_argument("baseline")
+    check.add_argument("current")
+    check.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio counted as a regression")
+
+    check_startup = commands.add_parser("startup", help="check the import time of drawing_editor")
+    check_startup.add_argument("--runs", type=int, default=5)
+    check_startup.add_argument("--threshold-ms", type=float, default=40.0)
+
+    args = parser.parse_args(argv)
+    if args.command == "generate":
+        with open(args.path, "w") as file:
+            generate_drawing(file, args.shapes, args.line_ratio, seed=args.seed)
+        return 0
+    if args.command == "compare":
+        return compare(args)
+    if args.command == "startup":
+        return startup(args)
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,69 +1,2740 @@
-import tkinter as tk
-from tkinter import simpledialog, colorchooser, messagebox, filedialog
 import sys
-import xml.etree.ElementTree as ET
+import os
+import math
+import time
+import mmap
+import struct
+import heapq
+import logging
+from collections import deque
+from array import array
 
 
-class EditDialog(simpledialog.Dialog):
-    def __init__(self, parent, title, initial_color="black", is_line=True):
-        self.is_line = is_line
-        self.initial_color = initial_color
-        super().__init__(parent, title)
-        
-    def body(self, master):
-        tk.Label(master, text="Choose color:").grid(row=0, column=0)
-        self.color_var = tk.StringVar(value=self.initial_color)
-        colors = ["black", "red", "green", "blue"]
-        self.color_menu = tk.OptionMenu(master, self.color_var, *colors)
-        self.color_menu.grid(row=0, column=1)
+SHAPE_TYPES = ("line", "rectangle")
+CORNER_STYLES = ("square", "round")
+COLOR_CODES = {"k": "black", "r": "red", "g": "green", "b": "blue"}
+CODE_FOR_COLOR = {v: k for k, v in COLOR_CODES.items()}
+
+logger = logging.getLogger("drawing_editor")
+
+
+class Document:
+    """ Headless, column-oriented storage for every shape in a drawing.
+
+    A shape is identified by its row index (shape id).  Each attribute lives in
+    its own typed array, so a shape costs a few dozen bytes instead of a dict,
+    and nothing here needs Tk.  Deleted rows are tombstoned rather than reused
+    so shape ids stay stable for the lifetime of the document.
+    """
+
+    def __init__(self):
+        self.kinds = array('b')      # index into SHAPE_TYPES
+        self.coords = array('d')     # x1, y1, x2, y2 per shape
+        self.colors = array('H')     # index into self.palette
+        self.corners = array('b')    # index into CORNER_STYLES
+        self.group_ids = array('i')  # owning group, -1 when ungrouped
+        self.alive = bytearray()
+        self.palette = list(COLOR_CODES.values())
+        self._palette_index = {color: i for i, color in enumerate(self.palette)}
+        self._count = 0
+        self.groups = GroupTree(self)
+        self.changed = None  # ids of shapes changed since take_changes(), when tracking
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        """ Iterate over the ids of live shapes, in creation order. """
+        alive = self.alive
+        return (sid for sid in range(len(alive)) if alive[sid])
+
+    def __contains__(self, sid):
+        return 0 <= sid < len(self.alive) and self.alive[sid] == 1
+
+    def color_index(self, color):
+        index = self._palette_index.get(color)
+        if index is None:
+            index = len(self.palette)
+            self.palette.append(color)
+            self._palette_index[color] = index
+        return index
+
+    def add(self, shape_type, x1, y1, x2, y2, color="black", corner_style="square", group_id=-1):
+        """ Append a shape and return its id. """
+        sid = len(self.alive)
+        self.kinds.append(SHAPE_TYPES.index(shape_type))
+        self.coords.extend((x1, y1, x2, y2))
+        self.colors.append(self.color_index(color))
+        self.corners.append(CORNER_STYLES.index(corner_style))
+        self.group_ids.append(group_id)
+        self.alive.append(1)
+        self._count += 1
+        if self.changed is not None:
+            self.changed.add(sid)
+        return sid
+
+    def remove(self, sid):
+        if self.alive[sid]:
+            self.alive[sid] = 0
+            self._count -= 1
+            self.touch((sid,))
+
+    def restore(self, sid):
+        """ Bring a removed shape back with the attributes it had. """
+        if not self.alive[sid]:
+            self.alive[sid] = 1
+            self._count += 1
+            self.touch((sid,))
+
+    def clear(self):
+        self.__init__()
+
+    def copy(self):
+        """ Independent copy of the document, e.g. for writing it out on another thread. """
+        clone = Document()
+        clone.kinds = self.kinds[:]
+        clone.coords = self.coords[:]
+        clone.colors = self.colors[:]
+        clone.corners = self.corners[:]
+        clone.group_ids = self.group_ids[:]
+        clone.alive = self.alive[:]
+        clone.palette = self.palette[:]
+        clone._palette_index = dict(self._palette_index)
+        clone._count = self._count
+        groups = clone.groups
+        groups.parents = dict(self.groups.parents)
+        groups.members = {g: set(sids) for g, sids in self.groups.members.items()}
+        groups.children = {g: set(children) for g, children in self.groups.children.items()}
+        groups.next_id = self.groups.next_id
+        return clone
+
+    def track_changes(self, enabled=True):
+        """ Start (or stop) collecting the ids of shapes that change. """
+        self.changed = set() if enabled else None
+
+    def touch(self, sids):
+        """ Mark shapes as changed; for code that writes the columns directly. """
+        if self.changed is not None:
+            self.changed.update(sids)
+
+    def take_changes(self):
+        """ Ids of shapes changed since the last call, in id order. """
+        changed = sorted(self.changed) if self.changed else []
+        if self.changed is not None:
+            self.changed = set()
+        return changed
+
+    def records(self):
+        """ Iterate over live shapes as add() argument tuples. """
+        for sid in self:
+            yield (self.type(sid), *self.get_coords(sid), self.color(sid), self.corner_style(sid))
+
+    def type(self, sid):
+        return SHAPE_TYPES[self.kinds[sid]]
+
+    def get_coords(self, sid):
+        i = sid * 4
+        return tuple(self.coords[i:i + 4])
+
+    def set_coords(self, sid, x1, y1, x2, y2):
+        i = sid * 4
+        self.coords[i:i + 4] = array('d', (x1, y1, x2, y2))
+        self.touch((sid,))
+
+    def translate(self, sid, dx, dy):
+        i = sid * 4
+        c = self.coords
+        c[i] += dx
+        c[i + 1] += dy
+        c[i + 2] += dx
+        c[i + 3] += dy
+        if self.changed is not None:
+            self.changed.add(sid)
+
+    def vertices(self, sid):
+        """ End points of a line, or the four corners of a rectangle. """
+        x1, y1, x2, y2 = self.get_coords(sid)
+        if self.kinds[sid] == 0:
+            return ((x1, y1), (x2, y2))
+        return ((x1, y1), (x2, y1), (x2, y2), (x1, y2))
+
+    def bbox(self, sid):
+        """ Normalised (min x, min y, max x, max y) of a shape. """
+        x1, y1, x2, y2 = self.get_coords(sid)
+        return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+    def color(self, sid):
+        return self.palette[self.colors[sid]]
+
+    def set_color(self, sid, color):
+        self.colors[sid] = self.color_index(color)
+        self.touch((sid,))
+
+    def corner_style(self, sid):
+        return CORNER_STYLES[self.corners[sid]]
+
+    def set_corner_style(self, sid, corner_style):
+        self.corners[sid] = CORNER_STYLES.index(corner_style)
+        self.touch((sid,))
+
+    def group(self, sid):
+        return self.group_ids[sid]
+
+    def set_group(self, sid, group_id):
+        self.group_ids[sid] = group_id
+        self.touch((sid,))
+
+
+class GroupTree:
+    """ Groups of shapes and of other groups, stored as a forest.
+
+    The document's ``group_ids`` column is the reverse index from a shape to the
+    group directly containing it; ``parents`` does the same for groups.  Finding
+    the group a clicked shape belongs to is therefore a couple of lookups no
+    matter how many groups the drawing has.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self.parents = {}   # group id -> parent group id, -1 for top-level groups
+        self.members = {}   # group id -> shape ids directly in the group
+        self.children = {}  # group id -> group ids directly in the group
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.parents)
+
+    def __contains__(self, group_id):
+        return group_id in self.parents
+
+    @staticmethod
+    def tag(group_id):
+        """ Canvas tag carried by every item inside the group, at any depth. """
+        return f"group_{group_id}"
+
+    def create(self, shape_ids=(), group_ids=(), parent=-1):
+        """ Make a new group containing the given shapes and groups. """
+        group_id = self.next_id
+        self.next_id += 1
+        self.parents[group_id] = -1
+        self.members[group_id] = set()
+        self.children[group_id] = set()
+        if parent != -1:
+            self._attach(group_id, parent)
+        for sid in shape_ids:
+            self.add_shape(group_id, sid)
+        for child in group_ids:
+            self._detach(child)
+            self._attach(child, group_id)
+        return group_id
+
+    def rebuild(self, parents):
+        """ Reset the forest to ``parents`` (group id -> parent), taking members from the document. """
+        self.parents = parents
+        self.members = {group_id: set() for group_id in parents}
+        self.children = {group_id: set() for group_id in parents}
+        self.next_id = max(parents, default=-1) + 1
+        if not parents:
+            return
+        for group_id, parent in parents.items():
+            if parent != -1:
+                self.children[parent].add(group_id)
+        alive = self.document.alive
+        for sid, group_id in enumerate(self.document.group_ids):
+            if group_id in parents and alive[sid]:
+                self.members[group_id].add(sid)
+
+    def add_shape(self, group_id, sid):
+        old = self.document.group(sid)
+        if old != -1:
+            self.members[old].discard(sid)
+        self.document.set_group(sid, group_id)
+        self.members[group_id].add(sid)
+
+    def _attach(self, group_id, parent):
+        self.parents[group_id] = parent
+        self.children[parent].add(group_id)
+
+    def _detach(self, group_id):
+        parent = self.parents[group_id]
+        if parent != -1:
+            self.children[parent].discard(group_id)
+        self.parents[group_id] = -1
+
+    def root(self, group_id):
+        """ Outermost group enclosing ``group_id``. """
+        parents = self.parents
+        while parents[group_id] != -1:
+            group_id = parents[group_id]
+        return group_id
+
+    def top_level(self, sid):
+        """ Outermost group a shape belongs to, or None if it is ungrouped. """
+        group_id = self.document.group(sid)
+        return None if group_id == -1 else self.root(group_id)
+
+    def ancestors(self, group_id):
+        """ ``group_id`` followed by each enclosing group up to the root. """
+        chain = []
+        while group_id != -1:
+            chain.append(group_id)
+            group_id = self.parents[group_id]
+        return chain
+
+    def lineage(self, group_id):
+        """ ``(group id, parent)`` pairs from ``group_id`` up to its root. """
+        return tuple((g, self.parents[g]) for g in self.ancestors(group_id))
+
+    def reinstate(self, lineage):
+        """ Recreate any groups of a saved lineage that have since been removed. """
+        for group_id, parent in reversed(lineage):
+            if group_id not in self.parents:
+                self.parents[group_id] = -1
+                self.members[group_id] = set()
+                self.children[group_id] = set()
+                if parent != -1 and parent in self.parents:
+                    self._attach(group_id, parent)
+
+    def shape_tags(self, sid):
+        """ Canvas tags for a shape: one per group enclosing it. """
+        group_id = self.document.group(sid)
+        return tuple(self.tag(g) for g in self.ancestors(group_id)) if group_id != -1 else ()
+
+    def subgroups(self, group_id):
+        """ ``group_id`` and every group nested inside it. """
+        stack, found = [group_id], []
+        while stack:
+            current = stack.pop()
+            found.append(current)
+            stack.extend(self.children[current])
+        return found
+
+    def shapes(self, group_id):
+        """ Every shape in the group, including those of nested groups. """
+        found = []
+        for current in self.subgroups(group_id):
+            found.extend(self.members[current])
+        return found
+
+    def dissolve(self, group_id):
+        """ Remove one level of grouping; contents move to the enclosing group. """
+        parent = self.parents[group_id]
+        for sid in self.members.pop(group_id):
+            self.document.set_group(sid, parent)
+            if parent != -1:
+                self.members[parent].add(sid)
+        for child in self.children.pop(group_id):
+            self.parents[child] = parent
+            if parent != -1:
+                self.children[parent].add(child)
+        if parent != -1:
+            self.children[parent].discard(group_id)
+        del self.parents[group_id]
+
+    def delete(self, group_id):
+        """ Forget a group and all groups nested in it (shapes are untouched). """
+        self._detach(group_id)
+        for current in self.subgroups(group_id):
+            for sid in self.members.pop(current):
+                self.document.set_group(sid, -1)
+            del self.children[current]
+            del self.parents[current]
+
+    def discard_shape(self, sid):
+        """ Drop a shape from its group, pruning groups left empty. """
+        group_id = self.document.group(sid)
+        if group_id == -1:
+            return
+        self.members[group_id].discard(sid)
+        while group_id != -1 and not self.members[group_id] and not self.children[group_id]:
+            parent = self.parents[group_id]
+            self.delete(group_id)
+            group_id = parent
+
+
+class RemoveShapes:
+    """ Undoable removal of shapes.
+
+    Removal only tombstones document rows, so the delta is just the shape ids
+    plus enough group lineage to rebuild groups that were pruned on the way.
+    Undoing a bulk delete flips bits back on instead of replaying a snapshot.
+    """
+
+    def __init__(self, sids):
+        self.sids = array('i', sids)
+        self.group_ids = array('i')
+        self.lineages = {}
+
+    def size(self):
+        return (len(self.sids) + len(self.group_ids)) * 4 + 64 * len(self.lineages)
+
+    def apply(self, document):
+        groups = document.groups
+        self.group_ids = array('i', (document.group(sid) for sid in self.sids))
+        self.lineages = {}
+        for group_id in set(self.group_ids):
+            if group_id != -1 and group_id in groups:
+                self.lineages[group_id] = groups.lineage(group_id)
+        for sid in self.sids:
+            groups.discard_shape(sid)
+            document.remove(sid)
+
+    def revert(self, document):
+        groups = document.groups
+        for sid, group_id in zip(self.sids, self.group_ids):
+            document.restore(sid)
+            if group_id != -1:
+                groups.reinstate(self.lineages[group_id])
+                groups.add_shape(group_id, sid)
+
+
+class AddShapes(RemoveShapes):
+    """ Undoable creation of shapes; the inverse of RemoveShapes. """
+
+    def apply(self, document):
+        RemoveShapes.revert(self, document)
+
+    def revert(self, document):
+        RemoveShapes.apply(self, document)
+
+
+class MoveShapes:
+    """ Undoable translation of shapes by a common offset. """
+
+    def __init__(self, sids, dx, dy):
+        self.sids = array('i', sids)
+        self.dx = dx
+        self.dy = dy
+
+    def size(self):
+        return len(self.sids) * 4 + 16
+
+    def merge(self, other):
+        """ Fold a later move of the same shapes into this one. """
+        if not isinstance(other, MoveShapes) or other.sids != self.sids:
+            return False
+        self.dx += other.dx
+        self.dy += other.dy
+        return True
+
+    def apply(self, document):
+        transform_shapes(document, self.sids, translation(self.dx, self.dy))
+
+    def revert(self, document):
+        transform_shapes(document, self.sids, translation(-self.dx, -self.dy))
+
+
+class SetStyle:
+    """ Undoable change of colour and corner style; keeps the old values per shape. """
+
+    def __init__(self, document, sids, color, corner_style=None):
+        self.sids = array('i', sids)
+        self.old_colors = array('H', (document.colors[sid] for sid in self.sids))
+        self.old_corners = array('b', (document.corners[sid] for sid in self.sids))
+        self.color = document.color_index(color)
+        self.corner = None if corner_style is None else CORNER_STYLES.index(corner_style)  # None keeps corners
+
+    def size(self):
+        return len(self.sids) * 7 + 16
+
+    def apply(self, document):
+        for sid in self.sids:
+            document.colors[sid] = self.color
+            if self.corner is not None and document.kinds[sid] == SHAPE_TYPES.index("rectangle"):
+                document.corners[sid] = self.corner
+        document.touch(self.sids)
+
+    def revert(self, document):
+        for sid, color, corner in zip(self.sids, self.old_colors, self.old_corners):
+            document.colors[sid] = color
+            document.corners[sid] = corner
+        document.touch(self.sids)
+
+
+class SetCoords:
+    """ Undoable replacement of shape coordinates, e.g. by a transform; keeps old and new values. """
+
+    def __init__(self, document, sids, coords):
+        self.sids = array('i', sids)
+        self.old = gather_coords(document, self.sids)
+        self.new = coords
+
+    def size(self):
+        return len(self.sids) * 68 + 16
+
+    def apply(self, document):
+        scatter_coords(document, self.sids, self.new)
+
+    def revert(self, document):
+        scatter_coords(document, self.sids, self.old)
+
+
+class History:
+    """ Bounded undo/redo log of document commands.
+
+    Commands record deltas (shape ids and old values), never snapshots, and
+    each stack holds (command, size) pairs.  The log keeps at most ``limit``
+    entries and roughly ``max_bytes`` of deltas, dropping the oldest entries
+    first.  ``record(..., merge=True)`` folds the command into the previous one
+    while a merge run is open, e.g. the motion events of a drag; ``seal()``
+    ends the run.
+    """
+
+    def __init__(self, limit=500, max_bytes=64 * 1024 * 1024):
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.bytes = 0
+        self._merging = False
+
+    def record(self, command, merge=False):
+        # Sizes are stored at record time: commands such as RemoveShapes grow once applied
+        for _, size in self.redo_stack:
+            self.bytes -= size
+        self.redo_stack.clear()
+        if merge and self._merging and self.undo_stack and self.undo_stack[-1][0].merge(command):
+            return
+        self._merging = merge
+        size = command.size()
+        self.undo_stack.append((command, size))
+        self.bytes += size
+        while len(self.undo_stack) > 1 and (len(self.undo_stack) > self.limit or self.bytes > self.max_bytes):
+            self.bytes -= self.undo_stack.popleft()[1]
+
+    def seal(self):
+        self._merging = False
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def undo(self, document):
+        """ Revert the latest command; returns the ids of the shapes it touched. """
+        self._merging = False
+        if not self.undo_stack:
+            return ()
+        entry = self.undo_stack.pop()
+        entry[0].revert(document)
+        self.redo_stack.append(entry)
+        return entry[0].sids
+
+    def redo(self, document):
+        self._merging = False
+        if not self.redo_stack:
+            return ()
+        entry = self.redo_stack.pop()
+        entry[0].apply(document)
+        self.undo_stack.append(entry)
+        return entry[0].sids
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.bytes = 0
+        self._merging = False
+
+
+def point_segment_distance(px, py, x1, y1, x2, y2):
+    """ Exact distance from a point to the segment (x1, y1)-(x2, y2). """
+    dx, dy = x2 - x1, y2 - y1
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return math.hypot(px - x1, py - y1)
+    t = max(0.0, min(1.0, ((px - x1) * dx + (py - y1) * dy) / length_sq))
+    return math.hypot(px - (x1 + t * dx), py - (y1 + t * dy))
+
+
+def point_rect_edge_distance(px, py, x1, y1, x2, y2):
+    """ Exact distance from a point to the outline of an axis-aligned rectangle. """
+    left, right = min(x1, x2), max(x1, x2)
+    top, bottom = min(y1, y2), max(y1, y2)
+    if left <= px <= right and top <= py <= bottom:
+        return min(px - left, right - px, py - top, bottom - py)
+    return math.hypot(max(left - px, 0, px - right), max(top - py, 0, py - bottom))
+
+
+def point_in_polygon(px, py, polygon):
+    """ Even-odd test of a point against a closed polygon given as (x, y) pairs. """
+    inside = False
+    x1, y1 = polygon[-1]
+    for x2, y2 in polygon:
+        if (y1 > py) != (y2 > py) and px < x1 + (py - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+        x1, y1 = x2, y2
+    return inside
+
+
+_ORIENTATION_ERROR = 3.3306690738754716e-16  # Bound on the relative rounding error of the float test
+
+
+def _orientation(ax, ay, bx, by, px, py):
+    """ Sign of the turn a -> b -> p: 1 counter-clockwise, -1 clockwise, 0 collinear.
+
+    Computed in floats, and again in exact fractions when the float result is
+    too close to zero to trust, so shapes meeting at a point always touch.
+    """
+    left = (bx - ax) * (py - ay)
+    right = (by - ay) * (px - ax)
+    cross = left - right
+    if abs(cross) > _ORIENTATION_ERROR * (abs(left) + abs(right)):
+        return (cross > 0) - (cross < 0)
+    if left == right == 0:
+        return 0  # A zero product means an exactly zero difference
+    return _exact_orientation(ax, ay, bx, by, px, py)
+
+
+def _exact_orientation(*values):
+    from fractions import Fraction
+    ax, ay, bx, by, px, py = map(Fraction, values)
+    cross = (bx - ax) * (py - ay) - (by - ay) * (px - ax)
+    return (cross > 0) - (cross < 0)
+
+
+def _within_box(px, py, x1, y1, x2, y2):
+    return min(x1, x2) <= px <= max(x1, x2) and min(y1, y2) <= py <= max(y1, y2)
+
+
+def segments_intersect(ax1, ay1, ax2, ay2, bx1, by1, bx2, by2):
+    """ Whether two closed segments share a point; touching ends and collinear overlaps count. """
+    d1 = _orientation(bx1, by1, bx2, by2, ax1, ay1)
+    d2 = _orientation(bx1, by1, bx2, by2, ax2, ay2)
+    d3 = _orientation(ax1, ay1, ax2, ay2, bx1, by1)
+    d4 = _orientation(ax1, ay1, ax2, ay2, bx2, by2)
+    if d1 * d2 < 0 and d3 * d4 < 0:
+        return True
+    return ((d1 == 0 and _within_box(ax1, ay1, bx1, by1, bx2, by2)) or
+            (d2 == 0 and _within_box(ax2, ay2, bx1, by1, bx2, by2)) or
+            (d3 == 0 and _within_box(bx1, by1, ax1, ay1, ax2, ay2)) or
+            (d4 == 0 and _within_box(bx2, by2, ax1, ay1, ax2, ay2)))
+
+
+def segment_distance(ax1, ay1, ax2, ay2, bx1, by1, bx2, by2):
+    """ Exact distance between two segments, 0 when they intersect. """
+    if segments_intersect(ax1, ay1, ax2, ay2, bx1, by1, bx2, by2):
+        return 0.0
+    return min(point_segment_distance(ax1, ay1, bx1, by1, bx2, by2),
+               point_segment_distance(ax2, ay2, bx1, by1, bx2, by2),
+               point_segment_distance(bx1, by1, ax1, ay1, ax2, ay2),
+               point_segment_distance(bx2, by2, ax1, ay1, ax2, ay2))
+
+
+ALIGN_EDGES = ("left", "center", "right", "top", "middle", "bottom")
+_numpy = None
+
+
+def load_numpy():
+    """ The numpy module, or None when it is not installed.
+
+    Imported on first use rather than at startup, since it takes longer to load
+    than the rest of the editor.
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def translation(dx, dy):
+    """ Affine matrices are ``(a, b, c, d, e, f)``: x' = a*x + b*y + c, y' = d*x + e*y + f. """
+    return (1.0, 0.0, dx, 0.0, 1.0, dy)
+
+
+def scaling(sx, sy, cx=0.0, cy=0.0):
+    """ Scale about (cx, cy); a negative factor mirrors. """
+    return (sx, 0.0, cx - sx * cx, 0.0, sy, cy - sy * cy)
+
+
+def rotation(degrees, cx=0.0, cy=0.0):
+    """ Rotate about (cx, cy), clockwise on screen since y grows downwards. """
+    if degrees % 90 == 0:
+        cos, sin = ((1, 0), (0, 1), (-1, 0), (0, -1))[int(degrees // 90) % 4]  # Exact quarter turns
+    else:
+        cos, sin = math.cos(math.radians(degrees)), math.sin(math.radians(degrees))
+    return (cos, -sin, cx - cos * cx + sin * cy, sin, cos, cy - sin * cx - cos * cy)
+
+
+def gather_coords(document, sids):
+    """ Coordinates of the given shapes, four per shape, as a new array. """
+    np = load_numpy()
+    if np is not None and len(sids):
+        rows = np.frombuffer(document.coords, dtype=np.float64).reshape(-1, 4)
+        picked = rows[np.asarray(sids, dtype=np.intp)]
+        del rows  # Release the export so the array can grow again
+        return array('d', picked.tobytes())
+    coords = document.coords
+    values = array('d')
+    for sid in sids:
+        values.extend(coords[sid * 4:sid * 4 + 4])
+    return values
+
+
+def scatter_coords(document, sids, values):
+    """ Write coordinates gathered with gather_coords() back to the document. """
+    np = load_numpy()
+    if np is not None and len(sids):
+        rows = np.frombuffer(document.coords, dtype=np.float64).reshape(-1, 4)
+        rows[np.asarray(sids, dtype=np.intp)] = np.frombuffer(values, dtype=np.float64).reshape(-1, 4)
+        del rows
+    else:
+        coords = document.coords
+        for i, sid in enumerate(sids):
+            coords[sid * 4:sid * 4 + 4] = values[i * 4:i * 4 + 4]
+    document.touch(sids)
+
+
+def transform_coords(values, matrix):
+    """ Apply an affine matrix to every point of a coordinate array; returns a new array. """
+    a, b, c, d, e, f = matrix
+    np = load_numpy()
+    if np is not None:
+        points = np.frombuffer(values, dtype=np.float64).reshape(-1, 2)
+        x, y = points[:, 0], points[:, 1]
+        out = np.empty_like(points)
+        out[:, 0] = a * x + b * y + c
+        out[:, 1] = d * x + e * y + f
+        return array('d', out.tobytes())
+    xs, ys = values[0::2], values[1::2]
+    out = array('d', values)
+    out[0::2] = array('d', [a * x + b * y + c for x, y in zip(xs, ys)])
+    out[1::2] = array('d', [d * x + e * y + f for x, y in zip(xs, ys)])
+    return out
+
+
+def bound_rectangles(document, sids, old, new, matrix):
+    """ Keep transformed rectangles from collapsing under matrices that tilt the axes.
+
+    Rectangles are stored as two axis-aligned corners, so rotating just those
+    corners by 45 degrees would give a zero-width rectangle.  For such matrices
+    each rectangle in ``new`` becomes the bounding box of its four transformed
+    corners from ``old`` instead.
+    """
+    a, b, c, d, e, f = matrix
+    if (b == 0 and d == 0) or (a == 0 and e == 0):
+        return new  # Translations, scaling, mirroring and quarter turns keep rectangles exact
+    kinds, rectangle = document.kinds, SHAPE_TYPES.index("rectangle")
+    for i, sid in enumerate(sids):
+        if kinds[sid] != rectangle:
+            continue
+        x1, y1, x2, y2 = old[i * 4:i * 4 + 4]
+        corners = ((x1, y1), (x2, y1), (x2, y2), (x1, y2))
+        xs = [a * x + b * y + c for x, y in corners]
+        ys = [d * x + e * y + f for x, y in corners]
+        new[i * 4:i * 4 + 4] = array('d', (min(xs), min(ys), max(xs), max(ys)))
+    return new
+
+
+def transform_shapes(document, sids, matrix):
+    scatter_coords(document, sids, transform_coords(gather_coords(document, sids), matrix))
+
+
+def coords_bounds(values):
+    """ Joint (left, top, right, bottom) of a coordinate array. """
+    xs, ys = values[0::2], values[1::2]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _unit_extents(values, sizes, axis):
+    """ Lowest and highest coordinate along ``axis`` (0: x, 1: y) of each run of ``sizes`` shapes. """
+    np = load_numpy()
+    if np is not None:
+        along = np.frombuffer(values, dtype=np.float64).reshape(-1, 4)[:, axis::2]
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        return (np.minimum.reduceat(along.min(axis=1), starts).tolist(),
+                np.maximum.reduceat(along.max(axis=1), starts).tolist())
+    lows, highs = [], []
+    start = 0
+    for size in sizes:
+        run = values[start * 4:(start + size) * 4]
+        along = run[axis::2]
+        lows.append(min(along))
+        highs.append(max(along))
+        start += size
+    return lows, highs
+
+
+def _shift_units(values, sizes, axis, deltas):
+    """ Move each run of ``sizes`` shapes by its entry of ``deltas`` along ``axis``. """
+    np = load_numpy()
+    if np is not None:
+        rows = np.frombuffer(values, dtype=np.float64).reshape(-1, 4).copy()
+        rows[:, axis::2] += np.repeat(np.asarray(deltas, dtype=np.float64), sizes)[:, None]
+        return array('d', rows.tobytes())
+    out = array('d', values)
+    start = 0
+    for size, delta in zip(sizes, deltas):
+        for i in range(start * 4 + axis, (start + size) * 4, 2):
+            out[i] += delta
+        start += size
+    return out
+
+
+def align_coords(document, units, edge):
+    """ New coordinates lining units up on an edge or centre line of their joint bounds.
+
+    ``units`` are lists of shape ids that move together, such as the shapes of
+    a group.  Returns ``(sids, coords)`` with the units' shapes concatenated.
+    """
+    sids = [sid for unit in units for sid in unit]
+    sizes = [len(unit) for unit in units]
+    values = gather_coords(document, sids)
+    axis = 0 if edge in ("left", "center", "right") else 1
+    lows, highs = _unit_extents(values, sizes, axis)
+    if edge in ("left", "top"):
+        target = min(lows)
+        deltas = [target - low for low in lows]
+    elif edge in ("right", "bottom"):
+        target = max(highs)
+        deltas = [target - high for high in highs]
+    else:
+        target = (min(lows) + max(highs)) / 2
+        deltas = [target - (low + high) / 2 for low, high in zip(lows, highs)]
+    return sids, _shift_units(values, sizes, axis, deltas)
+
+
+def distribute_coords(document, units, axis):
+    """ New coordinates spacing unit centres evenly along ``axis`` (0: x, 1: y).
+
+    The outermost units stay where they are.  Returns ``(sids, coords)``.
+    """
+    sids = [sid for unit in units for sid in unit]
+    sizes = [len(unit) for unit in units]
+    values = gather_coords(document, sids)
+    lows, highs = _unit_extents(values, sizes, axis)
+    centers = [(low + high) / 2 for low, high in zip(lows, highs)]
+    order = sorted(range(len(units)), key=centers.__getitem__)
+    deltas = [0.0] * len(units)
+    if len(units) > 2:
+        first, step = centers[order[0]], (centers[order[-1]] - centers[order[0]]) / (len(units) - 1)
+        for rank, unit in enumerate(order):
+            deltas[unit] = first + rank * step - centers[unit]
+    return sids, _shift_units(values, sizes, axis, deltas)
+
+
+def shape_segments(document, sid):
+    """ The drawn strokes of a shape: the line itself, or the four edges of a rectangle. """
+    points = document.vertices(sid)
+    if len(points) == 2:
+        return [points[0] + points[1]]
+    return [points[i - 1] + points[i] for i in range(4)]
+
+
+def shape_distance(document, a, b):
+    """ Exact distance between the strokes of two shapes, as hit-testing measures it. """
+    return min(segment_distance(*first, *second)
+               for first in shape_segments(document, a) for second in shape_segments(document, b))
+
+
+def sweep_overlaps(boxes, band=None, max_bands=64):
+    """ Yield each pair of ids whose closed (id, left, top, right, bottom) boxes overlap.
+
+    Boxes enter a sweep over x at their left edge and leave once it passes their
+    right edge.  The active boxes are bucketed into horizontal bands of height
+    ``band``, so an entering box is only compared with active boxes in the bands
+    its y-range covers; boxes taller than ``max_bands`` bands are compared with
+    everything active.  That suits rectangles, whose boxes are the shapes
+    themselves, but not slanted lines: use sweep_segments() for those.
+    """
+    if not boxes:
+        return
+    boxes = sorted(boxes, key=lambda box: box[1])
+    if band is None:
+        top = min(box[2] for box in boxes)
+        bottom = max(box[4] for box in boxes)
+        # About as high as a typical box, but never so thin that the bands outnumber the boxes
+        band = max(sum(box[4] - box[2] for box in boxes) / len(boxes), (bottom - top) / len(boxes), 1e-9)
+    bands = {}  # band number -> {id: (left, top, right, bottom)} of active boxes
+    tall = {}  # active boxes spanning more than max_bands bands
+    spans = {}  # id -> (first band, last band), None when tall
+    expiry = []  # (right, id) of active boxes
+    for sid, left, top, right, bottom in boxes:
+        while expiry and expiry[0][0] < left:
+            _, old = heapq.heappop(expiry)
+            span = spans.pop(old)
+            if span is None:
+                del tall[old]
+            else:
+                for number in range(span[0], span[1] + 1):
+                    bucket = bands[number]
+                    del bucket[old]
+                    if not bucket:
+                        del bands[number]
+        first, last = math.floor(top / band), math.floor(bottom / band)
+        if last - first >= max_bands:
+            # Compare with every active box; each pair is reported once below
+            for number, others in bands.items():
+                for other, (_, other_top, _, other_bottom) in others.items():
+                    if spans[other][0] == number and other_top <= bottom and top <= other_bottom:
+                        yield other, sid
+            span = None
+        else:
+            for number in range(first, last + 1):
+                for other, (_, other_top, _, other_bottom) in bands.get(number, {}).items():
+                    # A pair sharing several bands is reported only in the first of them
+                    if max(spans[other][0], first) == number and other_top <= bottom and top <= other_bottom:
+                        yield other, sid
+            span = (first, last)
+        for other, (_, other_top, _, other_bottom) in tall.items():
+            if other_top <= bottom and top <= other_bottom:
+                yield other, sid
+        spans[sid] = span
+        heapq.heappush(expiry, (right, sid))
+        if span is None:
+            tall[sid] = (left, top, right, bottom)
+        else:
+            for number in range(first, last + 1):
+                bands.setdefault(number, {})[sid] = (left, top, right, bottom)
+
+
+def _exact_integers(values):
+    """ ``(integers, scale)``: the values times one power of two, ``scale``, which makes them all whole. """
+    ratios = [float(value).as_integer_ratio() for value in values]
+    scale = max((denominator for _, denominator in ratios), default=1)
+    return [numerator * (scale // denominator) for numerator, denominator in ratios], scale
+
+
+class _SweepPoint(tuple):
+    """ An exact point ``(x, y, w)`` standing for (x / w, y / w), with w > 0 and no common factor. """
+    __slots__ = ()
+
+    def __lt__(self, other):
+        x, y, w = self
+        other_x, other_y, other_w = other
+        if x * other_w != other_x * w:
+            return x * other_w < other_x * w
+        return y * other_w < other_y * w
+
+
+def _crossing(first, second):
+    """ The single point where two integer segments meet, or None when they miss or are parallel. """
+    ax, ay, ax2, ay2 = first
+    bx, by, bx2, by2 = second
+    adx, ady, bdx, bdy = ax2 - ax, ay2 - ay, bx2 - bx, by2 - by
+    denominator = adx * bdy - ady * bdx
+    if denominator == 0:
+        return None  # Collinear overlaps meet at endpoints, which are events already
+    along_first = (bx - ax) * bdy - (by - ay) * bdx
+    along_second = (bx - ax) * ady - (by - ay) * adx
+    if denominator < 0:
+        denominator, along_first, along_second = -denominator, -along_first, -along_second
+    if not (0 <= along_first <= denominator and 0 <= along_second <= denominator):
+        return None
+    x, y = ax * denominator + along_first * adx, ay * denominator + along_first * ady
+    common = math.gcd(math.gcd(x, y), denominator)
+    return _SweepPoint((x // common, y // common, denominator // common))
+
+
+def sweep_segments(segments):
+    """ Yield each pair of ids whose closed (id, x1, y1, x2, y2) segments intersect.
+
+    A Bentley-Ottmann sweep over x (then y) keeps the segments it crosses in a
+    list ordered by y.  A segment is only tested against its neighbours in that
+    list: when it enters, when one next to it leaves, and when a crossing
+    swaps it with another.  Segments that never meet thus cost log n each
+    however long they are, and n segments with k crossings take (n + k) log n.
+    Coordinates are scaled to exact integers, so every segment through a point
+    is found there, including touching ends and collinear overlaps.
+    """
+    segments = list(segments)
+    values, scale = _exact_integers([value for segment in segments for value in segment[1:]])
+    ends = {}  # id -> (x1, y1, x2, y2) with the sweep meeting (x1, y1) first
+    starting = {}  # (x, y, 1) -> ids of segments entering there
+    for i, (sid, *_) in enumerate(segments):
+        x1, y1, x2, y2 = values[i * 4:i * 4 + 4]
+        if (x2, y2) < (x1, y1):
+            x1, y1, x2, y2 = x2, y2, x1, y1
+        ends[sid] = (x1, y1, x2, y2)
+        starting.setdefault((x1, y1, 1), []).append(sid)
+    queued = set(starting)
+    queued.update((x2, y2, 1) for _, _, x2, y2 in ends.values())
+    endpoints = sorted(queued)  # Whole numbers, so plain tuples compare exactly
+    crossings = []  # heap of crossing points past the sweep, see entry()
+    active = []  # ids ordered by y along the sweep line
+    reported = set()  # collinear overlaps meet at more than one event
+
+    def entry(point):
+        # Heap entries order like the points but compare as floats, with the
+        # direction each float was rounded in, and fall back on the exact point
+        # only when both of those tie
+        x, y, w = point
+        ordered = []
+        for value in (x, y):
+            rounded = value / (w * scale)
+            numerator, denominator = rounded.as_integer_ratio()
+            error = value * denominator - numerator * w * scale
+            ordered += (rounded, (error > 0) - (error < 0), point if error else 0)
+        ordered[-1] = point
+        return tuple(ordered)
+
+    def check(below, above, point):
+        crossing = _crossing(ends[below], ends[above])
+        # Queued points include the current one, so a crossing not before it lies past it
+        if crossing is not None and crossing not in queued and not crossing < point:
+            queued.add(crossing)
+            heapq.heappush(crossings, entry(crossing))
+
+    def steeper(first, second):
+        # Order of segments leaving a common point, bottom to top; vertical ones last
+        x1, y1, x2, y2 = ends[first]
+        x3, y3, x4, y4 = ends[second]
+        cross = (x2 - x1) * (y4 - y3) - (y2 - y1) * (x4 - x3)
+        return (cross < 0) - (cross > 0)
+
+    from functools import cmp_to_key
+    slope = cmp_to_key(steeper)
+    following = 0
+    while following < len(endpoints) or crossings:
+        if crossings and (following == len(endpoints) or crossings[0][-1] < endpoints[following]):
+            point = heapq.heappop(crossings)[-1]
+        else:
+            point = endpoints[following]
+            following += 1
+        x, y, w = point
+        # Bisect for the first segment not below the point
+        low, high = 0, len(active)
+        while low < high:
+            middle = (low + high) // 2
+            x1, y1, x2, y2 = ends[active[middle]]
+            if x1 == x2:
+                above = y > y2 * w
+            else:
+                above = (x2 - x1) * (y - y1 * w) > (y2 - y1) * (x - x1 * w)
+            if above:
+                low = middle + 1
+            else:
+                high = middle
+        high = low
+        while high < len(active):
+            x1, y1, x2, y2 = ends[active[high]]
+            if x1 == x2:
+                if y > y2 * w:
+                    break
+            elif (x2 - x1) * (y - y1 * w) != (y2 - y1) * (x - x1 * w):
+                break
+            high += 1
+        meeting = active[low:high]
+        if w == 1:
+            meeting += starting.get(point, ())
+        if len(meeting) > 1:
+            for i, first in enumerate(meeting):
+                for second in meeting[i + 1:]:
+                    pair = (first, second) if first < second else (second, first)
+                    if pair not in reported:
+                        reported.add(pair)
+                        yield pair
+        # Segments going on past the point re-enter in their order just after it
+        if w == 1:
+            going = [sid for sid in meeting if ends[sid][2] != x or ends[sid][3] != y]
+        else:
+            going = meeting
+        if len(going) > 1:
+            going.sort(key=slope)
+        active[low:high] = going
+        if not going:
+            if 0 < low < len(active):
+                check(active[low - 1], active[low], point)
+            continue
+        if low > 0:
+            check(active[low - 1], active[low], point)
+        high = low + len(going)
+        if high < len(active):
+            check(active[high - 1], active[high], point)
+
+
+def _shape_boxes(document, sids, kind):
+    kinds, bbox = document.kinds, document.bbox
+    return [(sid, *bbox(sid)) for sid in (document if sids is None else sids) if kinds[sid] == kind]
+
+
+def line_intersections(document, sids=None):
+    """ Sorted (a, b) pairs of lines, among ``sids`` or the whole document, that cross or touch.
+
+    Lines are paired by sweep_overlaps() first, which is quickest while few of
+    their boxes overlap without the lines crossing.  Long slanted lines break
+    that, as their boxes all overlap one another, so once the boxes have come
+    up about ``4 * n`` times in vain the lines go to sweep_segments() instead.
+    """
+    coords = document.coords
+    boxes = _shape_boxes(document, sids, SHAPE_TYPES.index("line"))
+    misses = 4 * len(boxes) + 1024
+    pairs = []
+    for a, b in sweep_overlaps(boxes):
+        if segments_intersect(*coords[a * 4:a * 4 + 4], *coords[b * 4:b * 4 + 4]):
+            pairs.append((a, b) if a < b else (b, a))
+        else:
+            misses -= 1
+            if not misses:
+                return sorted(sweep_segments((sid, *coords[sid * 4:sid * 4 + 4]) for sid, *_ in boxes))
+    pairs.sort()
+    return pairs
+
+
+def rectangle_overlaps(document, sids=None):
+    """ Sorted (a, b, relation) for rectangles whose areas overlap.
+
+    The relation is "contains" when b lies entirely inside a, else "overlaps".
+    Rectangles that only share an edge or a corner are not reported.
+    """
+    bbox = document.bbox
+    found = []
+    for a, b in sweep_overlaps(_shape_boxes(document, sids, SHAPE_TYPES.index("rectangle"))):
+        if b < a:
+            a, b = b, a
+        ax1, ay1, ax2, ay2 = bbox(a)
+        bx1, by1, bx2, by2 = bbox(b)
+        if ax1 <= bx1 and bx2 <= ax2 and ay1 <= by1 and by2 <= ay2:
+            found.append((a, b, "contains"))
+        elif bx1 <= ax1 and ax2 <= bx2 and by1 <= ay1 and ay2 <= by2:
+            found.append((b, a, "contains"))
+        elif ax1 < bx2 and bx1 < ax2 and ay1 < by2 and by1 < ay2:
+            found.append((a, b, "overlaps"))
+    found.sort()
+    return found
+
+
+class SpatialIndex:
+    """ Uniform grid over the drawn strokes of shapes for hit-testing and region queries.
+
+    A line is registered in every cell its segment passes through, and a
+    rectangle in the cells of its four edges, so a point or rectangle query
+    only looks at the shapes drawn in the cells it covers, however long or
+    slanted they are.  The few shapes whose strokes cross more than
+    ``max_stroke_cells`` cells are kept in ``unfiled`` and checked by every query.
+
+    Shapes whose bounding box spans more than ``max_cells`` cells are also
+    listed in ``large``, which zoomed-out views draw one by one.  For the others
+    a coarse count per block of ``2**coarse_shift`` cells is kept, so those
+    views can be summarised without visiting every shape.
+    """
+
+    def __init__(self, document, cell_size=64, max_cells=256, coarse_shift=4, max_stroke_cells=4096):
+        self.document = document
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.max_stroke_cells = max_stroke_cells
+        self.coarse_shift = coarse_shift
+        self.cells = {}
+        self.coarse = {}  # (coarse x, coarse y) -> number of shapes starting there
+        self.large = set()
+        self.unfiled = set()
+        self._keys = {}  # shape id -> (cells, coarse key or None when in self.large)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, sid):
+        return sid in self._keys
+
+    def _cell_range(self, left, top, right, bottom):
+        size = self.cell_size
+        return (math.floor(left / size), math.floor(top / size),
+                math.floor(right / size), math.floor(bottom / size))
+
+    def _segment_cells(self, x1, y1, x2, y2):
+        """ Keys of the cells a segment passes through, walked one column at a time. """
+        size = self.cell_size
+        if x2 < x1:
+            x1, y1, x2, y2 = x2, y2, x1, y1
+        cx0, cx1 = math.floor(x1 / size), math.floor(x2 / size)
+        if cx0 == cx1:
+            return [(cx0, cy) for cy in range(math.floor(min(y1, y2) / size), math.floor(max(y1, y2) / size) + 1)]
+        slope = (y2 - y1) / (x2 - x1)
+        keys = []
+        for cx in range(cx0, cx1 + 1):
+            # The part of the segment inside this column; its ends are exact at the end points
+            xa, xb = max(x1, cx * size), min(x2, (cx + 1) * size)
+            ya, yb = y1 + (xa - x1) * slope, y1 + (xb - x1) * slope
+            if ya > yb:
+                ya, yb = yb, ya
+            keys.extend((cx, cy) for cy in range(math.floor(ya / size), math.floor(yb / size) + 1))
+        return keys
+
+    def _stroke_cells(self, sid, coords, span):
+        cx0, cy0, cx1, cy1 = span
+        if self.document.kinds[sid] == 0:
+            return self._segment_cells(*coords)
+        if cx1 - cx0 < 2 or cy1 - cy0 < 2:
+            return [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+        keys = [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in (cy0, cy1)]
+        keys.extend((cx, cy) for cy in range(cy0 + 1, cy1) for cx in (cx0, cx1))
+        return keys
+
+    def build(self):
+        """ Index every live shape of the document from scratch. """
+        self.cells.clear()
+        self.coarse.clear()
+        self.large.clear()
+        self.unfiled.clear()
+        self._keys.clear()
+        for sid in self.document:
+            self.insert(sid)
+
+    def _locate(self, sid):
+        """ (cells, coarse key) for a shape as it is now; cells is None when it crosses too many. """
+        coords = self.document.get_coords(sid)
+        x1, y1, x2, y2 = coords
+        left, right = (x1, x2) if x1 <= x2 else (x2, x1)
+        top, bottom = (y1, y2) if y1 <= y2 else (y2, y1)
+        size = self.cell_size
+        span = cx0, cy0, cx1, cy1 = (math.floor(left / size), math.floor(top / size),
+                                     math.floor(right / size), math.floor(bottom / size))
+        coarse = None
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > self.max_cells:
+            if (cx1 - cx0 + 1) + (cy1 - cy0 + 1) > self.max_stroke_cells:
+                return None, None  # Even its strokes cross too many cells to file
+        else:
+            coarse = (cx0 >> self.coarse_shift, cy0 >> self.coarse_shift)
+        if cx1 - cx0 < 2 and cy1 - cy0 < 2:
+            # Up to four cells: filing the whole box is as cheap and only a little loose
+            return tuple((cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)), coarse
+        cells = self._stroke_cells(sid, coords, span)
+        if len(cells) > self.max_stroke_cells:
+            return None, coarse
+        return tuple(cells), coarse
+
+    def insert(self, sid):
+        self._file(sid, *self._locate(sid))
+
+    def _file(self, sid, keys, coarse):
+        self._keys[sid] = (keys, coarse)
+        if keys is None:
+            self.unfiled.add(sid)
+        else:
+            cells = self.cells
+            for key in keys:
+                bucket = cells.get(key)
+                if bucket is None:
+                    cells[key] = {sid}
+                else:
+                    bucket.add(sid)
+        if coarse is None:
+            self.large.add(sid)
+        else:
+            self.coarse[coarse] = self.coarse.get(coarse, 0) + 1
+
+    def remove(self, sid):
+        if sid not in self._keys:
+            return
+        keys, coarse = self._keys.pop(sid)
+        if keys is None:
+            self.unfiled.discard(sid)
+        else:
+            cells = self.cells
+            for key in keys:
+                bucket = cells[key]
+                bucket.discard(sid)
+                if not bucket:
+                    del cells[key]
+        if coarse is None:
+            self.large.discard(sid)
+        else:
+            self.coarse[coarse] -= 1
+            if not self.coarse[coarse]:
+                del self.coarse[coarse]
+
+    def update(self, sid):
+        """ Re-index a shape after its coordinates changed. """
+        located = self._locate(sid)
+        if self._keys.get(sid) == located:
+            return  # Still drawn in the same cells
+        self.remove(sid)
+        self._file(sid, *located)
+
+    def candidates(self, left, top, right, bottom):
+        """ Shape ids drawn in the cells overlapping the region (a superset of the hits). """
+        cx0, cy0, cx1, cy1 = self._cell_range(left, top, right, bottom)
+        found = set(self.unfiled)
+        cells = self.cells
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(cells):
+            # Region covers more cells than are occupied; walk the occupied ones
+            for (cx, cy), bucket in cells.items():
+                if cx0 <= cx <= cx1 and cy0 <= cy <= cy1:
+                    found.update(bucket)
+            return found
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                bucket = cells.get((cx, cy))
+                if bucket:
+                    found.update(bucket)
+        return found
+
+    def coarse_blocks(self, left, top, right, bottom):
+        """ World-space (x, y, size, count) of occupied coarse blocks in a region. """
+        size = self.cell_size << self.coarse_shift
+        bx0, by0 = math.floor(left / size), math.floor(top / size)
+        bx1, by1 = math.floor(right / size), math.floor(bottom / size)
+        return [(bx * size, by * size, size, count) for (bx, by), count in self.coarse.items()
+                if bx0 <= bx <= bx1 and by0 <= by <= by1]
+
+    def count_rect(self, left, top, right, bottom):
+        """ Rough number of shapes in a region: the coarse counts of the blocks it touches, plus large shapes. """
+        return len(self.large) + sum(block[3] for block in self.coarse_blocks(left, top, right, bottom))
+
+    def distance(self, sid, x, y):
+        """ Exact distance from a point to the drawn stroke of a shape. """
+        coords = self.document.get_coords(sid)
+        if self.document.type(sid) == "line":
+            return point_segment_distance(x, y, *coords)
+        return point_rect_edge_distance(x, y, *coords)
+
+    def nearest(self, x, y, halo=10):
+        """ Id of the shape closest to (x, y) within ``halo``, or None.
+
+        Ties go to the most recently created shape, which is the one drawn on top.
+        """
+        best, best_distance = None, None
+        for sid in self.candidates(x - halo, y - halo, x + halo, y + halo):
+            distance = self.distance(sid, x, y)
+            if distance > halo:
+                continue
+            if best is None or distance < best_distance or (distance == best_distance and sid > best):
+                best, best_distance = sid, distance
+        return best
+
+    def within(self, sid, distance):
+        """ (id, distance) of other shapes whose strokes come within ``distance`` of a shape, nearest first. """
+        bbox = self.document.bbox
+        left, top, right, bottom = bbox(sid)
+        found = []
+        for other in self.candidates(left - distance, top - distance, right + distance, bottom + distance):
+            if other == sid:
+                continue
+            x1, y1, x2, y2 = bbox(other)
+            if math.hypot(max(x1 - right, left - x2, 0), max(y1 - bottom, top - y2, 0)) > distance:
+                continue  # Even the bounding boxes are too far apart
+            gap = shape_distance(self.document, sid, other)
+            if gap <= distance:
+                found.append((other, gap))
+        found.sort(key=lambda hit: (hit[1], hit[0]))
+        return found
+
+    def nearest_vertex(self, x, y, halo=10, exclude=None):
+        """ The shape end point or corner closest to (x, y) within ``halo``, or None.
+
+        Cells are searched in rings outward from the point, stopping once a ring
+        lies farther away than the best vertex so far, so a large halo costs
+        little when there is a vertex close by.
+        """
+        best, best_distance = None, halo
+        vertices = self.document.vertices
+        size = self.cell_size
+        cx, cy = math.floor(x / size), math.floor(y / size)
+        x0, y0, x1, y1 = self._cell_range(x - halo, y - halo, x + halo, y + halo)
+        cells = self.cells
+        seen = {exclude}
+        pool = set(self.unfiled)
+        for ring in range(max(cx - x0, x1 - cx, cy - y0, y1 - cy) + 1):
+            if ring:
+                # Distance from the point to the nearest cell of this ring
+                gap = min(x - (cx - ring + 1) * size, (cx + ring) * size - x,
+                          y - (cy - ring + 1) * size, (cy + ring) * size - y)
+                if gap > best_distance:
+                    break
+                keys = set()
+                for i in range(-ring, ring + 1):
+                    keys.update(((cx + i, cy - ring), (cx + i, cy + ring), (cx - ring, cy + i), (cx + ring, cy + i)))
+            else:
+                keys = ((cx, cy),)
+            for key in keys:
+                if x0 <= key[0] <= x1 and y0 <= key[1] <= y1:
+                    pool.update(cells.get(key, ()))
+            for sid in pool - seen:
+                for point in vertices(sid):
+                    distance = math.hypot(point[0] - x, point[1] - y)
+                    if distance <= best_distance:
+                        best, best_distance = point, distance
+            seen |= pool
+            pool = set()
+        return best
+
+    def query_rect(self, x1, y1, x2, y2, contained=False, large_only=False):
+        """ Ids of shapes drawn in the region whose bounding box overlaps it.
+
+        A rectangle that merely encloses the region, with all four edges outside
+        it, is not drawn there and is not returned.
+        With ``contained=True`` only shapes lying entirely inside it are returned;
+        ``large_only=True`` skips the grid and only considers oversized shapes.
+        """
+        left, right = min(x1, x2), max(x1, x2)
+        top, bottom = min(y1, y2), max(y1, y2)
+        bbox = self.document.bbox
+        hits = []
+        pool = self.large if large_only else self.candidates(left, top, right, bottom)
+        for sid in pool:
+            sx1, sy1, sx2, sy2 = bbox(sid)
+            if contained:
+                if left <= sx1 and sx2 <= right and top <= sy1 and sy2 <= bottom:
+                    hits.append(sid)
+            elif sx1 <= right and sx2 >= left and sy1 <= bottom and sy2 >= top:
+                hits.append(sid)
+        return hits
+
+    def in_rect(self, sid, x1, y1, x2, y2, large_only=False):
+        """ Whether query_rect() with the same arguments would return the shape. """
+        left, right = min(x1, x2), max(x1, x2)
+        top, bottom = min(y1, y2), max(y1, y2)
+        sx1, sy1, sx2, sy2 = self.document.bbox(sid)
+        if sx1 > right or sx2 < left or sy1 > bottom or sy2 < top:
+            return False
+        if large_only:
+            return sid in self.large
+        keys = self._keys[sid][0]
+        if keys is None:
+            return True  # Unfiled shapes are candidates everywhere
+        cx0, cy0, cx1, cy1 = self._cell_range(left, top, right, bottom)
+        return any(cx0 <= cx <= cx1 and cy0 <= cy <= cy1 for cx, cy in keys)
+
+
+class AttributeIndex:
+    """ Shape ids bucketed by (type, colour) for select-by-attribute queries.
+
+    Buckets are only built on the first query, so opening a drawing costs
+    nothing extra; until then insert() and remove() are no-ops.  The key each
+    shape was filed under is remembered, so a shape can be removed after its
+    colour has already changed in the document.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self.buckets = None  # (type index, colour index) -> set of shape ids
+        self._keys = {}
+
+    def build(self):
+        self.buckets = {}
+        self._keys = {}
+        for sid in self.document:
+            self.insert(sid)
+
+    def insert(self, sid):
+        if self.buckets is None:
+            return
+        key = (self.document.kinds[sid], self.document.colors[sid])
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = {sid}
+        else:
+            bucket.add(sid)
+        self._keys[sid] = key
+
+    def remove(self, sid):
+        if self.buckets is None or sid not in self._keys:
+            return
+        key = self._keys.pop(sid)
+        bucket = self.buckets[key]
+        bucket.discard(sid)
+        if not bucket:
+            del self.buckets[key]
+
+    def update(self, sid):
+        """ Re-file a shape after its colour changed. """
+        self.remove(sid)
+        self.insert(sid)
+
+    def query(self, shape_type=None, color=None):
+        """ Ids of live shapes of the given type and/or colour (None matches any). """
+        if self.buckets is None:
+            self.build()
+        kind = None if shape_type is None else SHAPE_TYPES.index(shape_type)
+        palette = self.document.palette
+        found = []
+        for (shape_kind, color_index), bucket in self.buckets.items():
+            if (kind is None or shape_kind == kind) and (color is None or palette[color_index] == color):
+                found.extend(bucket)
+        return found
+
+
+class Viewport:
+    """ Maps document (world) coordinates to canvas pixels for zoom and pan. """
+
+    def __init__(self, width=800, height=600, zoom=1.0, min_zoom=1e-4, max_zoom=1e3):
+        self.width = width
+        self.height = height
+        self.zoom = zoom
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.x = 0.0  # world coordinates of the top-left pixel
+        self.y = 0.0
+
+    def to_screen(self, x, y):
+        return (x - self.x) * self.zoom, (y - self.y) * self.zoom
+
+    def to_world(self, sx, sy):
+        return self.x + sx / self.zoom, self.y + sy / self.zoom
+
+    def screen_coords(self, x1, y1, x2, y2):
+        zoom, ox, oy = self.zoom, self.x, self.y
+        return (x1 - ox) * zoom, (y1 - oy) * zoom, (x2 - ox) * zoom, (y2 - oy) * zoom
+
+    def world_rect(self, margin=0):
+        """ Visible world region, grown by ``margin`` pixels on every side. """
+        x1, y1 = self.to_world(-margin, -margin)
+        x2, y2 = self.to_world(self.width + margin, self.height + margin)
+        return x1, y1, x2, y2
+
+    def screen_affine(self, matrix):
+        """ ``(sx, sy, tx, ty)`` doing to pixels what an axis-aligned world matrix does to points. """
+        a, _, c, _, e, f = matrix
+        return a, e, (a * self.x + c - self.x) * self.zoom, (e * self.y + f - self.y) * self.zoom
+
+    def pan(self, dx, dy):
+        """ Scroll the view so the drawing follows a pointer move of (dx, dy) pixels. """
+        self.x -= dx / self.zoom
+        self.y -= dy / self.zoom
+
+    def zoom_at(self, factor, sx, sy):
+        """ Zoom by ``factor`` keeping the world point under pixel (sx, sy) in place. """
+        x, y = self.to_world(sx, sy)
+        self.zoom = min(max(self.zoom * factor, self.min_zoom), self.max_zoom)
+        self.x = x - sx / self.zoom
+        self.y = y - sy / self.zoom
+
+
+def rect_difference(outer, inner):
+    """ Up to four (left, top, right, bottom) rectangles covering ``outer`` but not ``inner``. """
+    left, top, right, bottom = outer
+    inner_left, inner_top, inner_right, inner_bottom = inner
+    if inner_left > right or inner_right < left or inner_top > bottom or inner_bottom < top:
+        return [outer]
+    pieces = []
+    if inner_top > top:
+        pieces.append((left, top, right, inner_top))
+    if inner_bottom < bottom:
+        pieces.append((left, inner_bottom, right, bottom))
+    middle_top, middle_bottom = max(top, inner_top), min(bottom, inner_bottom)
+    if inner_left > left:
+        pieces.append((left, middle_top, inner_left, middle_bottom))
+    if inner_right < right:
+        pieces.append((inner_right, middle_top, right, middle_bottom))
+    return pieces
+
+
+def parse_shape_line(line):
+    """ Parse one record of the text format into add() arguments.
+
+    Records look like ``<type> x1 y1 x2 y2 <color code> [corner]``.  ``rect`` is
+    accepted as an alias of ``rectangle`` for files written by older versions.
+    Raises ValueError for malformed records.
+    """
+    parts = line.split()
+    if len(parts) < 6:
+        raise ValueError("insufficient data")
+    shape_type = "rectangle" if parts[0] == "rect" else parts[0]
+    if shape_type not in SHAPE_TYPES:
+        raise ValueError(f"unrecognized shape type: {parts[0]}")
+    x1, y1, x2, y2 = map(int, parts[1:5])
+    color = COLOR_CODES.get(parts[5], "black")
+    corner_style = "square"
+    if shape_type == "rectangle" and len(parts) > 6 and parts[6] in CORNER_STYLES:
+        corner_style = parts[6]
+    return shape_type, x1, y1, x2, y2, color, corner_style
+
+
+def format_shape_line(shape_type, x1, y1, x2, y2, color="black", corner_style="square"):
+    """ Format add() arguments as one record of the text format. """
+    code = CODE_FOR_COLOR.get(color, "k")
+    line = f"{shape_type} {int(x1)} {int(y1)} {int(x2)} {int(y2)} {code}"
+    if shape_type == "rectangle":
+        line += f" {corner_style}"
+    return line + "\n"
+
+
+def iter_text_shapes(file, errors=None):
+    """ Lazily parse text-format records from an open file.
+
+    Malformed lines are appended to ``errors`` as ``(line number, message)`` and
+    skipped.  Without an ``errors`` list the first one raises ValueError.
+    """
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            yield parse_shape_line(line)
+        except ValueError as e:
+            if errors is None:
+                raise ValueError(f"line {line_number}: {e}") from None
+            errors.append((line_number, str(e)))
+
+
+def read_text(file, document=None, errors=None):
+    """ Load text-format records from an open file into a Document. """
+    document = Document() if document is None else document
+    add = document.add
+    for shape in iter_text_shapes(file, errors):
+        add(*shape)
+    return document
+
+
+def write_text(document, file):
+    write_text_shapes(document.records(), file)
+
+
+def write_text_shapes(shapes, file):
+    """ Write add() argument tuples from any iterable in the text format. """
+    file.writelines(format_shape_line(*shape) for shape in shapes)
+
+
+XML_SUFFIX = ".xml"
+
+
+def write_xml(document, file, chunk_size=4096):
+    """ Stream a document to an open text file in the ``<Drawing>`` XML schema. """
+    write_xml_shapes(document.records(), file, chunk_size)
+
+
+def write_xml_shapes(shapes, file, chunk_size=4096):
+    """ Write add() argument tuples from any iterable as a ``<Drawing>`` document.
+
+    Elements are formatted as they arrive and written in chunks, so memory use
+    does not grow with the drawing.  Every value is a number or a fixed
+    keyword, so no escaping is needed.
+    """
+    file.write("<Drawing>\n")
+    chunk = []
+    for shape_type, x1, y1, x2, y2, color, corner_style in shapes:
+        color = CODE_FOR_COLOR.get(color, "k")
+        if shape_type == 'line':
+            chunk.append(f"<line><begin><x>{x1}</x><y>{y1}</y></begin><end><x>{x2}</x><y>{y2}</y></end>"
+                         f"<color>{color}</color></line>\n")
+        else:
+            chunk.append(f"<rectangle><upper-left><x>{x1}</x><y>{y1}</y></upper-left>"
+                         f"<lower-right><x>{x2}</x><y>{y2}</y></lower-right><color>{color}</color>"
+                         f"<corner>{corner_style}</corner></rectangle>\n")
+        if len(chunk) >= chunk_size:
+            file.write("".join(chunk))
+            chunk.clear()
+    file.write("".join(chunk))
+    file.write("</Drawing>\n")
+
+
+def _xml_point(element, name):
+    point = element.find(name)
+    if point is None:
+        raise ValueError(f"missing <{name}>")
+    return float(point.findtext("x")), float(point.findtext("y"))
+
+
+def parse_shape_element(element):
+    """ Turn a ``<line>`` or ``<rectangle>`` element into add() arguments. """
+    color = COLOR_CODES.get((element.findtext("color") or "k").strip(), "black")
+    if element.tag == "line":
+        (x1, y1), (x2, y2) = _xml_point(element, "begin"), _xml_point(element, "end")
+        return "line", x1, y1, x2, y2, color, "square"
+    (x1, y1), (x2, y2) = _xml_point(element, "upper-left"), _xml_point(element, "lower-right")
+    corner_style = (element.findtext("corner") or "square").strip()
+    if corner_style not in CORNER_STYLES:
+        corner_style = "square"
+    return "rectangle", x1, y1, x2, y2, color, corner_style
+
+
+def iter_xml_shapes(file, errors=None):
+    """ Lazily parse shapes from an XML drawing with ``iterparse``.
+
+    Each shape element is released as soon as it has been read, so memory stays
+    flat however large the file is.  Malformed shapes are reported to ``errors``
+    as ``(shape number, message)`` like iter_text_shapes does for lines.
+    """
+    import xml.etree.ElementTree as ET
+    context = ET.iterparse(file, events=("start", "end"))
+    _, root = next(context)
+    number = 0
+    for event, element in context:
+        if event != "end" or element.tag not in SHAPE_TYPES:
+            continue
+        number += 1
+        try:
+            shape = parse_shape_element(element)
+        except (TypeError, ValueError) as e:
+            if errors is None:
+                raise ValueError(f"shape {number}: {e}") from None
+            errors.append((number, str(e) if isinstance(e, ValueError) else "missing coordinate"))
+        else:
+            yield shape
+        root.clear()
+
+
+def read_xml(file, document=None, errors=None):
+    """ Load an XML drawing from an open binary file into a Document. """
+    document = Document() if document is None else document
+    add = document.add
+    for shape in iter_xml_shapes(file, errors):
+        add(*shape)
+    return document
+
+
+BINARY_MAGIC = b"DRWB"
+BINARY_VERSION = 1
+BINARY_SUFFIX = ".drw"
+# magic, version, reserved, shape count, group count, palette byte length
+BINARY_HEADER = struct.Struct("<4sHHIII")
+BINARY_GROUP = struct.Struct("<ii")  # group id, parent group id
+
+
+def _align(offset, size=8):
+    return (offset + size - 1) // size * size
+
+
+def _columns(document):
+    return [document.coords, document.kinds, document.colors, document.corners, document.group_ids]
+
+
+def _live_columns(document):
+    """ Columns of a document without tombstoned rows, in little-endian order. """
+    columns = _columns(document)
+    if len(document) != len(document.alive):
+        live = list(document)
+        coords = document.coords
+        compacted = [array('d', (v for sid in live for v in coords[sid * 4:sid * 4 + 4]))]
+        compacted += [array(column.typecode, (column[sid] for sid in live)) for column in columns[1:]]
+        columns = compacted
+    if sys.byteorder == "big":
+        columns = [array(column.typecode, column) for column in columns]
+        for column in columns:
+            column.byteswap()
+    return columns
+
+
+def write_binary(document, file):
+    """ Write a document in the versioned binary format.
+
+    Layout: header, newline-separated palette, then one fixed-width column per
+    attribute (coordinates as 4 doubles, type and corner as bytes, colour index
+    as uint16, group id as int32), each 8-byte aligned, then the group table.
+    Storing columns rather than interleaved records lets a reader turn each one
+    into an array with a single copy.
+    """
+    palette = "\n".join(document.palette).encode("utf-8")
+    groups = document.groups.parents
+    file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, len(document), len(groups), len(palette)))
+    file.write(palette)
+    offset = BINARY_HEADER.size + len(palette)
+    for column in _live_columns(document):
+        padding = _align(offset) - offset
+        file.write(b"\0" * padding)
+        data = column.tobytes()
+        file.write(data)
+        offset += padding + len(data)
+    for group_id, parent in groups.items():
+        file.write(BINARY_GROUP.pack(group_id, parent))
+
+
+def read_binary(filename):
+    """ Load a binary drawing through a read-only memory map. """
+    with open(filename, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            return _read_binary_view(view)
+        finally:
+            view.release()
+
+
+def _read_binary_view(view):
+    if len(view) < BINARY_HEADER.size:
+        raise ValueError("not a binary drawing: file too short")
+    magic, version, _, count, group_count, palette_len = BINARY_HEADER.unpack_from(view)
+    if magic != BINARY_MAGIC:
+        raise ValueError("not a binary drawing: bad magic")
+    if version > BINARY_VERSION:
+        raise ValueError(f"unsupported binary drawing version {version}")
+    document = Document()
+    offset = BINARY_HEADER.size
+    document.palette = bytes(view[offset:offset + palette_len]).decode("utf-8").split("\n")
+    document._palette_index = {color: i for i, color in enumerate(document.palette)}
+    offset += palette_len
+    for column, length in zip(_columns(document), (count * 4, count, count, count, count)):
+        offset = _align(offset)
+        end = offset + length * column.itemsize
+        if end > len(view):
+            raise ValueError("truncated binary drawing")
+        column.frombytes(view[offset:end])
+        if sys.byteorder == "big":
+            column.byteswap()
+        offset = end
+    document.alive = bytearray(b"\1") * count
+    document._count = count
+    end = offset + group_count * BINARY_GROUP.size
+    if end > len(view):
+        raise ValueError("truncated binary drawing")
+    parents = dict(BINARY_GROUP.iter_unpack(view[offset:end]))
+    _check_binary_tables(document, parents)
+    document.groups.rebuild(parents)
+    return document
+
+
+def _check_binary_tables(document, parents):
+    """ Raise ValueError unless every index in the columns and the group table points at something. """
+    for column, limit, what in ((document.kinds, len(SHAPE_TYPES), "shape type"),
+                                (document.corners, len(CORNER_STYLES), "corner style")):
+        if column.tobytes().translate(None, bytes(range(limit))):  # Deletes the valid bytes in C
+            raise ValueError(f"corrupt binary drawing: {what} out of range")
+    if document.colors and max(document.colors) >= len(document.palette):
+        raise ValueError("corrupt binary drawing: colour out of range")
+    if not set(document.group_ids) <= parents.keys() | {-1}:
+        raise ValueError("corrupt binary drawing: shape in an unknown group")
+    checked = {-1}
+    for group_id in parents:
+        path = set()
+        while group_id not in checked:
+            if group_id in path or group_id not in parents:
+                raise ValueError("corrupt binary drawing: bad group parent")
+            path.add(group_id)
+            group_id = parents[group_id]
+        checked |= path
+
+
+def text_to_binary(text_filename, binary_filename):
+    """ Convert a text drawing to the binary format. """
+    with open(text_filename, "r") as file:
+        document = read_text(file)
+    with open(binary_filename, "wb") as file:
+        write_binary(document, file)
+    return document
+
+
+def binary_to_text(binary_filename, text_filename):
+    """ Convert a binary drawing back to the text format. """
+    document = read_binary(binary_filename)
+    with open(text_filename, "w") as file:
+        write_text(document, file)
+    return document
+
+
+JOURNAL_MAGIC = b"DRWJ"
+JOURNAL_SUFFIX = ".drj"
+AUTOSAVE_PATH = os.path.join(os.path.expanduser("~"), ".drawing_editor_autosave" + JOURNAL_SUFFIX)
+# magic, payload length, CRC-32 of the payload
+JOURNAL_FRAME = struct.Struct("<4sII")
+# snapshot flag, shape count, group count (-1: unchanged), palette byte length (0: unchanged)
+JOURNAL_BATCH = struct.Struct("<Bxxxiii")
+
+
+def encode_journal_batch(document, sids=None, palette=True, groups=True):
+    """ Encode shape rows as one journal record.
+
+    With ``sids`` None the record is a snapshot of every row, dead ones included,
+    so shape ids stay valid for the records that follow.  Otherwise only the
+    given rows are stored, each with its id.  Columns are kept in native byte
+    order: a journal never leaves the machine that wrote it.
+    """
+    palette_bytes = "\n".join(document.palette).encode("utf-8") if palette else b""
+    group_table = document.groups.parents if groups else None
+    parts = [None, palette_bytes]
+    if group_table is not None:
+        parts.append(b"".join(BINARY_GROUP.pack(g, parent) for g, parent in group_table.items()))
+    if sids is None:
+        count = len(document.alive)
+        parts += [column.tobytes() for column in _columns(document)]
+        parts.append(bytes(document.alive))
+    else:
+        count = len(sids)
+        coords = array('d')
+        for sid in sids:
+            coords.extend(document.coords[sid * 4:sid * 4 + 4])
+        parts.append(array('i', sids).tobytes())
+        parts.append(coords.tobytes())
+        for column in _columns(document)[1:]:
+            parts.append(array(column.typecode, (column[sid] for sid in sids)).tobytes())
+        parts.append(bytes(document.alive[sid] for sid in sids))
+    group_count = -1 if group_table is None else len(group_table)
+    parts[0] = JOURNAL_BATCH.pack(sids is None, count, group_count, len(palette_bytes))
+    return b"".join(parts)
+
+
+def apply_journal_batch(document, payload):
+    """ Apply one journal record; returns ``(document, group parents or None)``.
+
+    A snapshot starts a new document.  Group membership is not rebuilt here
+    because it is cheaper to do once after the last record (see read_journal).
+    """
+    snapshot, count, group_count, palette_len = JOURNAL_BATCH.unpack_from(payload)
+    offset = JOURNAL_BATCH.size
+    if snapshot:
+        document = Document()
+    elif document is None:
+        return None, None
+    if palette_len:
+        document.palette = bytes(payload[offset:offset + palette_len]).decode("utf-8").split("\n")
+        document._palette_index = {color: i for i, color in enumerate(document.palette)}
+        offset += palette_len
+    parents = None
+    if group_count >= 0:
+        end = offset + group_count * BINARY_GROUP.size
+        parents = dict(BINARY_GROUP.iter_unpack(payload[offset:end]))
+        offset = end
+
+    def take(column, length):
+        nonlocal offset
+        end = offset + length * column.itemsize
+        if end > len(payload):
+            raise ValueError("truncated journal record")
+        column.frombytes(payload[offset:end])
+        offset = end
+        return column
+
+    sids = None if snapshot else take(array('i'), count)
+    columns = [take(array(column.typecode), count * (4 if i == 0 else 1))
+               for i, column in enumerate(_columns(document))]
+    alive = bytearray(payload[offset:offset + count])
+    if snapshot:
+        document.coords, document.kinds, document.colors, document.corners, document.group_ids = columns
+        document.alive = alive
+    elif count:
+        missing = max(sids) + 1 - len(document.alive)
+        if missing > 0:
+            document.coords.extend(array('d', bytes(32 * missing)))
+            for column in _columns(document)[1:]:
+                column.extend(array(column.typecode, bytes(column.itemsize * missing)))
+            document.alive.extend(bytes(missing))
+        coords, kinds, colors, corners, group_ids = columns
+        for i, sid in enumerate(sids):
+            document.coords[sid * 4:sid * 4 + 4] = coords[i * 4:i * 4 + 4]
+            document.kinds[sid] = kinds[i]
+            document.colors[sid] = colors[i]
+            document.corners[sid] = corners[i]
+            document.group_ids[sid] = group_ids[i]
+            document.alive[sid] = alive[i]
+    document._count = document.alive.count(1)
+    return document, parents
+
+
+def write_journal_frame(payload, file):
+    import zlib
+    file.write(JOURNAL_FRAME.pack(JOURNAL_MAGIC, len(payload), zlib.crc32(payload)))
+    file.write(payload)
+
+
+def read_journal(filename):
+    """ Rebuild the drawing recorded in a journal, or None if it holds no snapshot.
+
+    Replay stops at the first incomplete or corrupt frame, which is where a
+    crash interrupted the last append.
+    """
+    import zlib
+    with open(filename, "rb") as file:
+        data = memoryview(file.read())
+    document = parents = None
+    offset = 0
+    while offset + JOURNAL_FRAME.size <= len(data):
+        magic, length, crc = JOURNAL_FRAME.unpack_from(data, offset)
+        start = offset + JOURNAL_FRAME.size
+        payload = data[start:start + length]
+        if magic != JOURNAL_MAGIC or len(payload) != length or zlib.crc32(payload) != crc:
+            break
+        document, batch_parents = apply_journal_batch(document, payload)
+        if batch_parents is not None:
+            parents = batch_parents
+        offset = start + length
+    if document is not None:
+        document.groups.rebuild(parents or {})
+    return document
+
+
+def write_atomic(filename, write, content, binary=True):
+    """ Call ``write(content, file)`` on a temporary file, then rename it over ``filename``.
+
+    Readers, and a crash half way through, only ever see the old or the new file.
+    """
+    temp = filename + ".tmp"
+    with open(temp, "wb" if binary else "w") as file:
+        write(content, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, filename)
+
+
+RASTER_SUFFIXES = (".png", ".ppm")
+# Tk's named colours for the palette the editor can produce; "#rrggbb" comes from the colour chooser
+RASTER_COLORS = {"black": (0, 0, 0), "white": (255, 255, 255), "red": (255, 0, 0),
+                 "green": (0, 128, 0), "blue": (0, 0, 255)}
+RASTER_BACKGROUND = (255, 255, 255)
+ROUND_CORNER_RADIUS = 6  # pixels, clamped to half the rectangle's smaller side
+
+
+def color_to_rgb(color):
+    """ Map a palette colour name or ``#rrggbb`` string to an RGB triple (black if unknown). """
+    if color.startswith("#") and len(color) == 7:
+        try:
+            return tuple(bytes.fromhex(color[1:]))
+        except ValueError:
+            pass
+    return RASTER_COLORS.get(color.lower(), (0, 0, 0))
+
+
+class RasterTile:
+    """ Draw shapes into one rectangular region of an RGB pixel buffer.
+
+    ``buffer`` is the whole image (``stride`` bytes per row); only pixels inside
+    ``left <= x < right`` and ``top <= y < bottom`` are written, so tiles that
+    share a buffer can be rendered concurrently. Pixel positions are computed
+    from the shape alone, never from the tile, so edges line up across seams.
+    """
+
+    def __init__(self, buffer, stride, left, top, right, bottom):
+        self.buffer = buffer
+        self.stride = stride
+        self.left, self.top, self.right, self.bottom = left, top, right, bottom
+
+    def plot(self, x, y, rgb):
+        if self.left <= x < self.right and self.top <= y < self.bottom:
+            i = y * self.stride + x * 3
+            self.buffer[i:i + 3] = rgb
+
+    def hline(self, x1, x2, y, rgb):
+        if not self.top <= y < self.bottom:
+            return
+        x1, x2 = max(x1, self.left), min(x2, self.right - 1)
+        if x1 <= x2:
+            i = y * self.stride + x1 * 3
+            self.buffer[i:i + (x2 - x1 + 1) * 3] = rgb * (x2 - x1 + 1)
+
+    def vline(self, x, y1, y2, rgb):
+        if not self.left <= x < self.right:
+            return
+        y1, y2 = max(y1, self.top), min(y2, self.bottom - 1)
+        if y1 <= y2:
+            # One strided slice per channel instead of a loop over pixels
+            stride = self.stride
+            start = y1 * stride + x * 3
+            end = y2 * stride + x * 3 + 1
+            for channel in range(3):
+                self.buffer[start + channel:end + channel:stride] = rgb[channel:channel + 1] * (y2 - y1 + 1)
+
+    def line(self, x1, y1, x2, y2, rgb):
+        """ One-pixel line stepping along the major axis, clipped to the tile. """
+        dx, dy = x2 - x1, y2 - y1
+        if abs(dx) >= abs(dy):
+            if dx < 0:
+                x1, y1, x2, y2, dx, dy = x2, y2, x1, y1, -dx, -dy
+            slope = dy / dx if dx else 0.0
+            start = max(math.ceil(x1 - 0.5), self.left)
+            end = min(math.floor(x2 + 0.5), self.right - 1)
+            buffer, stride, top, bottom = self.buffer, self.stride, self.top, self.bottom
+            for x in range(start, end + 1):
+                y = math.floor(y1 + (x - x1) * slope + 0.5)
+                if top <= y < bottom:
+                    i = y * stride + x * 3
+                    buffer[i:i + 3] = rgb
+        else:
+            if dy < 0:
+                x1, y1, x2, y2, dx, dy = x2, y2, x1, y1, -dx, -dy
+            slope = dx / dy
+            start = max(math.ceil(y1 - 0.5), self.top)
+            end = min(math.floor(y2 + 0.5), self.bottom - 1)
+            buffer, stride, left, right = self.buffer, self.stride, self.left, self.right
+            for y in range(start, end + 1):
+                x = math.floor(x1 + (y - y1) * slope + 0.5)
+                if left <= x < right:
+                    i = y * stride + x * 3
+                    buffer[i:i + 3] = rgb
+
+    def rectangle(self, x1, y1, x2, y2, rgb, corner_style="square"):
+        left, right = sorted((math.floor(x1 + 0.5), math.floor(x2 + 0.5)))
+        top, bottom = sorted((math.floor(y1 + 0.5), math.floor(y2 + 0.5)))
+        radius = 0
+        if corner_style == "round":
+            radius = min(ROUND_CORNER_RADIUS, (right - left) // 2, (bottom - top) // 2)
+        self.hline(left + radius, right - radius, top, rgb)
+        self.hline(left + radius, right - radius, bottom, rgb)
+        self.vline(left, top + radius, bottom - radius, rgb)
+        self.vline(right, top + radius, bottom - radius, rgb)
+        if radius > 0:
+            self.corners(left + radius, top + radius, right - radius, bottom - radius, radius, rgb)
+
+    def corners(self, left, top, right, bottom, radius, rgb):
+        """ Quarter circles of ``radius`` around the four inner corner centres. """
+        for a in range(radius + 1):
+            b = math.floor(math.sqrt(radius * radius - a * a) + 0.5)
+            for dx, dy in ((a, b), (b, a)):
+                self.plot(right + dx, bottom + dy, rgb)
+                self.plot(left - dx, bottom + dy, rgb)
+                self.plot(right + dx, top - dy, rgb)
+                self.plot(left - dx, top - dy, rgb)
+
+
+_raster_state = {}
+
+
+def _init_raster_worker(shm_name, shapes):
+    from multiprocessing import shared_memory
+    _raster_state["memory"] = shared_memory.SharedMemory(name=shm_name)
+    _raster_state["shapes"] = shapes
+
+
+def _render_tile_task(stride, bounds, sids):
+    """ Worker side of render_raster: draw one tile straight into shared memory. """
+    memory = _raster_state["memory"]
+    render_tile(memory.buf, stride, bounds, _raster_state["shapes"], sids)
+    return len(sids)
+
+
+def render_tile(buffer, stride, bounds, shapes, sids):
+    """ Draw shapes ``sids`` from a raster_shapes() tuple into one tile of ``buffer``. """
+    kinds, coords, colors, corners, palette = shapes
+    tile = RasterTile(buffer, stride, *bounds)
+    for sid in sids:
+        x1, y1, x2, y2 = coords[sid * 4:sid * 4 + 4]
+        rgb = palette[colors[sid]]
+        if kinds[sid] == 0:
+            tile.line(x1, y1, x2, y2, rgb)
+        else:
+            tile.rectangle(x1, y1, x2, y2, rgb, CORNER_STYLES[corners[sid]])
+
+
+def raster_shapes(document, origin_x, origin_y, scale):
+    """ Live shapes of a document transformed to pixel space, as plain picklable columns. """
+    live = list(document)
+    coords = array('d')
+    for sid in live:
+        x1, y1, x2, y2 = document.coords[sid * 4:sid * 4 + 4]
+        coords.extend(((x1 - origin_x) * scale, (y1 - origin_y) * scale,
+                       (x2 - origin_x) * scale, (y2 - origin_y) * scale))
+    kinds = array('b', (document.kinds[sid] for sid in live))
+    colors = array('H', (document.colors[sid] for sid in live))
+    corners = array('b', (document.corners[sid] for sid in live))
+    palette = [bytes(color_to_rgb(color)) for color in document.palette]
+    return kinds, coords, colors, corners, palette
+
+
+def raster_extent(document, margin=10):
+    """ World bounding box of the live shapes plus ``margin``, or None if empty. """
+    left = top = math.inf
+    right = bottom = -math.inf
+    for sid in document:
+        x1, y1, x2, y2 = document.bbox(sid)
+        left, top = min(left, x1), min(top, y1)
+        right, bottom = max(right, x2), max(bottom, y2)
+    if right < left:
+        return None
+    return left - margin, top - margin, right + margin, bottom + margin
+
+
+def bin_tiles(shapes, width, height, tile_size):
+    """ Assign each shape to the tiles its pixel bounding box overlaps. """
+    kinds, coords, _, _, _ = shapes
+    columns = (width + tile_size - 1) // tile_size
+    rows = (height + tile_size - 1) // tile_size
+    tiles = {}
+    for sid in range(len(kinds)):
+        x1, y1, x2, y2 = coords[sid * 4:sid * 4 + 4]
+        # One pixel of slack covers rounding at the ends
+        col1 = max(int(min(x1, x2) - 1) // tile_size, 0)
+        col2 = min(int(max(x1, x2) + 1) // tile_size, columns - 1)
+        row1 = max(int(min(y1, y2) - 1) // tile_size, 0)
+        row2 = min(int(max(y1, y2) + 1) // tile_size, rows - 1)
+        for row in range(row1, row2 + 1):
+            for col in range(col1, col2 + 1):
+                tiles.setdefault((col, row), []).append(sid)
+    return [((col * tile_size, row * tile_size, min((col + 1) * tile_size, width),
+              min((row + 1) * tile_size, height)), sids)
+            for (col, row), sids in sorted(tiles.items(), key=lambda item: (item[0][1], item[0][0]))]
+
+
+def render_raster(document, width=None, height=None, scale=1.0, extent=None, tile_size=256,
+                  jobs=None, background=RASTER_BACKGROUND):
+    """ Rasterize a document to ``(width, height, rgb_bytes)``.
+
+    ``extent`` is the world rectangle to draw (default: the drawing's bounding
+    box). Giving ``width`` and/or ``height`` fits that rectangle into the image
+    keeping its aspect ratio, which is how thumbnails are made; otherwise
+    ``scale`` pixels per world unit decide the size. With ``jobs`` > 1 the
+    image is cut into ``tile_size`` tiles rendered by a process pool directly
+    into a shared-memory buffer, so no pixel data is pickled back.
+    """
+    extent = extent or raster_extent(document) or (0, 0, 1, 1)
+    left, top, right, bottom = extent
+    span_x, span_y = max(right - left, 1e-9), max(bottom - top, 1e-9)
+    if width or height:
+        scale = min(width / span_x if width else math.inf, height / span_y if height else math.inf)
+    width = width or max(1, math.ceil(span_x * scale))
+    height = height or max(1, math.ceil(span_y * scale))
+    stride = width * 3
+    shapes = raster_shapes(document, left, top, scale)
+    tiles = bin_tiles(shapes, width, height, tile_size)
+    jobs = os.cpu_count() if jobs is None else jobs
+    fill = bytes(background) * width * height
+
+    if jobs <= 1 or len(tiles) <= 1:
+        pixels = bytearray(fill)
+        for bounds, sids in tiles:
+            render_tile(pixels, stride, bounds, shapes, sids)
+        return width, height, pixels
+
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+    memory = shared_memory.SharedMemory(create=True, size=len(fill))
+    try:
+        memory.buf[:len(fill)] = fill
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tiles)), initializer=_init_raster_worker,
+                                 initargs=(memory.name, shapes)) as pool:
+            for future in [pool.submit(_render_tile_task, stride, bounds, sids) for bounds, sids in tiles]:
+                future.result()
+        return width, height, bytearray(memory.buf[:len(fill)])
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def write_ppm(file, width, height, pixels):
+    """ Write binary (P6) PPM. """
+    file.write(b"P6\n%d %d\n255\n" % (width, height))
+    file.write(pixels)
+
+
+def _png_chunk(kind, data):
+    import zlib
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def write_png(file, width, height, pixels, level=6):
+    """ Write an 8-bit RGB PNG, one unfiltered scanline at a time through zlib. """
+    import zlib
+    stride = width * 3
+    compressor = zlib.compressobj(level)
+    data = []
+    view = memoryview(pixels)
+    for y in range(height):
+        data.append(compressor.compress(b"\0"))
+        data.append(compressor.compress(view[y * stride:(y + 1) * stride]))
+    data.append(compressor.flush())
+    file.write(b"\x89PNG\r\n\x1a\n")
+    file.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+    file.write(_png_chunk(b"IDAT", b"".join(data)))
+    file.write(_png_chunk(b"IEND", b""))
+
+
+def write_image(document, filename, **options):
+    """ Render a document to ``filename``; ``.ppm`` writes PPM, anything else PNG.
+
+    ``options`` are passed to render_raster(). Returns ``(width, height)``.
+    """
+    width, height, pixels = render_raster(document, **options)
+    with open(filename, "wb") as file:
+        if filename.lower().endswith(".ppm"):
+            write_ppm(file, width, height, pixels)
+        else:
+            write_png(file, width, height, pixels)
+    return width, height
+
+
+DRAWING_FILETYPES = [("Text files", "*.txt"), ("Binary drawings", "*" + BINARY_SUFFIX)]
+
+
+def load_dialogs():
+    """ Define the Tk dialog classes on first use.
+
+    They subclass simpledialog.Dialog, so defining them at import time would
+    load Tk for every headless user of this module.
+    """
+    global EditDialog, PropertyDialog
+    if "EditDialog" in globals():
+        return
+    import tkinter as tk
+    from tkinter import simpledialog, colorchooser
+
+    class EditDialog(simpledialog.Dialog):
+        def __init__(self, parent, title, initial_color="black", is_line=True):
+            self.is_line = is_line
+            self.initial_color = initial_color
+            super().__init__(parent, title)
+
+        def body(self, master):
+            tk.Label(master, text="Choose color:").grid(row=0, column=0)
+            self.color_var = tk.StringVar(value=self.initial_color)
+            colors = ["black", "red", "green", "blue"]
+            self.color_menu = tk.OptionMenu(master, self.color_var, *colors)
+            self.color_menu.grid(row=0, column=1)
+
+            if not self.is_line:
+                tk.Label(master, text="Corner style:").grid(row=1, column=0)
+                self.corner_var = tk.StringVar(value="square")
+                tk.Radiobutton(master, text="Square", variable=self.corner_var, value="square").grid(row=1, column=1)
+                tk.Radiobutton(master, text="Rounded", variable=self.corner_var, value="round").grid(row=1, column=2)
+
+            return self.color_menu  # initial focus
+
+        def apply(self):
+            self.result = self.color_var.get(), self.corner_var.get() if not self.is_line else "square"
+
+    class PropertyDialog(simpledialog.Dialog):
+        def __init__(self, parent, title, initial_color="black", is_line=True):
+            self.is_line = is_line
+            self.color = initial_color
+            self.corner_style = tk.StringVar(value="square")
+            super().__init__(parent, title)
+
+        def body(self, master):
+            tk.Label(master, text="Color:").grid(row=0)
+            self.color_button = tk.Button(master, bg=self.color, command=self.choose_color)
+            self.color_button.grid(row=0, column=1)
+
+            if not self.is_line:
+                tk.Label(master, text="Corner Style:").grid(row=1)
+                tk.Radiobutton(master, text="Square", variable=self.corner_style, value="square").grid(row=1, column=1)
+                tk.Radiobutton(master, text="Rounded", variable=self.corner_style, value="round").grid(row=1, column=2)
+            return self.color_button
+
+        def choose_color(self):
+            color, _ = colorchooser.askcolor(initialcolor=self.color)
+            if color:
+                self.color = color
+                self.color_button.config(bg=color)
 
-        if not self.is_line:
-            tk.Label(master, text="Corner style:").grid(row=1, column=0)
-            self.corner_var = tk.StringVar(value="square")
-            tk.Radiobutton(master, text="Square", variable=self.corner_var, value="square").grid(row=1, column=1)
-            tk.Radiobutton(master, text="Rounded", variable=self.corner_var, value="round").grid(row=1, column=2)
+        def apply(self):
+            # This method will be called automatically to process the data
+            pass  # We handle the changes directly in the dialog callbacks
 
-        return self.color_menu  # initial focus
 
-    def apply(self):
-        self.result = self.color_var.get(), self.corner_var.get() if not self.is_line else "square"
+def __getattr__(name):
+    """ Build the dialog classes when another module asks for them. """
+    if name in ("EditDialog", "PropertyDialog"):
+        load_dialogs()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def edit_properties(parent, initial_color="black", is_line=True):
+    load_dialogs()
     dialog = EditDialog(parent, "Edit Properties", initial_color, is_line)
     return dialog.result if dialog.result else (initial_color, "square")
 
-class PropertyDialog(simpledialog.Dialog):
-    def __init__(self, parent, title, initial_color="black", is_line=True):
-        self.is_line = is_line
-        self.color = initial_color
-        self.corner_style = tk.StringVar(value="square")
-        super().__init__(parent, title)
-        
-    def body(self, master):
-        tk.Label(master, text="Color:").grid(row=0)
-        self.color_button = tk.Button(master, bg=self.color, command=self.choose_color)
-        self.color_button.grid(row=0, column=1)
-
-        if not self.is_line:
-            tk.Label(master, text="Corner Style:").grid(row=1)
-            tk.Radiobutton(master, text="Square", variable=self.corner_style, value="square").grid(row=1, column=1)
-            tk.Radiobutton(master, text="Rounded", variable=self.corner_style, value="round").grid(row=1, column=2)
-        return self.color_button
-
-    def choose_color(self):
-        color, _ = colorchooser.askcolor(initialcolor=self.color)
-        if color:
-            self.color = color
-            self.color_button.config(bg=color)
 
-    def apply(self):
-        # This method will be called automatically to process the data
-        pass  # We handle the changes directly in the dialog callbacks
+class Instrumentation:
+    """ Latency histograms and counters for event handlers, plus on-demand profiling.
+
+    wrap() times every call of a handler into logarithmic buckets, so the cost
+    per event is two clock reads and a few integer updates.  Calls slower than
+    ``slow_ms`` are also logged as warnings.  A cProfile run or a sampling
+    profiler (a thread that records the main thread's stack every
+    ``sample_interval`` seconds, cheap enough for large drawings) can be
+    started and stopped at any time.
+    """
+
+    BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, math.inf)
+
+    def __init__(self, slow_ms=100, sample_interval=0.005):
+        self.slow_ms = slow_ms
+        self.sample_interval = sample_interval
+        self.started = time.time()
+        self.handlers = {}  # name -> [count, total ms, max ms, bucket counts...]
+        self.counters = {}
+        self.profiler = None
+        self.samples = None
+        self._sampling = False
+
+    def wrap(self, name, handler):
+        """ Return ``handler`` wrapped so that each call is timed under ``name``. """
+        buckets = self.BUCKETS_MS
+        entry = self.handlers.setdefault(name, [0, 0.0, 0.0] + [0] * len(buckets))
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                elapsed = (clock() - start) * 1000
+                entry[0] += 1
+                entry[1] += elapsed
+                if elapsed > entry[2]:
+                    entry[2] = elapsed
+                i = 0
+                while elapsed > buckets[i]:
+                    i += 1
+                entry[3 + i] += 1
+                if elapsed > self.slow_ms:
+                    logger.warning("slow handler=%s ms=%.1f", name, elapsed)
+
+        timed.__name__ = getattr(handler, "__name__", name)
+        timed.__doc__ = handler.__doc__
+        return timed
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def percentile(self, name, fraction):
+        """ Upper bound of the bucket holding the given fraction of a handler's calls. """
+        entry = self.handlers[name]
+        wanted = fraction * entry[0]
+        seen = 0
+        for bound, count in zip(self.BUCKETS_MS, entry[3:]):
+            seen += count
+            if count and seen >= wanted:
+                return round(min(bound, entry[2]), 3)
+        return round(entry[2], 3)
+
+    def report(self):
+        """ Everything measured so far as a JSON-serialisable dict. """
+        handlers = {}
+        for name, entry in sorted(self.handlers.items()):
+            count, total, worst = entry[:3]
+            if not count:
+                continue
+            handlers[name] = {
+                "count": count, "total_ms": round(total, 3), "mean_ms": round(total / count, 3),
+                "p50_ms": self.percentile(name, 0.5), "p95_ms": self.percentile(name, 0.95),
+                "p99_ms": self.percentile(name, 0.99), "max_ms": round(worst, 3),
+                "histogram": {("inf" if bound == math.inf else str(bound)): n
+                              for bound, n in zip(self.BUCKETS_MS, entry[3:]) if n},
+            }
+        return {"uptime_s": round(time.time() - self.started, 3), "handlers": handlers,
+                "counters": dict(sorted(self.counters.items()))}
+
+    def format_report(self):
+        report = self.report()
+        lines = [f"{'handler':<24}{'count':>8}{'mean ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for name, h in report["handlers"].items():
+            lines.append(f"{name:<24}{h['count']:>8}{h['mean_ms']:>10.2f}{h['p95_ms']:>10.2f}"
+                         f"{h['p99_ms']:>10.2f}{h['max_ms']:>10.2f}")
+        lines += [f"{name}: {value}" for name, value in report["counters"].items()]
+        return "\n".join(lines)
+
+    def export(self, filename):
+        """ Write the report as JSON, or as a text table unless the name ends in .json. """
+        import json
+        with open(filename, "w") as file:
+            if filename.endswith(".json"):
+                json.dump(self.report(), file, indent=2)
+            else:
+                file.write(self.format_report() + "\n")
+
+    @property
+    def profiling(self):
+        return self.profiler is not None or self._sampling
+
+    def start_profile(self, sampling=False):
+        if self.profiling:
+            return
+        if sampling:
+            import threading
+            self.samples = {}
+            self._sampling = True
+            threading.Thread(target=self._sample, args=(threading.main_thread().ident,),
+                             name="sampler", daemon=True).start()
+        else:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        logger.info("profiling started mode=%s", "sampling" if sampling else "cprofile")
+
+    def stop_profile(self, filename=None):
+        """ Stop profiling and write the result.
+
+        A cProfile run goes to ``filename`` in pstats format, readable with
+        ``python -m pstats``.  Samples are written as collapsed stacks, one
+        ``frame;frame;frame count`` line per distinct stack, which flame graph
+        tools accept.
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+            if filename:
+                self.profiler.dump_stats(filename)
+            self.profiler = None
+        elif self._sampling:
+            self._sampling = False
+            if filename:
+                with open(filename, "w") as file:
+                    for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]):
+                        file.write(f"{';'.join(stack)} {count}\n")
+        logger.info("profiling stopped output=%s", filename)
+
+    def _sample(self, thread_id):
+        samples = self.samples
+        while self._sampling:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            key = tuple(reversed(stack))
+            samples[key] = samples.get(key, 0) + 1
+            time.sleep(self.sample_interval)
+
+
+class MotionCoalescer:
+    """ Collapses bursts of motion events into one handler call per display frame.
+
+    Tk can deliver ``<B1-Motion>`` faster than the canvas redraws.  Only the
+    latest pending event matters for drawing and dragging, so events are parked
+    and the handler runs at most once every ``frame_ms`` with the newest one.
+    """
+
+    def __init__(self, root, handler, frame_ms=16):
+        self.root = root
+        self.handler = handler
+        self.frame_ms = frame_ms
+        self.pending = None
+        self._after_id = None
+
+    def push(self, event):
+        self.pending = event
+        if self._after_id is None:
+            self._after_id = self.root.after(self.frame_ms, self._fire)
+
+    def _fire(self):
+        self._after_id = None
+        event, self.pending = self.pending, None
+        if event is not None:
+            self.handler(event)
+
+    def flush(self):
+        """ Handle the pending event now, e.g. right before a button release. """
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+        self._fire()
+
+
+class StreamingLoader:
+    """ Loads a text or XML drawing into the app a frame's worth at a time.
+
+    Records are parsed lazily and handed to the canvas in batches that fit in
+    ``frame_budget`` seconds, with the next batch scheduled through ``after()``
+    so the event loop keeps redrawing and handling input between batches.
+    """
+
+    def __init__(self, app, filename, frame_budget=0.012, on_done=None):
+        self.app = app
+        self.filename = filename
+        self.frame_budget = frame_budget
+        self.on_done = on_done
+        self.errors = []
+        self.loaded = 0
+        self.cancelled = False
+        self.file = None
+        self._after_id = None
+
+    def open(self):
+        """ Open the file; raises OSError before anything in the app has changed. """
+        self.size = os.path.getsize(self.filename) or 1
+        if self.filename.endswith(XML_SUFFIX):
+            self.file = open(self.filename, "rb")
+            self.shapes = iter_xml_shapes(self.file, self.errors)
+        else:
+            self.file = open(self.filename, "r")
+            self.shapes = iter_text_shapes(self.file, self.errors)
+
+    def start(self):
+        if self.file is None:
+            self.open()
+        self._after_id = self.app.root.after_idle(self._step)
+
+    def progress(self):
+        """ Fraction of the file consumed so far. """
+        if self.file is None or self.file.closed:
+            return 1.0
+        return min(getattr(self.file, "buffer", self.file).tell() / self.size, 1.0)
+
+    def _step(self):
+        if self.cancelled:
+            return
+        deadline = time.perf_counter() + self.frame_budget
+        document = self.app.document
+        add, shapes = document.add, self.shapes
+        first = len(document.alive)
+        finished = True
+        try:
+            while time.perf_counter() < deadline:
+                for _ in range(64):  # Check the clock every few shapes, not every one
+                    add(*next(shapes))
+                    self.loaded += 1
+            finished = False
+        except StopIteration:
+            pass
+        except SyntaxError as e:  # ElementTree.ParseError, without importing xml for text files
+            self.errors.append((self.loaded + 1, f"unreadable XML: {e}"))
+        except (ValueError, OSError) as e:  # e.g. UnicodeDecodeError, or the disk going away
+            self.errors.append((self.loaded + 1, f"unreadable file: {e}"))
+        except BaseException:
+            self._finish()  # Never leave the file open and the app waiting for the load
+            raise
+        # Indexing and drawing the batch at once lets the view keep to its item budget
+        self.app.place_shapes(range(first, len(document.alive)))
+        if finished:
+            self._finish()
+            return
+        self.app.show_progress(f"Loading {os.path.basename(self.filename)}", self.progress())
+        self._after_id = self.app.root.after(1, self._step)
+
+    def cancel(self):
+        """ Stop loading; shapes read so far stay in the drawing. """
+        if self.file is None or self.file.closed:
+            return
+        self.cancelled = True
+        self.app.root.after_cancel(self._after_id)
+        self._finish()
+
+    def _finish(self):
+        self.file.close()
+        if self.on_done:
+            self.on_done(self)
+
+
+class Autosave:
+    """ Crash journal for the open drawing, written on a background thread.
+
+    Every ``interval_ms`` the Tk thread collects the shapes changed since the
+    previous tick (see Document.track_changes) and queues them as one compact
+    journal record; a worker thread appends the records to ``path``.  Once the
+    journal has grown by ``snapshot_bytes`` a full snapshot is queued instead,
+    which replaces the journal through a temporary file and a rename.  Saves
+    requested by the user go through the same thread, so the event loop only
+    ever copies memory and never waits on the disk.
+    """
+
+    def __init__(self, root, path, interval_ms=2000, snapshot_bytes=16 * 1024 * 1024, on_error=None):
+        import queue
+        import threading
+        self.root = root
+        self.path = path
+        self.interval_ms = interval_ms
+        self.snapshot_bytes = snapshot_bytes
+        self.on_error = on_error
+        self.document = None
+        self.parents = {}
+        self.palette_size = 0
+        self.journal_bytes = 0
+        self.tasks = queue.Queue()
+        self.errors = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="autosave", daemon=True)
+        self._after_id = None
+
+    def start(self):
+        self.thread.start()
+        self._after_id = self.root.after(self.interval_ms, self.tick)
+
+    def track(self, document):
+        """ Journal ``document`` from now on, starting from a snapshot; None pauses journaling. """
+        if self.document is not None:
+            self.document.track_changes(False)
+        self.document = document
+        if document is not None:
+            document.track_changes()
+            self.snapshot()
+
+    def snapshot(self):
+        document = self.document
+        document.take_changes()
+        self.parents = dict(document.groups.parents)
+        self.palette_size = len(document.palette)
+        payload = encode_journal_batch(document)
+        self.journal_bytes = len(payload)
+        self.tasks.put(("snapshot", payload))
+
+    def tick(self):
+        self._after_id = self.root.after(self.interval_ms, self.tick)
+        self.report_errors()
+        self.flush()
+
+    def flush(self):
+        """ Queue the changes made since the last record. """
+        document = self.document
+        if document is None:
+            return
+        if self.journal_bytes > self.snapshot_bytes:
+            self.snapshot()
+            return
+        sids = document.take_changes()
+        groups_changed = document.groups.parents != self.parents
+        palette_changed = len(document.palette) != self.palette_size
+        if not (sids or groups_changed or palette_changed):
+            return
+        payload = encode_journal_batch(document, sids, palette_changed, groups_changed)
+        if groups_changed:
+            self.parents = dict(document.groups.parents)
+        self.palette_size = len(document.palette)
+        self.journal_bytes += len(payload)
+        self.tasks.put(("append", payload))
+
+    def save(self, document, filename, write, binary=True):
+        """ Write ``document``, a copy nobody else changes, to ``filename`` in the background. """
+        self.tasks.put(("save", document, filename, write, binary))
+
+    def report_errors(self):
+        """ Hand the worker's errors to ``on_error``; returns whether a save failed. """
+        save_failed = False
+        while not self.errors.empty():
+            kind, message = self.errors.get_nowait()
+            if kind == "journal":
+                self.track(None)  # Stop journaling rather than fail every tick
+            save_failed = save_failed or kind == "save"
+            if self.on_error:
+                self.on_error(kind, message)
+        return save_failed
+
+    def wait(self):
+        """ Block until everything queued so far is written; returns whether a save failed. """
+        import threading
+        if self.thread.is_alive():
+            done = threading.Event()
+            self.tasks.put(("sync", done))
+            done.wait()
+        return self.report_errors()
+
+    def close(self, discard=True):
+        """ Finish queued work and stop the thread; ``discard`` deletes the journal. """
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+        if not discard:
+            self.flush()
+        self.tasks.put(("close", discard))
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def _run(self):
+        journal = None
+        while True:
+            task = self.tasks.get()
+            kind = task[0]
+            try:
+                if kind == "append":
+                    if journal is None:
+                        journal = open(self.path, "ab")
+                    write_journal_frame(task[1], journal)
+                    journal.flush()
+                elif kind == "snapshot":
+                    if journal is not None:
+                        journal.close()
+                        journal = None
+                    write_atomic(self.path, write_journal_frame, task[1])
+                elif kind == "save":
+                    _, document, filename, write, binary = task
+                    write_atomic(filename, write, document, binary)
+                elif kind == "sync":
+                    task[1].set()
+                else:
+                    if journal is not None:
+                        journal.close()
+                    if task[1] and os.path.exists(self.path):
+                        os.remove(self.path)
+                    return
+            except OSError as e:
+                self.errors.put(("journal" if kind != "save" else "save", str(e)))
+
 
 class DrawingApp:
-    def __init__(self, root):
+    # Methods timed by self.instrumentation; Tk bindings and menus see the wrapped versions.
+    # Handlers that open a modal dialog are left out, so time spent in the dialog is not counted;
+    # the work they hand on to (load_file, write_file, select_*) is timed instead.
+    INSTRUMENTED_HANDLERS = ("on_canvas_click", "select_object", "start_draw", "on_draw", "stop_draw",
+                             "move_object", "release_object", "pan_view", "zoom", "sync_view",
+                             "finish_marquee", "undo", "redo", "load_file", "write_file",
+                             "delete_selection", "paste", "apply_coords", "select_intersections",
+                             "select_overlaps", "select_within")
+
+    def __init__(self, root, history_limit=500, autosave_path=AUTOSAVE_PATH):
+        import tkinter as tk
         self.root = root
         self.root.title("Advanced Drawing Editor")
+        self.loader = None
+        self.instrumentation = Instrumentation()
+        for name in self.INSTRUMENTED_HANDLERS:
+            setattr(self, name, self.instrumentation.wrap(name, getattr(self, name)))
 
         self.canvas = tk.Canvas(root, width=800, height=600, bg='white')
         self.canvas.pack(expand=tk.YES, fill=tk.BOTH)
@@ -71,26 +2742,62 @@ class DrawingApp:
         self.selected_tool = None
         self.current_object = None
         self.last_object = None
-        self.objects = {}
-        self.object_id = 1
+        self.document = Document()
+        self.objects = {}  # canvas item -> shape id in self.document
+        self.items = {}  # shape id -> canvas item
+        self.index = SpatialIndex(self.document)
+        self.attributes = AttributeIndex(self.document)
+        self.history = History(history_limit)
+        self.draw_motion = MotionCoalescer(root, self.on_draw)
+        self.move_motion = MotionCoalescer(root, self.move_object)
+        self.drag_tag = None  # canvas tag or item moved by the current drag
+        self.drag_sids = []
+        self.drag_dx = self.drag_dy = 0
+        self.viewport = Viewport()
+        self.view_margin = 200  # pixels of off-screen drawing kept as canvas items
+        self.lod_pixels = 2  # shapes smaller than this on screen are merged into LOD cells
+        self.max_items = 50000  # beyond this only the largest shapes get their own item
+        self.overview_density = 0.025  # shapes per square pixel beyond which the view shows coarse blocks
+        self.lod_cell = 6  # pixels per side of the grey cells standing in for tiny shapes
+        self.lod_items = {}  # grey cell (x, y) or coarse block (x, y, size) -> canvas item
+        self.synced = None  # ((zoom, overview), region) of the last sync_view
+        self.pan_motion = MotionCoalescer(root, self.pan_view)
+        self.canvas.bind("<Configure>", self.on_resize)
+        self.canvas.bind("<MouseWheel>", self.on_wheel)
+        self.canvas.bind("<Button-4>", self.on_wheel)
+        self.canvas.bind("<Button-5>", self.on_wheel)
+        self.canvas.bind("<Button-2>", self.start_pan)
+        self.canvas.bind("<B2-Motion>", self.pan_motion.push)
         self.operation_mode = None
-        self.groups = {}  # Dictionary to store group information
-        self.group_id_counter = 0  # Counter to assign unique IDs to each group
-        self.selected_objects = set() 
+        self.selection = set()  # ids of selected shapes, whether or not they have an item
+        self.clipboard = []  # add() argument tuples of copied shapes
+        self.paste_count = 0
+        self.marquee_points = []
+        self.marquee_motion = MotionCoalescer(root, self.drag_marquee)
+        self.snap_endpoints = True
+        self.snap_pixels = 8  # screen distance within which a drawn point jumps to an end point
+        self.grid_size = 0  # document units between grid points; 0 turns grid snapping off
         self.canvas.bind("<Button-1>", self.on_canvas_click)
         self.is_saved = True
         self.setup_menus()
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.autosave = None
+        if autosave_path:
+            self.autosave = Autosave(root, autosave_path, on_error=self.autosave_failed)
+            if not self.recover_autosave():
+                self.autosave.track(self.document)
+            self.autosave.start()
 
     def setup_menus(self):
+        import tkinter as tk
         menu_bar = tk.Menu(self.root)
         
         file_menu = tk.Menu(menu_bar, tearoff=0)
-        file_menu.add_command(label="Exit", command=self.root.quit)
+        file_menu.add_command(label="Exit", command=self.on_close)
         menu_bar.add_cascade(label="File", menu=file_menu)
 
         draw_menu = tk.Menu(menu_bar, tearoff=0)
-        tools = ["line", "rectangle", "select", "edit"]
+        tools = ["line", "rectangle", "select", "edit", "marquee", "lasso"]
         for tool in tools:
             draw_menu.add_command(label=tool.capitalize(), command=lambda t=tool: self.select_tool(t))
         menu_bar.add_cascade(label="Draw/Edit", menu=draw_menu)
@@ -98,7 +2805,74 @@ class DrawingApp:
         edit_menu = tk.Menu(menu_bar, tearoff=0)
         edit_menu.add_command(label="Delete", command=lambda: self.set_operation_mode("delete"))
         edit_menu.add_command(label="Copy", command=lambda: self.set_operation_mode("copy"))
+        edit_menu.add_separator()
+        edit_menu.add_command(label="Undo", command=self.undo, accelerator="Ctrl+Z")
+        edit_menu.add_command(label="Redo", command=self.redo, accelerator="Ctrl+Y")
+        edit_menu.add_separator()
+        edit_menu.add_command(label="Delete Selection", command=self.delete_selection, accelerator="Delete")
+        edit_menu.add_command(label="Copy Selection", command=self.copy_selection, accelerator="Ctrl+C")
+        edit_menu.add_command(label="Paste", command=self.paste, accelerator="Ctrl+V")
+        edit_menu.add_command(label="Recolour Selection", command=self.recolor_selection)
         menu_bar.add_cascade(label="Tools", menu=edit_menu)
+        self.root.bind("<Control-z>", lambda event: self.undo())
+        self.root.bind("<Control-y>", lambda event: self.redo())
+        self.root.bind("<Delete>", lambda event: self.delete_selection())
+        self.root.bind("<Control-c>", lambda event: self.copy_selection())
+        self.root.bind("<Control-v>", lambda event: self.paste())
+        self.root.bind("<Control-a>", lambda event: self.select_matching())
+
+        select_menu = tk.Menu(menu_bar, tearoff=0)
+        select_menu.add_command(label="Select All", command=self.select_matching, accelerator="Ctrl+A")
+        select_menu.add_command(label="Select Lines", command=lambda: self.select_matching("line"))
+        select_menu.add_command(label="Select Rectangles", command=lambda: self.select_matching("rectangle"))
+        select_menu.add_command(label="Select by Colour", command=self.select_by_color)
+        select_menu.add_command(label="Clear Selection", command=self.clear_selections)
+        menu_bar.add_cascade(label="Select", menu=select_menu)
+
+        transform_menu = tk.Menu(menu_bar, tearoff=0)
+        transform_menu.add_command(label="Rotate 90° Clockwise", command=lambda: self.rotate_selection(90))
+        transform_menu.add_command(label="Rotate 90° Counter-clockwise", command=lambda: self.rotate_selection(-90))
+        transform_menu.add_command(label="Rotate...", command=self.rotate_selection)
+        transform_menu.add_command(label="Scale...", command=self.scale_selection)
+        transform_menu.add_command(label="Flip Horizontal", command=lambda: self.flip_selection(horizontal=True))
+        transform_menu.add_command(label="Flip Vertical", command=lambda: self.flip_selection(horizontal=False))
+        transform_menu.add_separator()
+        for edge in ALIGN_EDGES:
+            transform_menu.add_command(label=f"Align {edge.capitalize()}", command=lambda e=edge: self.align_selection(e))
+        transform_menu.add_command(label="Distribute Horizontally", command=lambda: self.distribute_selection(0))
+        transform_menu.add_command(label="Distribute Vertically", command=lambda: self.distribute_selection(1))
+        menu_bar.add_cascade(label="Transform", menu=transform_menu)
+
+        debug_menu = tk.Menu(menu_bar, tearoff=0)
+        debug_menu.add_command(label="Start cProfile", command=self.instrumentation.start_profile)
+        debug_menu.add_command(label="Start Sampling Profiler",
+                               command=lambda: self.instrumentation.start_profile(sampling=True))
+        debug_menu.add_command(label="Stop Profiling", command=self.stop_profile)
+        debug_menu.add_command(label="Export Stats", command=self.export_stats)
+        menu_bar.add_cascade(label="Debug", menu=debug_menu)
+        for key, dx, dy in (("Left", -1, 0), ("Right", 1, 0), ("Up", 0, -1), ("Down", 0, 1)):
+            self.root.bind(f"<{key}>", lambda event, dx=dx, dy=dy: self.nudge_selection(dx, dy))
+            self.root.bind(f"<Shift-{key}>", lambda event, dx=dx, dy=dy: self.nudge_selection(dx * 10, dy * 10))
+
+        view_menu = tk.Menu(menu_bar, tearoff=0)
+        view_menu.add_command(label="Zoom In", command=lambda: self.zoom(1.25))
+        view_menu.add_command(label="Zoom Out", command=lambda: self.zoom(0.8))
+        view_menu.add_command(label="Reset View", command=self.reset_view)
+        view_menu.add_separator()
+        # Kept on self so Tk does not drop the variables behind the check marks
+        self.snap_endpoints_var = tk.BooleanVar(self.root, value=self.snap_endpoints)
+        self.snap_grid_var = tk.BooleanVar(self.root, value=bool(self.grid_size))
+        view_menu.add_checkbutton(label="Snap to Endpoints", variable=self.snap_endpoints_var,
+                                  command=lambda: setattr(self, "snap_endpoints", self.snap_endpoints_var.get()))
+        view_menu.add_checkbutton(label="Snap to Grid", variable=self.snap_grid_var, command=self.toggle_grid)
+        view_menu.add_command(label="Grid Size...", command=self.set_grid_size)
+        menu_bar.add_cascade(label="View", menu=view_menu)
+
+        analyze_menu = tk.Menu(menu_bar, tearoff=0)
+        analyze_menu.add_command(label="Find Intersecting Lines", command=self.find_intersections)
+        analyze_menu.add_command(label="Find Overlapping Rectangles", command=self.find_overlaps)
+        analyze_menu.add_command(label="Select Shapes Nearby...", command=self.select_nearby)
+        menu_bar.add_cascade(label="Analyze", menu=analyze_menu)
 
         group_menu = tk.Menu(menu_bar, tearoff=0)
         group_menu.add_command(label="Group", command=self.create_group)
@@ -106,8 +2880,11 @@ class DrawingApp:
         menu_bar.add_cascade(label="Group", menu=group_menu)
         
         file_menu.add_command(label="Open", command=self.open_file)
+        file_menu.add_command(label="Cancel Loading", command=self.cancel_loading)
         file_menu.add_command(label="Save", command=self.save_file)
         file_menu.add_command(label="Export to XML", command=self.export_to_xml)
+        file_menu.add_command(label="Export Image", command=self.export_image)
+        file_menu.add_command(label="Import from XML", command=self.import_from_xml)
 
         # file_menu.add_separator()
         # file_menu.add_command(label="Exit", command=self.root.quit)
@@ -115,37 +2892,703 @@ class DrawingApp:
 
         self.root.config(menu=menu_bar)
 
+    def render_shape(self, sid):
+        """ Create the canvas item that displays a document shape. """
+        x1, y1, x2, y2 = self.viewport.screen_coords(*self.document.get_coords(sid))
+        color = self.document.color(sid)
+        shape_type = self.document.type(sid)
+        # Items carry their type and one tag per enclosing group, so whole groups
+        # can be addressed with a single canvas call.
+        tags = (shape_type, self.color_tag(self.document.colors[sid])) + self.document.groups.shape_tags(sid)
+        if sid in self.selection:
+            tags += ("selected",)
+            color = "red"
+        if shape_type == "line":
+            item = self.canvas.create_line(x1, y1, x2, y2, fill=color, tags=tags)
+        else:
+            item = self.canvas.create_rectangle(x1, y1, x2, y2, outline=color, tags=tags)
+        self.objects[item] = sid
+        self.items[sid] = item
+        self.instrumentation.count("items_created")
+        return item
+
+    @staticmethod
+    def color_tag(color_index):
+        """ Canvas tag carried by every item drawn in a palette colour. """
+        return f"color_{color_index}"
+
+    def unrender_shape(self, sid):
+        item = self.items.pop(sid)
+        del self.objects[item]
+        self.canvas.delete(item)
+
+    def place_shape(self, sid):
+        """ Index a new document shape and give it a canvas item if sync_view would. """
+        self.index.insert(sid)
+        self.attributes.insert(sid)
+        if self.wants_item(sid):
+            return self.render_shape(sid)
+        return None
+
+    def wants_item(self, sid):
+        """ Whether a shape is in view, there is room for another item, and it is oversized if the view is crowded. """
+        if len(self.items) >= self.max_items or not self.in_view(sid):
+            return False
+        return self.synced is None or not self.synced[0][1] or sid in self.index.large
+
+    def place_shapes(self, sids):
+        """ Index shapes added in bulk, then draw them, with one sync_view if they crowd the view or fill the budget. """
+        insert, attributes = self.index.insert, self.attributes.insert
+        for sid in sids:
+            insert(sid)
+            attributes(sid)
+        region = self.viewport.world_rect(self.view_margin)
+        if (self.synced is None or self.synced[0][1] != self.crowded(region)
+                or len(self.items) + len(sids) > self.max_items):
+            self.sync_view()
+            return
+        for sid in sids:
+            if self.wants_item(sid):
+                self.render_shape(sid)
+
+    def add_shape(self, *shape):
+        """ Add a shape to the document and display it; returns the canvas item. """
+        return self.place_shape(self.document.add(*shape))
+
+    def in_view(self, sid):
+        """ Whether a shape is big enough and close enough to the view to get an item. """
+        x1, y1, x2, y2 = self.document.bbox(sid)
+        left, top, right, bottom = self.viewport.world_rect(self.view_margin)
+        if x1 > right or x2 < left or y1 > bottom or y2 < top:
+            return False
+        lod = self.lod_pixels / self.viewport.zoom
+        return x2 - x1 >= lod or y2 - y1 >= lod
+
+    def crowded(self, region):
+        """ Whether a view region holds too many shapes to visit one by one.
+
+        Judged from the index's coarse counts against ``overview_density``
+        shapes per square pixel of the region, or when grid cells shrink under
+        ``lod_pixels`` on screen.
+        """
+        viewport, margin = self.viewport, self.view_margin
+        if self.index.cell_size * viewport.zoom < self.lod_pixels:
+            return True
+        pixels = (viewport.width + 2 * margin) * (viewport.height + 2 * margin)
+        return self.index.count_rect(*region) > self.overview_density * pixels
+
+    def sync_view(self, rescale=False, panned=False):
+        """ Create items for shapes that came into view and recycle the rest.
+
+        Only shapes intersecting the visible region plus ``view_margin`` become
+        canvas items.  Shapes too small to see at the current zoom, and all but
+        the ``max_items`` largest, are merged into one grey cell per few pixels
+        instead of being drawn one by one.  A crowded view only visits oversized
+        shapes and shows the rest as the index's coarse blocks.  Grey cells
+        outlive the call, and after a pan (``panned=True``) only the strips that
+        scrolled into or out of the region are looked at.  The selection is
+        kept by shape id, so items created later come up already highlighted.
+        """
+        viewport, bbox = self.viewport, self.document.bbox
+        lod = self.lod_pixels / viewport.zoom
+        region = viewport.world_rect(self.view_margin)
+        overview = self.crowded(region)
+        previous, self.synced = self.synced, ((viewport.zoom, overview), region)
+        if rescale or previous is None or previous[0] != self.synced[0]:
+            # Grey cells are laid out for one zoom and mode
+            self.canvas.delete("lod")
+            self.lod_items.clear()
+            panned = False
+        areas = rect_difference(region, previous[1]) if panned else [region]
+        candidates = set()
+        for area in areas:
+            candidates.update(self.index.query_rect(*area, large_only=overview))
+        wanted, small = set(), []
+        for sid in candidates:
+            x1, y1, x2, y2 = bbox(sid)
+            if x2 - x1 < lod and y2 - y1 < lod:
+                small.append(sid)
+            elif sid not in self.items or not panned:
+                wanted.add(sid)
+        room = self.max_items - len(self.items) if panned else self.max_items
+        if len(wanted) > room:
+            def size(sid):
+                x1, y1, x2, y2 = bbox(sid)
+                return max(x2 - x1, y2 - y1)
+            largest = set(heapq.nlargest(max(room, 0), wanted, key=size))
+            small.extend(wanted - largest)
+            wanted = largest
+        pinned = set()
+        if self.current_object in self.objects:
+            pinned.add(self.objects[self.current_object])
+        if panned:
+            for area in rect_difference(previous[1], region):
+                for sid in self.index.query_rect(*area, large_only=overview):
+                    if sid in self.items and sid not in pinned and not self.index.in_rect(sid, *region, overview):
+                        self.unrender_shape(sid)
+        else:
+            for sid in list(self.items):
+                if sid not in wanted and sid not in pinned:
+                    self.unrender_shape(sid)
+                elif rescale:
+                    self.canvas.coords(self.items[sid], *viewport.screen_coords(*self.document.get_coords(sid)))
+        for sid in wanted:
+            if sid not in self.items:
+                self.render_shape(sid)
+        keys = self.lod_keys(small, region)
+        if overview:
+            for area in areas:
+                keys.update(block[:3] for block in self.index.coarse_blocks(*area))
+        stale = self.scrolled_out(previous[1], region) if panned else self.lod_items.keys() - keys
+        for key in stale:
+            self.canvas.delete(self.lod_items.pop(key))
+        self.draw_grey(keys)
+
+    def lod_keys(self, sids, region):
+        """ Grey cells, on a grid fixed to the drawing, under the first points of shapes in a region.
+
+        Cells wholly outside the region are left out, so every cell drawn
+        touches the region it was drawn for and scrolled_out() finds it.
+        """
+        scale = self.viewport.zoom / self.lod_cell
+        coords = self.document.coords
+        keys = {(math.floor(coords[sid * 4] * scale), math.floor(coords[sid * 4 + 1] * scale)) for sid in sids}
+        return {key for key in keys if not self.grey_outside(key, region)}
+
+    def grey_outside(self, key, region):
+        """ Whether a grey cell (x, y) or coarse block (x, y, size) lies wholly outside a region. """
+        left, top, right, bottom = region
+        if len(key) == 3:
+            x, y, size = key
+        else:
+            size = self.lod_cell / self.viewport.zoom
+            x, y = key[0] * size, key[1] * size
+        return x > right or x + size < left or y > bottom or y + size < top
+
+    def scrolled_out(self, old, region):
+        """ Keys of grey cells and blocks drawn for region ``old`` that lie wholly outside ``region``. """
+        unit = self.lod_cell / self.viewport.zoom
+        keys = self.lod_items
+        strips = [(math.floor(x1 / unit), math.floor(y1 / unit), math.floor(x2 / unit), math.floor(y2 / unit))
+                  for x1, y1, x2, y2 in rect_difference(old, region)]
+        if self.synced[0][1] or sum((x2 - x1 + 1) * (y2 - y1 + 1) for x1, y1, x2, y2 in strips) > len(keys):
+            # Coarse blocks are few, as are the cells when fewer are drawn than scrolled past
+            return [key for key in keys if self.grey_outside(key, region)]
+        return [(x, y) for x1, y1, x2, y2 in strips for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)
+                if (x, y) in keys and self.grey_outside((x, y), region)]
+
+    def draw_grey(self, keys):
+        """ Draw the grey cells and coarse blocks among ``keys`` that are not on the canvas yet. """
+        to_screen, zoom, cell = self.viewport.to_screen, self.viewport.zoom, self.lod_cell
+        unit = cell / zoom
+        for key in keys:
+            if key in self.lod_items:
+                continue
+            if len(key) == 3:
+                sx, sy = to_screen(key[0], key[1])
+                extent = max(key[2] * zoom, 1)
+            else:
+                sx, sy = to_screen(key[0] * unit, key[1] * unit)
+                extent = cell - 1
+            self.lod_items[key] = self.canvas.create_rectangle(sx, sy, sx + extent, sy + extent,
+                                                               fill="gray", outline="", tags="lod")
+
+    def world(self, event):
+        """ Document coordinates of a mouse event. """
+        return self.viewport.to_world(event.x, event.y)
+
+    def on_resize(self, event):
+        self.viewport.width, self.viewport.height = event.width, event.height
+        self.sync_view()
+
+    def on_wheel(self, event):
+        zoom_in = event.num == 4 or event.delta > 0
+        self.zoom(1.25 if zoom_in else 0.8, event.x, event.y)
+
+    def zoom(self, factor, sx=None, sy=None):
+        """ Zoom around a pixel, the centre of the view by default. """
+        if sx is None:
+            sx, sy = self.viewport.width / 2, self.viewport.height / 2
+        self.viewport.zoom_at(factor, sx, sy)
+        self.sync_view(rescale=True)
+
+    def reset_view(self):
+        self.viewport.zoom = 1.0
+        self.viewport.x = self.viewport.y = 0.0
+        self.sync_view(rescale=True)
+
+    def start_pan(self, event):
+        self.pan_x, self.pan_y = event.x, event.y
+
+    def pan_view(self, event):
+        """ Shift existing items with one canvas call, then fill in the newly exposed area. """
+        dx, dy = event.x - self.pan_x, event.y - self.pan_y
+        self.pan_x, self.pan_y = event.x, event.y
+        self.viewport.pan(dx, dy)
+        self.canvas.move("all", dx, dy)
+        self.sync_view(panned=True)
+
+    def remove_shape(self, item):
+        self.delete_shapes([self.objects[item]])
+
+    def delete_shapes(self, sids, tag=None):
+        """ Remove shapes as one undoable step.
+
+        When every shape carries ``tag`` the canvas items go in a single call.
+        """
+        if tag is not None:
+            self.canvas.delete(tag)
+        for sid in sids:
+            item = self.items.pop(sid, None)  # Shapes out of view have no item
+            if item is not None:
+                del self.objects[item]
+                if tag is None:
+                    self.canvas.delete(item)
+            self.index.remove(sid)
+            self.attributes.remove(sid)
+            self.selection.discard(sid)
+        command = RemoveShapes(sids)
+        command.apply(self.document)
+        self.history.record(command)
+
+    def refresh_shapes(self, sids):
+        """ Bring the canvas in line with the document for the given shapes. """
+        self.clear_selections()
+        self.current_object = self.last_object = None
+        for sid in sids:
+            if sid in self.items:
+                self.unrender_shape(sid)
+            self.index.remove(sid)
+            self.attributes.remove(sid)
+        self.place_shapes([sid for sid in sids if sid in self.document])
+
+    def undo(self):
+        self.refresh_shapes(self.history.undo(self.document))
+        self.is_saved = False
+
+    def redo(self):
+        self.refresh_shapes(self.history.redo(self.document))
+        self.is_saved = False
+
+    def show_document(self, document, journal=True):
+        """ Replace the current drawing with the given document; ``journal=False`` leaves autosave alone. """
+        self.canvas.delete("all")
+        self.objects.clear()
+        self.items.clear()
+        self.lod_items.clear()
+        self.synced = None
+        self.selection.clear()
+        self.last_object = None
+        self.document = document
+        self.index = SpatialIndex(document)
+        self.index.build()
+        self.attributes = AttributeIndex(document)
+        self.history.clear()
+        self.sync_view()
+        if self.autosave and journal:
+            self.autosave.track(document)
+
+    def recover_autosave(self):
+        """ Offer to restore the drawing journaled by a session that did not exit cleanly. """
+        from tkinter import messagebox
+        path = self.autosave.path
+        if not os.path.exists(path):
+            return False
+        try:
+            document = read_journal(path)
+        except (OSError, ValueError) as e:
+            messagebox.showwarning("Recover", f"Could not read the autosave journal {path}:\n{e}")
+            return False
+        if document is None or not len(document):
+            return False
+        if not messagebox.askyesno("Recover", f"Recover {len(document)} shapes from the last session?"):
+            return False
+        self.show_document(document)
+        self.is_saved = False
+        return True
+
+    def autosave_failed(self, kind, message):
+        from tkinter import messagebox
+        logger.error("background write failed kind=%s error=%s", kind, message)
+        if kind == "save":
+            self.is_saved = False
+            messagebox.showerror("Error", f"Failed to save file:\n{message}")
+        else:
+            messagebox.showwarning("Autosave", f"Autosave stopped:\n{message}")
+
+    def find_item_at(self, x, y, halo=10):
+        """ Canvas item of the shape nearest to document point (x, y), or None.
+
+        ``halo`` is in screen pixels, so the pick radius is the same at any zoom.
+        """
+        sid = self.index.nearest(x, y, halo / self.viewport.zoom)
+        return None if sid is None else self.items.get(sid)
+
+    def set_item_color(self, item, color, width=None):
+        """ Recolour a canvas item through the option its type draws with. """
+        option = 'fill' if self.canvas.type(item) == 'line' else 'outline'
+        options = {option: color}
+        if width is not None:
+            options['width'] = width
+        self.canvas.itemconfig(item, **options)
+
+    def set_tag_color(self, tag, color, width=None):
+        """ Recolour every item carrying a tag with one call per shape type. """
+        line_options, rect_options = {'fill': color}, {'outline': color}
+        if width is not None:
+            line_options['width'] = rect_options['width'] = width
+        self.canvas.itemconfig(f"{tag}&&line", **line_options)
+        self.canvas.itemconfig(f"{tag}&&rectangle", **rect_options)
+
     def clear_selections(self):
-        """Clear all selections."""
-        for obj in self.selected_objects:
-            self.canvas.itemconfig(obj, outline='black')  # Reset outline
-        self.selected_objects.clear()
+        """ Clear the selection, restoring item colours with one call per colour and type. """
+        colors = self.document.colors
+        for index in {colors[sid] for sid in self.selection}:
+            self.set_tag_color(f"selected&&{self.color_tag(index)}", self.document.palette[index], width=1)
+        self.canvas.dtag("selected")
+        self.selection.clear()
+
+    def select_shapes(self, sids, add=False, tag=None):
+        """ Select shapes by id; only those that currently have an item touch the canvas.
+
+        ``tag`` is a canvas tag expression carried by exactly the items of these
+        shapes, e.g. a type and colour tag; the items are then tagged in one call.
+        """
+        if not add:
+            self.clear_selections()
+        if tag is not None:
+            self.selection.update(sids)
+            self.canvas.addtag_withtag("selected", tag)
+        else:
+            items = self.items
+            for sid in sids:
+                if sid not in self.selection:
+                    self.selection.add(sid)
+                    item = items.get(sid)
+                    if item is not None:
+                        self.canvas.addtag_withtag("selected", item)
+        self.set_tag_color("selected", "red")
+
+    def select_matching(self, shape_type=None, color=None):
+        """ Select every shape of a type and/or colour, looked up in the attribute index. """
+        parts = [shape_type] if shape_type else []
+        if color is not None:
+            index = self.document.palette.index(color) if color in self.document.palette else None
+            if index is None:
+                self.select_shapes(())  # A colour no shape uses
+                return
+            parts.append(self.color_tag(index))
+        # Shape items carry their type and colour tags, so these select exactly the matching items
+        tag = "&&".join(parts) or "line||rectangle"
+        self.select_shapes(self.attributes.query(shape_type, color), tag=tag)
+
+    def select_by_color(self):
+        from tkinter import simpledialog
+        in_use = sorted({self.document.color(sid) for sid in self.selection}) or self.document.palette
+        color = simpledialog.askstring("Select by Colour", f"Colour name or #rrggbb ({', '.join(in_use)}):",
+                                       parent=self.root)
+        if color:
+            self.select_matching(color=color.strip())
+
+    def start_marquee(self, event):
+        self.marquee_points = [self.world(event)]
+        self.canvas.delete("marquee")
+        if self.selected_tool == "lasso":
+            self.canvas.create_line(event.x, event.y, event.x, event.y, dash=(4, 2), tags="marquee")
+        else:
+            self.canvas.create_rectangle(event.x, event.y, event.x, event.y, dash=(4, 2), tags="marquee")
+
+    def drag_marquee(self, event):
+        """ Called at most once per frame; stretches the rubber band to the pointer. """
+        if not self.marquee_points:
+            return
+        if self.selected_tool == "lasso":
+            self.marquee_points.append(self.world(event))
+            coords = [c for point in self.marquee_points for c in self.viewport.to_screen(*point)]
+            self.canvas.coords("marquee", *coords)
+        else:
+            self.marquee_points[1:] = [self.world(event)]
+            self.canvas.coords("marquee", *self.viewport.screen_coords(*self.marquee_points[0], *self.marquee_points[1]))
+
+    def finish_marquee(self, event):
+        """ Select the shapes lying entirely inside the rectangle or lasso; Shift adds to the selection. """
+        self.marquee_motion.flush()
+        self.canvas.delete("marquee")
+        points, self.marquee_points = self.marquee_points, []
+        if len(points) < 2:
+            return
+        xs, ys = [x for x, _ in points], [y for _, y in points]
+        sids = self.index.query_rect(min(xs), min(ys), max(xs), max(ys), contained=True)
+        if self.selected_tool == "lasso":
+            if len(points) < 3:
+                return
+            vertices = self.document.vertices
+            sids = [sid for sid in sids if all(point_in_polygon(x, y, points) for x, y in vertices(sid))]
+        self.select_shapes(sids, add=bool(event.state & 0x0001))
+
+    def delete_selection(self):
+        """ Delete the selected shapes as one undoable step, canvas items in one call. """
+        if self.selection:
+            sids = list(self.selection)
+            self.selection.clear()
+            self.delete_shapes(sids, tag="selected")
+            self.is_saved = False
+
+    def copy_selection(self):
+        document = self.document
+        self.clipboard = [(document.type(sid), *document.get_coords(sid), document.color(sid),
+                           document.corner_style(sid)) for sid in sorted(self.selection)]
+        self.paste_count = 0
+
+    def paste(self, offset=15):
+        """ Add the copied shapes, shifted a little further on every paste, and select them. """
+        if not self.clipboard:
+            return
+        self.paste_count += 1
+        shift = offset * self.paste_count
+        add = self.document.add
+        new_sids = [add(shape_type, x1 + shift, y1 + shift, x2 + shift, y2 + shift, color, corner_style)
+                    for shape_type, x1, y1, x2, y2, color, corner_style in self.clipboard]
+        # Selected before they are drawn, so render_shape creates the items already highlighted
+        self.clear_selections()
+        self.selection.update(new_sids)
+        self.place_shapes(new_sids)
+        self.history.record(AddShapes(new_sids))
+        self.is_saved = False
+
+    def recolor_selection(self):
+        from tkinter import colorchooser
+        if not self.selection:
+            return
+        color = colorchooser.askcolor(title="Recolour Selection")[1]
+        if color:
+            self.restyle_shapes(list(self.selection), color, tag="selected")
+            self.clear_selections()
+
+    def restyle_shapes(self, sids, color, corner_style=None, tag=None):
+        """ Recolour shapes as one undoable step.
+
+        When every item of the shapes carries ``tag`` they are retagged and
+        recoloured through it, so the number of canvas calls depends on the
+        colours involved rather than on the number of shapes.
+        """
+        document = self.document
+        old_colors = {document.colors[sid] for sid in sids}
+        command = SetStyle(document, sids, color, corner_style)
+        command.apply(document)
+        self.history.record(command)
+        for sid in sids:
+            self.attributes.update(sid)
+        targets = [tag] if tag is not None else [self.items[sid] for sid in sids if sid in self.items]
+        for target in targets:
+            for index in old_colors:
+                self.canvas.dtag(target, self.color_tag(index))
+            self.canvas.addtag_withtag(self.color_tag(command.color), target)
+            if tag is not None:
+                self.set_tag_color(tag, color)
+            else:
+                self.set_item_color(target, color)
+        self.is_saved = False
+
+    def selection_units(self):
+        """ The selection as units that transform together, and the groups involved.
+
+        A selected shape that belongs to a group brings its whole top-level group,
+        as grouping does, so groups are rotated or aligned as one piece.
+        """
+        groups = self.document.groups
+        units, group_ids = [], []
+        for sid in sorted(self.selection):
+            top = groups.top_level(sid)
+            if top is None:
+                units.append([sid])
+            elif top not in group_ids:
+                group_ids.append(top)
+                units.append(groups.shapes(top))
+        return units, group_ids
+
+    def transform_selection(self, make_matrix):
+        """ Apply ``make_matrix(cx, cy)``, built around the centre of the selection, to it. """
+        units, group_ids = self.selection_units()
+        if not units:
+            return
+        sids = [sid for unit in units for sid in unit]
+        left, top, right, bottom = coords_bounds(gather_coords(self.document, sids))
+        matrix = make_matrix((left + right) / 2, (top + bottom) / 2)
+        old = gather_coords(self.document, sids)
+        coords = bound_rectangles(self.document, sids, old, transform_coords(old, matrix), matrix)
+        self.apply_coords(SetCoords(self.document, sids, coords), group_ids, matrix)
+
+    def apply_coords(self, command, group_ids, matrix=None, merge=False):
+        """ Apply a coordinate command and bring the canvas up to date in a batch.
+
+        Items are gathered under a temporary tag.  Translations, scaling and
+        mirroring then take two canvas calls in total.  Other transforms update
+        only the shapes that have items, and sync_view picks up any shape that
+        moved into or out of view.
+        """
+        command.apply(self.document)
+        self.history.record(command, merge=merge)
+        for sid in command.sids:
+            self.index.update(sid)
+        self.canvas.addtag_withtag("transform", "selected")
+        for group_id in group_ids:
+            self.canvas.addtag_withtag("transform", self.document.groups.tag(group_id))
+        if matrix is not None and matrix[1] == matrix[3] == 0:
+            sx, sy, tx, ty = self.viewport.screen_affine(matrix)
+            if sx != 1 or sy != 1:
+                self.canvas.scale("transform", 0, 0, sx, sy)
+            self.canvas.move("transform", tx, ty)
+        else:
+            screen_coords, coords = self.viewport.screen_coords, self.document.coords
+            for sid in command.sids:
+                item = self.items.get(sid)
+                if item is not None:
+                    self.canvas.coords(item, *screen_coords(*coords[sid * 4:sid * 4 + 4]))
+        self.canvas.dtag("transform")
+        self.sync_view()
+        self.is_saved = False
+
+    def rotate_selection(self, degrees=None):
+        if degrees is None:
+            from tkinter import simpledialog
+            degrees = simpledialog.askfloat("Rotate", "Degrees clockwise:", parent=self.root)
+            if degrees is None:
+                return
+        # Rectangles are stored axis-aligned; other than quarter turns they become their rotated bounds
+        self.transform_selection(lambda cx, cy: rotation(degrees, cx, cy))
+
+    def scale_selection(self):
+        from tkinter import simpledialog
+        factor = simpledialog.askfloat("Scale", "Scale factor:", parent=self.root, minvalue=1e-6)
+        if factor:
+            self.transform_selection(lambda cx, cy: scaling(factor, factor, cx, cy))
+
+    def flip_selection(self, horizontal=True):
+        sx, sy = (-1, 1) if horizontal else (1, -1)
+        self.transform_selection(lambda cx, cy: scaling(sx, sy, cx, cy))
+
+    def nudge_selection(self, dx, dy):
+        """ Move the selection by whole pixels; repeated nudges undo as one step. """
+        units, group_ids = self.selection_units()
+        if units:
+            dx, dy = dx / self.viewport.zoom, dy / self.viewport.zoom
+            command = MoveShapes([sid for unit in units for sid in unit], dx, dy)
+            self.apply_coords(command, group_ids, translation(dx, dy), merge=True)
+
+    def align_selection(self, edge):
+        units, group_ids = self.selection_units()
+        if len(units) > 1:
+            sids, coords = align_coords(self.document, units, edge)
+            self.apply_coords(SetCoords(self.document, sids, coords), group_ids)
+
+    def distribute_selection(self, axis):
+        units, group_ids = self.selection_units()
+        if len(units) > 2:
+            sids, coords = distribute_coords(self.document, units, axis)
+            self.apply_coords(SetCoords(self.document, sids, coords), group_ids)
+
+    def find_intersections(self):
+        """ Select every line that crosses or touches another line. """
+        from tkinter import messagebox
+        pairs = self.select_intersections()
+        messagebox.showinfo("Intersections", f"{pairs} intersecting pair(s) among {len(self.selection)} lines.")
+
+    def select_intersections(self):
+        """ Select the lines found by line_intersections(); returns the number of pairs. """
+        pairs = line_intersections(self.document)
+        logger.info("intersections pairs=%s", len(pairs))
+        self.select_shapes({sid for pair in pairs for sid in pair})
+        return len(pairs)
+
+    def find_overlaps(self):
+        """ Select every rectangle that overlaps or contains another one. """
+        from tkinter import messagebox
+        overlapping, contained = self.select_overlaps()
+        messagebox.showinfo("Overlaps", f"{overlapping} overlapping and {contained} nested pair(s) "
+                                        f"among {len(self.selection)} rectangles.")
+
+    def select_overlaps(self):
+        """ Select the rectangles found by rectangle_overlaps(); returns the overlapping and nested pair counts. """
+        found = rectangle_overlaps(self.document)
+        contained = sum(1 for _, _, relation in found if relation == "contains")
+        logger.info("overlaps pairs=%s contained=%s", len(found), contained)
+        self.select_shapes({sid for a, b, _ in found for sid in (a, b)})
+        return len(found) - contained, contained
+
+    def select_nearby(self, distance=None):
+        """ Ask for a distance, unless given, and select the shapes that close to the selection. """
+        from tkinter import messagebox, simpledialog
+        if not self.selection:
+            messagebox.showinfo("Select Nearby", "Select the shapes to measure from first")
+            return
+        if distance is None:
+            distance = simpledialog.askfloat("Select Nearby", "Distance:", parent=self.root, minvalue=0)
+            if distance is None:
+                return
+        self.select_within(distance)
+
+    def select_within(self, distance):
+        """ Replace the selection with the shapes within ``distance`` of any selected shape. """
+        seeds = self.selection
+        nearby = {other for sid in seeds for other, _ in self.index.within(sid, distance)}
+        self.select_shapes(nearby - seeds)
+
+    def toggle_grid(self):
+        if self.snap_grid_var.get() and not self.grid_size:
+            self.set_grid_size()
+        elif not self.snap_grid_var.get():
+            self.grid_size = 0
+        self.snap_grid_var.set(bool(self.grid_size))
+
+    def set_grid_size(self):
+        from tkinter import simpledialog
+        size = simpledialog.askfloat("Grid Size", "Grid spacing:", parent=self.root, minvalue=1e-6,
+                                     initialvalue=self.grid_size or 10)
+        if size:
+            self.grid_size = size
+        self.snap_grid_var.set(bool(self.grid_size))
+
+    def snap(self, x, y, exclude=None):
+        """ Move a drawn point onto a nearby end point or corner, else onto the grid when it is on.
+
+        Only the index cells around the pointer are searched, so this is cheap
+        enough to run on every motion event.
+        """
+        if self.snap_endpoints:
+            vertex = self.index.nearest_vertex(x, y, self.snap_pixels / self.viewport.zoom, exclude)
+            if vertex is not None:
+                return vertex
+        if self.grid_size:
+            size = self.grid_size
+            return round(x / size) * size, round(y / size) * size
+        return x, y
+
     def on_canvas_click(self, event):
-        # Output the event state to debug
         self.is_saved = False
-        # print("Event state:", event.state)  # Check what the state prints
         ctrl_pressed = (event.state & 0x08) != 0
-        # print("Ctrl pressed:", ctrl_pressed)
+        logger.debug("click x=%s y=%s state=%#x", event.x, event.y, event.state)
 
-        obj_id_tuple = self.canvas.find_closest(event.x, event.y, halo=10)
-        if obj_id_tuple:
-            obj_id = obj_id_tuple[0]
-            print("Object clicked:", obj_id)  # Check which object is clicked
+        obj_id = self.find_item_at(*self.world(event))
+        if obj_id is not None:
+            sid = self.objects[obj_id]
             if not ctrl_pressed:
-                if obj_id in self.selected_objects:
-                    self.selected_objects.remove(obj_id)
-                    self.canvas.itemconfig(obj_id, outline='black')
-                    print("Object deselected:", obj_id)
+                if sid in self.selection:
+                    self.selection.remove(sid)
+                    self.canvas.dtag(obj_id, "selected")
+                    self.reset_highlight(obj_id)
+                    logger.debug("deselected item=%s shape=%s", obj_id, sid)
                 else:
-                    self.selected_objects.add(obj_id)
-                    self.canvas.itemconfig(obj_id, outline='red')
-                    print("Object selected:", obj_id)
+                    self.selection.add(sid)
+                    self.canvas.addtag_withtag("selected", obj_id)
+                    self.set_item_color(obj_id, 'red')
+                    logger.debug("selected item=%s shape=%s", obj_id, sid)
             else:
                 self.clear_selections()
-                self.selected_objects.add(obj_id)
-                self.canvas.itemconfig(obj_id, outline='red')
-                print("New selection:", obj_id)
-        # self.is_saved = False
+                self.selection.add(sid)
+                self.canvas.addtag_withtag("selected", obj_id)
+                self.set_item_color(obj_id, 'red')
+                logger.debug("new selection item=%s shape=%s", obj_id, sid)
 
 
 
@@ -163,9 +3606,13 @@ class DrawingApp:
         self.canvas.unbind("<ButtonRelease-1>")
         if tool == "select" or tool == "edit":
             self.canvas.bind("<Button-1>", self.select_object)
+        elif tool in ("marquee", "lasso"):
+            self.canvas.bind("<Button-1>", self.start_marquee)
+            self.canvas.bind("<B1-Motion>", self.marquee_motion.push)
+            self.canvas.bind("<ButtonRelease-1>", self.finish_marquee)
         else:
             self.canvas.bind("<Button-1>", self.start_draw)
-            self.canvas.bind("<B1-Motion>", self.on_draw)
+            self.canvas.bind("<B1-Motion>", self.draw_motion.push)
             self.canvas.bind("<ButtonRelease-1>", self.stop_draw)
 
     def set_operation_mode(self, mode):
@@ -173,47 +3620,53 @@ class DrawingApp:
         self.canvas.bind("<Button-1>", self.perform_operation)
 
     def perform_operation(self, event):
-        selected_object = self.canvas.find_closest(event.x, event.y, halo=10)[0]
+        selected_object = self.find_item_at(*self.world(event))
+        if selected_object is None:
+            return
         if self.operation_mode == "delete":
-            self.canvas.delete(selected_object)
-            del self.objects[selected_object]
+            self.remove_shape(selected_object)
         elif self.operation_mode == "copy":
             self.copy_object(selected_object)
         self.operation_mode = None
 
     def delete_object(self, event):
-        selected_object = self.canvas.find_closest(event.x, event.y, halo=10)[0]
-        self.canvas.delete(selected_object)
-        del self.objects[selected_object]
+        selected_object = self.find_item_at(*self.world(event))
+        if selected_object is not None:
+            self.remove_shape(selected_object)
 
     def copy_object(self, event):
-        selected_object = self.canvas.find_closest(event.x, event.y, halo=10)[0]
-        self.copy_object(selected_object)
+        selected_object = self.find_item_at(*self.world(event))
+        if selected_object is not None:
+            self.copy_object(selected_object)
     def start_draw(self, event):
-        self.start_x = event.x
-        self.start_y = event.y
-        options = {'tags': str(self.object_id)}
-        if self.selected_tool == "line":
-            options['fill'] = 'black'
-            self.current_object = self.canvas.create_line(self.start_x, self.start_y, event.x, event.y, **options)
-        elif self.selected_tool == "rectangle":
-            options['outline'] = 'black'
-            self.current_object = self.canvas.create_rectangle(self.start_x, self.start_y, event.x, event.y, **options)
-        self.objects[self.current_object] = {'type': self.selected_tool, 'coordinates': (self.start_x, self.start_y, event.x, event.y)}
+        self.start_x, self.start_y = self.snap(*self.world(event))
+        if self.selected_tool in SHAPE_TYPES:
+            self.current_object = self.render_shape(
+                self.document.add(self.selected_tool, self.start_x, self.start_y, self.start_x, self.start_y))
+            self.index.insert(self.objects[self.current_object])
+            self.attributes.insert(self.objects[self.current_object])
+            self.history.record(AddShapes([self.objects[self.current_object]]))
 
     def on_draw(self, event):
         self.is_saved = False
         if self.current_object:
-            self.canvas.coords(self.current_object, self.start_x, self.start_y, event.x, event.y)
+            sid = self.objects[self.current_object]
+            x, y = self.snap(*self.world(event), exclude=sid)
+            self.document.set_coords(sid, self.start_x, self.start_y, x, y)
+            self.canvas.coords(self.current_object, *self.viewport.screen_coords(self.start_x, self.start_y, x, y))
+            self.index.update(sid)
 
     def stop_draw(self, event):
+        self.draw_motion.flush()
         self.current_object = None
 
     def prepare_to_move_object(self, event):
         if self.last_object:
             self.reset_highlight(self.last_object)
-        self.current_object = self.canvas.find_closest(event.x, event.y, halo=10)[0]
-        object_type = self.canvas.type(self.current_object)
+        self.current_object = self.find_item_at(*self.world(event))
+        if self.current_object is None:
+            return
+        object_type = self.document.type(self.objects[self.current_object])
         
         # Handling visual feedback based on object type
         if object_type == 'line':
@@ -224,23 +3677,39 @@ class DrawingApp:
             self.canvas.itemconfig(self.current_object, outline="red", width=2)
         
         self.last_object = self.current_object
-        self.start_x, self.start_y = event.x, event.y
-        self.canvas.bind("<B1-Motion>", self.move_object)
+        if self.objects[self.current_object] in self.selection and len(self.selection) > 1:
+            # Dragging part of a multi-selection drags all of it
+            self.begin_drag(event, "selected", list(self.selection))
+        else:
+            self.begin_drag(event, self.current_object, [self.objects[self.current_object]])
+
+    def prepare_to_move_group(self, group_id, event):
+        groups = self.document.groups
+        self.begin_drag(event, groups.tag(group_id), groups.shapes(group_id))
+
+    def begin_drag(self, event, tag, sids):
+        """ Start moving every canvas item carrying ``tag`` with the pointer. """
+        self.drag_tag = tag
+        self.drag_sids = sids
+        self.drag_dx = self.drag_dy = 0
+        self.start_x, self.start_y = self.world(event)
+        self.canvas.bind("<B1-Motion>", self.move_motion.push)
         self.canvas.bind("<ButtonRelease-1>", self.release_object)
 
     def select_object(self, event):
             """ Modified select_object to handle group selection. """
-            selected_object = self.canvas.find_closest(event.x, event.y, halo=10)[0]
-            is_grouped = any(selected_object in group for group in self.groups.values())
-            if is_grouped:
-                for group_id, objects in self.groups.items():
-                    if selected_object in objects:
-                        self.highlight_group(group_id)
-                        if self.selected_tool == "delete":
-                            self.perform_group_operation(group_id, "delete")
-                        elif self.selected_tool == "copy":
-                            self.perform_group_operation(group_id, "copy")
-                        break
+            selected_object = self.find_item_at(*self.world(event))
+            if selected_object is None:
+                return
+            group_id = self.document.groups.top_level(self.objects[selected_object])
+            if group_id is not None:
+                self.highlight_group(group_id)
+                if self.selected_tool == "delete":
+                    self.perform_group_operation(group_id, "delete")
+                elif self.selected_tool == "copy":
+                    self.perform_group_operation(group_id, "copy")
+                elif self.selected_tool == "select":
+                    self.prepare_to_move_group(group_id, event)
             else:
                 if self.selected_tool == "edit":
                     self.edit_object(event)
@@ -253,211 +3722,517 @@ class DrawingApp:
             
 
     def create_group(self):
-        if self.selected_objects:
-            new_group_id = self.group_objects(self.selected_objects)
-            print(f"Created new group: {new_group_id}")
+        if self.selection:
+            new_group_id = self.group_objects(self.selection)
+            logger.info("created group=%s shapes=%s", new_group_id, len(self.document.groups.shapes(new_group_id)))
             # Optionally, clear the selections after grouping
             self.clear_selections()
 
 
-    def group_objects(self, object_ids):
-        """ Group multiple objects together. """
-        group_id = f"group_{self.group_id_counter}"
-        self.group_id_counter += 1
-        self.groups[group_id] = set(object_ids)
-        for obj_id in object_ids:
-            self.canvas.itemconfig(obj_id, outline='green')  # Visual indication for grouping
+    def group_objects(self, sids):
+        """ Group multiple shapes together.
+
+        Shapes that already belong to a group bring their whole outermost group
+        along, which becomes a nested group of the new one.
+        """
+        groups = self.document.groups
+        shape_ids, group_ids = set(), set()
+        for sid in sids:
+            top = groups.top_level(sid)
+            if top is None:
+                shape_ids.add(sid)
+            else:
+                group_ids.add(top)
+        group_id = groups.create(shape_ids, group_ids)
+        tag = groups.tag(group_id)
+        for sid in shape_ids:
+            if sid in self.items:  # Shapes out of view get the tag when they are rendered
+                self.canvas.addtag_withtag(tag, self.items[sid])
+        for child in group_ids:
+            self.canvas.addtag_withtag(tag, groups.tag(child))
+        self.set_tag_color(tag, 'green')  # Visual indication for grouping
         return group_id
 
-    def ungroup_selected_group(self, group_id):
+    def ungroup_selected_group(self, group_id=None):
         """Ungroup the currently selected group."""
-    # This needs to know which group is selected; let's assume it's already known
-        if not self.selected_objects:
+        from tkinter import messagebox
+        groups = self.document.groups
+        if group_id is None:
+            for sid in self.selection:
+                group_id = groups.top_level(sid)
+                if group_id is not None:
+                    break
+        if group_id is None:
             messagebox.showinfo("Ungroup", "No group selected")
             return
-        for obj in self.selected_objects:
-            group_id = next((gid for gid, objs in self.groups.items() if obj in objs), None)
-            if group_id:
-                self.ungroup_objects(group_id)
-                break
+        self.ungroup_objects(group_id)
+
+    def ungroup_objects(self, group_id):
+        """ Dissolve one level of grouping; nested groups stay intact. """
+        self.canvas.dtag(self.document.groups.tag(group_id))
+        self.document.groups.dissolve(group_id)
 
     def perform_group_operation(self, group_id, operation):
         """ Perform an operation on all objects in a group. """
-        if group_id in self.groups:
-            for obj_id in self.groups[group_id]:
-                if operation == "delete":
-                    self.canvas.delete(obj_id)
-                    del self.objects[obj_id]
-                elif operation == "copy":
-                    self.copy_object(obj_id)
-                elif operation == "move":
-                    pass  # Moving is handled separately
+        groups = self.document.groups
+        if group_id in groups:
             if operation == "delete":
-                del self.groups[group_id]
+                self.delete_shapes(groups.shapes(group_id), tag=groups.tag(group_id))
+            elif operation == "copy":
+                new_group_id = self.copy_group(group_id)
+                self.history.record(AddShapes(groups.shapes(new_group_id)))
+            elif operation == "move":
+                pass  # Moving is handled separately
+
+    def copy_group(self, group_id, parent=-1, offset=15):
+        """ Duplicate a group, its nested groups and their shapes. """
+        groups = self.document.groups
+        document = self.document
+        new_group_id = groups.create(parent=parent)
+        for sid in groups.members[group_id]:
+            x1, y1, x2, y2 = document.get_coords(sid)
+            new_sid = document.add(document.type(sid), x1 + offset, y1 + offset, x2 + offset, y2 + offset,
+                                   document.color(sid), document.corner_style(sid), new_group_id)
+            groups.members[new_group_id].add(new_sid)
+            self.place_shape(new_sid)
+        for child in list(groups.children[group_id]):
+            self.copy_group(child, new_group_id, offset)
+        return new_group_id
+
     def highlight_group(self, group_id):
         """ Highlight all objects in a group. """
-        if group_id in self.groups:
-            for obj_id in self.groups[group_id]:
-                self.canvas.itemconfig(obj_id, outline='red', width=2)  # Highlight effect
+        if group_id in self.document.groups:
+            self.set_tag_color(self.document.groups.tag(group_id), 'red', width=2)  # Highlight effect
 
     def edit_object(self, event):
         if self.last_object:
             self.reset_highlight(self.last_object)
-        self.current_object = self.canvas.find_closest(event.x, event.y, halo=10)[0]
-        object_type = self.canvas.type(self.current_object)
-        current_color = self.canvas.itemcget(self.current_object, "fill" if object_type == 'line' else "outline")
+        self.current_object = self.find_item_at(*self.world(event))
+        if self.current_object is None:
+            return
+        sid = self.objects[self.current_object]
+        object_type = self.document.type(sid)
+        current_color = self.document.color(sid)
         new_color, corner_style = edit_properties(self.root, current_color, is_line=(object_type == 'line'))
         if new_color:
-            if object_type == 'line':
-                self.canvas.itemconfig(self.current_object, fill=new_color)
-            else:
-                self.canvas.itemconfig(self.current_object, outline=new_color)
-                if corner_style == "round":
-                    self.canvas.itemconfig(self.current_object, outline=new_color, dash=())
-                else:
-                    self.canvas.itemconfig(self.current_object, outline=new_color, dash=())
+            self.restyle_shapes([sid], new_color, corner_style)
     def move_object(self, event):
-        if self.current_object:
-            dx = event.x - self.start_x
-            dy = event.y - self.start_y
-            self.canvas.move(self.current_object, dx, dy)
-            self.start_x, self.start_y = event.x, event.y
+        """ Called at most once per frame while dragging; one tag-based canvas move. """
+        if self.drag_tag is not None:
+            x, y = self.world(event)
+            dx = x - self.start_x
+            dy = y - self.start_y
+            zoom = self.viewport.zoom
+            self.canvas.move(self.drag_tag, dx * zoom, dy * zoom)
+            self.drag_dx += dx
+            self.drag_dy += dy
+            self.start_x, self.start_y = x, y
 
     def release_object(self, event):
+        self.move_motion.flush()
+        moved = self.drag_tag is not None and bool(self.drag_dx or self.drag_dy)
+        if self.drag_tag is not None:
+            # The document and index only learn about the drag once it is over
+            if moved:
+                command = MoveShapes(self.drag_sids, self.drag_dx, self.drag_dy)
+                command.apply(self.document)
+                for sid in self.drag_sids:
+                    self.index.update(sid)
+                self.history.record(command)
+                self.is_saved = False
+            if not isinstance(self.drag_tag, int) and self.drag_tag != "selected":
+                for sid in self.drag_sids:
+                    self.reset_highlight(self.items.get(sid))  # Drop the group highlight
+            self.drag_tag = None
+            self.drag_sids = []
         if self.current_object:
             self.reset_highlight(self.current_object)
             self.current_object = None
+        if moved:
+            self.sync_view()  # Moved shapes may have entered or left the view
 
     def reset_highlight(self, obj):
-        object_type = self.canvas.type(obj)
-        if object_type == 'line':
-        # Reset line width and color to default
-                self.canvas.itemconfig(obj, fill='black', width=1)
-        else:
-            # Reset rectangle or other shapes' outline to default
-            self.canvas.itemconfig(obj, outline='black', width=1)
+        sid = self.objects.get(obj)
+        if sid is None:
+            return  # The item was deleted while highlighted
+        # Reset width and color to what the document says the shape looks like
+        self.set_item_color(obj, self.document.color(sid), width=1)
 
 
     def copy_object(self, obj):
         offset = 15
-        obj_info = self.objects[obj]
-        coords = self.canvas.coords(obj)
-        new_coords = [coord + offset for coord in coords]
-        if obj_info['type'] == 'line':
-            new_obj = self.canvas.create_line(*new_coords, fill='black', tags=str(self.object_id))
-        elif obj_info['type'] == 'rectangle':
-            new_obj = self.canvas.create_rectangle(*new_coords, outline='black', tags=str(self.object_id))
-        self.objects[new_obj] = {'type': obj_info['type'], 'coordinates': new_coords}
-        self.object_id += 1
+        sid = self.objects[obj]
+        new_coords = [coord + offset for coord in self.document.get_coords(sid)]
+        new_sid = self.document.add(self.document.type(sid), *new_coords,
+                                    self.document.color(sid), self.document.corner_style(sid))
+        self.history.record(AddShapes([new_sid]))
+        return self.place_shape(new_sid)
 
     def open_file(self):
-        filename = filedialog.askopenfilename(title="Open File", filetypes=[("Text files", "*.txt")])
+        from tkinter import filedialog
+        filename = filedialog.askopenfilename(title="Open File", filetypes=DRAWING_FILETYPES)
         if filename:
-            self.canvas.delete("all")  # Clear the current canvas
-            self.objects.clear()  # Also clear the objects dictionary to prevent referencing old objects.
-
-            with open(filename, "r") as file:
-                for line in file:
-                    parts = line.strip().split()
-                    if len(parts) < 6:  # Ensure there are enough parts to parse
-                        print("Skipped a line due to insufficient data:", line)
-                        continue  # Skip this line if not enough parts
-
-                    shape_type = parts[0]
-                    x1, y1, x2, y2 = map(int, parts[1:5])
-                    color = self.color_code_to_rgb(parts[5])
-                    obj = None  # Initialize obj to None for safety
-
-                    if shape_type == "line":
-                        obj = self.canvas.create_line(x1, y1, x2, y2, fill=color)
-                    elif shape_type == "rectangle":
-                        obj = self.canvas.create_rectangle(x1, y1, x2, y2, outline=color)
-                    else:
-                        print("Unrecognized shape type:", shape_type)
-                        continue  # Skip unrecognized shape types
-
-                    if obj is not None:
-                        # Store the object with its properties only if it has been created
-                        self.objects[obj] = {'type': shape_type, 'coordinates': (x1, y1, x2, y2), 'color': color}
-                    else:
-                        print("Failed to create object for line:", line)
+            self.load_file(filename)
+
+    def load_file(self, filename):
+        """ Replace the drawing with a file's contents without blocking the UI. """
+        from tkinter import messagebox
+        self.cancel_loading()
+        if filename.endswith(BINARY_SUFFIX):
+            try:
+                document = read_binary(filename)
+            except (OSError, ValueError) as e:
+                logger.error("load failed file=%s error=%s", filename, e)
+                messagebox.showerror("Error", f"Failed to load file: {filename}\n{str(e)}")
+                return
+            self.show_document(document)
+            self.is_saved = True
+            return
+        loader = StreamingLoader(self, filename, on_done=self.loading_done)
+        try:
+            loader.open()
+        except OSError as e:
+            # Nothing has changed yet: the drawing, its history and the journal are kept
+            logger.error("load failed file=%s error=%s", filename, e)
+            messagebox.showerror("Error", f"Failed to load file: {filename}\n{str(e)}")
+            return
+        if self.autosave:
+            # The journal keeps the old drawing until loading_done journals the new one in one go
+            self.autosave.flush()
+            self.autosave.track(None)
+        started = False
+        try:
+            self.show_document(Document(), journal=False)
+            loader.start()
+            started = True
+        finally:
+            if not started:
+                loader.file.close()
+                if self.autosave:
+                    self.autosave.track(self.document)
+        self.loader = loader
+        self.root.bind("<Escape>", lambda event: self.cancel_loading())
+
+    def cancel_loading(self):
+        if self.loader:
+            self.loader.cancel()
+
+    def show_progress(self, message, fraction):
+        self.root.title(f"Advanced Drawing Editor - {message} {fraction:.0%}")
+
+    def loading_done(self, loader):
+        from tkinter import messagebox
+        self.loader = None
+        self.sync_view()
+        self.root.unbind("<Escape>")
+        self.root.title("Advanced Drawing Editor")
+        self.is_saved = not loader.cancelled
+        logger.info("loaded file=%s shapes=%s errors=%s cancelled=%s", loader.filename, loader.loaded,
+                    len(loader.errors), loader.cancelled)
+        if self.autosave:
+            self.autosave.track(self.document)
+        if loader.cancelled:
+            messagebox.showinfo("Open", f"Loading cancelled after {loader.loaded} shapes.")
+        if loader.errors:
+            unit = "shape" if loader.filename.endswith(XML_SUFFIX) else "line"
+            report = "\n".join(f"{unit} {number}: {message}" for number, message in loader.errors[:10])
+            if len(loader.errors) > 10:
+                report += f"\n... and {len(loader.errors) - 10} more"
+            messagebox.showwarning("Open", f"Skipped {len(loader.errors)} malformed {unit}(s) in "
+                                           f"{loader.filename}:\n{report}")
 
     def save_file(self):
-        filename = filedialog.asksaveasfilename(title="Save File", filetypes=[("Text files", "*.txt")])
+        from tkinter import filedialog
+        filename = filedialog.asksaveasfilename(title="Save File", filetypes=DRAWING_FILETYPES)
         if filename:
-            with open(filename, "w") as file:
-                for obj, details in self.objects.items():
-                    x1, y1, x2, y2 = self.canvas.coords(obj)
-                    shape_type = details['type']
-                    color = self.rgb_to_color_code(self.canvas.itemcget(obj, "fill"))
-                    line = f"{shape_type} {int(x1)} {int(y1)} {int(x2)} {int(y2)} {color}\n"
-                    file.write(line)
-            self.is_saved = True
+            self.write_file(filename)
+
+    def write_file(self, filename):
+        """ Save the drawing to ``filename``, in the format its suffix names. """
+        binary = filename.endswith(BINARY_SUFFIX)
+        write = write_binary if binary else write_text
+        # Writing happens on the autosave thread from a copy, so the UI does not stall
+        if self.autosave:
+            self.autosave.save(self.document.copy(), filename, write, binary)
+        else:
+            write_atomic(filename, write, self.document, binary)
+        self.is_saved = True
 
     def color_code_to_rgb(self, code):
-        return {"k": "black", "r": "red", "g": "green", "b": "blue"}.get(code, "black")
+        return COLOR_CODES.get(code, "black")
 
     def rgb_to_color_code(self, rgb):
-        return {v: k for k, v in {"k": "black", "r": "red", "g": "green", "b": "blue"}.items()}.get(rgb, "k")
+        return CODE_FOR_COLOR.get(rgb, "k")
 
     def run(self):
         if len(sys.argv) > 1:
             self.open_file_via_arg(sys.argv[1])
         self.root.mainloop()
+        if self.autosave and self.autosave.thread.is_alive():
+            # mainloop ended without on_close; the worker is a daemon, so finish queued saves before exiting
+            save_failed = self.autosave.wait()
+            self.autosave.close(discard=self.is_saved and not save_failed)
         
     def on_close(self):
+        from tkinter import messagebox
+        response = True
         if not self.is_saved:
             response = messagebox.askyesnocancel("Quit", "You have unsaved changes. Save before quitting?")
             if response:  # Yes, save changes
                 self.save_file()
-                self.root.destroy()
             elif response is None:  # Cancel
                 return
+        if self.autosave:
+            if self.autosave.wait():
+                return  # The save failed and has been reported; keep the window and the journal
+            # Keeps the journal if the save dialog was cancelled
+            self.autosave.close(discard=self.is_saved or response is False)
         self.root.destroy()
     def open_file_via_arg(self, filename):
-        try:
-            with open(filename, "r") as file:
-                for line in file:
-                    parts = line.strip().split()
-                    shape_type = parts[0]
-                    x1, y1, x2, y2 = map(int, parts[1:5])
-                    color = self.color_code_to_rgb(parts[5])
-                    if shape_type == "line":
-                        obj = self.canvas.create_line(x1, y1, x2, y2, fill=color)
-                    elif shape_type == "rect":
-                        corner_style = parts[6]
-                        obj = self.canvas.create_rectangle(x1, y1, x2, y2, outline=color)
-                    self.objects[obj] = {'type': shape_type, 'coordinates': (x1, y1, x2, y2), 'color': color}
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to load file: {filename}\n{str(e)}")
+        self.load_file(filename)
     def export_to_xml(self):
-        root = ET.Element("Drawing")
-        for obj, details in self.objects.items():
-            if details['type'] == 'line':
-                line = ET.SubElement(root, "line")
-                begin = ET.SubElement(line, "begin")
-                ET.SubElement(begin, "x").text = str(self.canvas.coords(obj)[0])
-                ET.SubElement(begin, "y").text = str(self.canvas.coords(obj)[1])
-                end = ET.SubElement(line, "end")
-                ET.SubElement(end, "x").text = str(self.canvas.coords(obj)[2])
-                ET.SubElement(end, "y").text = str(self.canvas.coords(obj)[3])
-                ET.SubElement(line, "color").text = self.rgb_to_color_code(self.canvas.itemcget(obj, "fill"))
-            elif details['type'] == 'rectangle':
-                rect = ET.SubElement(root, "rectangle")
-                upper_left = ET.SubElement(rect, "upper-left")
-                ET.SubElement(upper_left, "x").text = str(self.canvas.coords(obj)[0])
-                ET.SubElement(upper_left, "y").text = str(self.canvas.coords(obj)[1])
-                lower_right = ET.SubElement(rect, "lower-right")
-                ET.SubElement(lower_right, "x").text = str(self.canvas.coords(obj)[2])
-                ET.SubElement(lower_right, "y").text = str(self.canvas.coords(obj)[3])
-                ET.SubElement(rect, "color").text = self.rgb_to_color_code(self.canvas.itemcget(obj, "outline"))
-                ET.SubElement(rect, "corner").text = details.get('corner_style', 'square')
-        
-        tree = ET.ElementTree(root)
+        from tkinter import filedialog
         filename = filedialog.asksaveasfilename(title="Export to XML", filetypes=[("XML Files", "*.xml")])
         if filename:
-            tree.write(filename)
+            with open(filename, "w") as file:
+                write_xml(self.document, file)
+
+    def export_image(self):
+        from tkinter import filedialog
+        filename = filedialog.asksaveasfilename(title="Export Image", defaultextension=".png",
+                                                filetypes=[("PNG Images", "*.png"), ("PPM Images", "*.ppm")])
+        if filename:
+            write_image(self.document, filename)
+
+    def stop_profile(self):
+        from tkinter import filedialog
+        if not self.instrumentation.profiling:
+            return
+        sampling = self.instrumentation.profiler is None
+        filetypes = [("Collapsed stacks", "*.txt")] if sampling else [("Profile data", "*.prof")]
+        filename = filedialog.asksaveasfilename(title="Save Profile", filetypes=filetypes,
+                                                defaultextension=".txt" if sampling else ".prof")
+        self.instrumentation.stop_profile(filename or None)
+
+    def export_stats(self):
+        from tkinter import filedialog
+        filename = filedialog.asksaveasfilename(title="Export Stats", defaultextension=".json",
+                                                filetypes=[("JSON", "*.json"), ("Text", "*.txt")])
+        if filename:
+            self.instrumentation.export(filename)
+
+    def import_from_xml(self):
+        from tkinter import filedialog
+        filename = filedialog.askopenfilename(title="Import from XML", filetypes=[("XML Files", "*.xml")])
+        if filename:
+            self.load_file(filename)
+
+FORMAT_SUFFIXES = {"txt": ".txt", "xml": XML_SUFFIX, "drw": BINARY_SUFFIX}
+CLI_COMMANDS = ("convert", "validate", "export", "stats", "render")
+
+
+def iter_file_shapes(filename, errors=None):
+    """ Stream add() argument tuples from a drawing file of any supported format. """
+    if filename.endswith(BINARY_SUFFIX):
+        yield from read_binary(filename).records()
+    elif filename.endswith(XML_SUFFIX):
+        with open(filename, "rb") as file:
+            yield from iter_xml_shapes(file, errors)
+    else:
+        with open(filename, "r") as file:
+            yield from iter_text_shapes(file, errors)
+
+
+def collect_drawings(paths):
+    """ Expand files and directories into ``(path, path relative to its root)`` pairs. """
+    suffixes = tuple(FORMAT_SUFFIXES.values())
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.endswith(suffixes):
+                        full = os.path.join(directory, name)
+                        found.append((full, os.path.relpath(full, path)))
+        else:
+            found.append((path, os.path.basename(path)))
+    return found
+
+
+def convert_file(source, target):
+    """ Convert between formats; text and XML targets are written as a stream. """
+    errors = []
+    shapes = iter_file_shapes(source, errors)
+    count = 0
+
+    def counted():
+        nonlocal count
+        for shape in shapes:
+            count += 1
+            yield shape
+
+    if target.endswith(BINARY_SUFFIX):
+        document = Document()
+        for shape in counted():
+            document.add(*shape)
+        with open(target, "wb") as file:
+            write_binary(document, file)
+    elif target.endswith(XML_SUFFIX):
+        with open(target, "w") as file:
+            write_xml_shapes(counted(), file)
+    else:
+        with open(target, "w") as file:
+            write_text_shapes(counted(), file)
+    return count, errors
+
+
+def drawing_stats(source):
+    errors = []
+    stats = {"line": 0, "rectangle": 0, "colors": {}, "bbox": None}
+    left = top = math.inf
+    right = bottom = -math.inf
+    for shape_type, x1, y1, x2, y2, color, _ in iter_file_shapes(source, errors):
+        stats[shape_type] += 1
+        stats["colors"][color] = stats["colors"].get(color, 0) + 1
+        left, right = min(left, x1, x2), max(right, x1, x2)
+        top, bottom = min(top, y1, y2), max(bottom, y1, y2)
+    if right >= left:
+        stats["bbox"] = [left, top, right, bottom]
+    return stats["line"] + stats["rectangle"], errors, stats
+
+
+def render_file(source, target, errors, **options):
+    document = Document()
+    for shape in iter_file_shapes(source, errors):
+        document.add(*shape)
+    write_image(document, target, **options)
+    return len(document)
+
+
+def process_drawing(command, source, target=None, options=None):
+    """ Run one CLI command on one file; executed in worker processes. """
+    start = time.perf_counter()
+    result = {"file": source, "command": command, "shapes": 0, "errors": [], "bytes": 0}
+    try:
+        result["bytes"] = os.path.getsize(source)
+        if command in ("convert", "export"):
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            result["shapes"], errors = convert_file(source, target)
+            result["output"] = target
+        elif command == "render":
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            errors = []
+            result["shapes"] = render_file(source, target, errors, **(options or {}))
+            result["output"] = target
+        elif command == "validate":
+            errors = []
+            result["shapes"] = sum(1 for _ in iter_file_shapes(source, errors))
+        else:
+            result["shapes"], errors, result["stats"] = drawing_stats(source)
+        result["errors"] = [f"{number}: {message}" for number, message in errors]
+    except Exception as e:  # One bad file must not end a batch run
+        if isinstance(e, (OSError, ValueError, SyntaxError)):  # SyntaxError covers ElementTree.ParseError
+            result["errors"].append(f"fatal: {e}")
+        else:
+            logger.exception("unexpected failure file=%s", source)
+            result["errors"].append(f"fatal: {type(e).__name__}: {e}")
+        result["failed"] = True
+        if target and os.path.exists(target):
+            os.remove(target)  # Do not leave a truncated conversion behind
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def format_result(result):
+    seconds = max(result["seconds"], 1e-9)
+    line = (f"{result['file']}: {result['shapes']} shapes in {result['seconds']:.3f}s "
+            f"({result['shapes'] / seconds:,.0f} shapes/s, {result['bytes'] / seconds / 1e6:.1f} MB/s)")
+    if result["errors"]:
+        line += f", {len(result['errors'])} error(s)"
+        line += "".join(f"\n  {error}" for error in result["errors"][:10])
+    if "stats" in result:
+        stats = result["stats"]
+        line += (f"\n  lines={stats['line']} rectangles={stats['rectangle']} "
+                 f"colors={stats['colors']} bbox={stats['bbox']}")
+    return line
+
+
+def run_cli(argv):
+    """ Headless batch mode: ``python -m drawing_editor convert|validate|export|stats|render``. """
+    import argparse
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = argparse.ArgumentParser(prog="drawing_editor", description="Batch-process drawing files without a display.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("convert", "convert drawings to another format"),
+                            ("validate", "check drawings for malformed records"),
+                            ("export", "export drawings to XML"),
+                            ("stats", "summarise drawings"),
+                            ("render", "render drawings to PNG or PPM images")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("paths", nargs="+", help="drawing files or directories of drawings")
+        command.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+        command.add_argument("--json", action="store_true", help="print one JSON result per line")
+        if name in ("convert", "export", "render"):
+            command.add_argument("-o", "--output", required=True, help="output directory")
+        if name == "convert":
+            command.add_argument("--to", choices=sorted(FORMAT_SUFFIXES), required=True, help="target format")
+        if name == "render":
+            command.add_argument("--format", choices=("png", "ppm"), default="png", help="image format")
+            command.add_argument("--width", type=int, help="fit the drawing into this many pixels across")
+            command.add_argument("--height", type=int, help="fit the drawing into this many pixels down")
+            command.add_argument("--scale", type=float, default=1.0, help="pixels per drawing unit")
+    args = parser.parse_args(argv)
+
+    suffix = XML_SUFFIX if args.command == "export" else FORMAT_SUFFIXES.get(getattr(args, "to", None))
+    options = None
+    if args.command == "render":
+        suffix = "." + args.format
+        options = {"width": args.width, "height": args.height, "scale": args.scale, "jobs": 1}
+    jobs = []
+    for source, relative in collect_drawings(args.paths):
+        target = None
+        if suffix:
+            target = os.path.join(args.output, os.path.splitext(relative)[0] + suffix)
+        jobs.append((args.command, source, target, options))
+
+    start = time.perf_counter()
+    failures = shapes = 0
+
+    def results():
+        if len(jobs) == 1 and options:
+            # A single image parallelises over its tiles instead of over files
+            options["jobs"] = args.jobs
+            yield process_drawing(*jobs[0])
+            return
+        with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            futures = [pool.submit(process_drawing, *job) for job in jobs]
+            for future in futures:
+                yield future.result()
+
+    for result in results():
+        shapes += result["shapes"]
+        failures += bool(result["errors"])
+        print(json.dumps(result) if args.json else format_result(result), flush=True)
+    elapsed = time.perf_counter() - start
+    if not args.json:
+        print(f"{len(jobs)} file(s), {shapes} shapes in {elapsed:.2f}s, {failures} with errors")
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    logging.basicConfig(level=os.environ.get("DRAWING_EDITOR_LOG", "WARNING").upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if argv and argv[0] in CLI_COMMANDS:
+        return run_cli(argv)
+    import tkinter as tk
+    root = tk.Tk()
+    app = DrawingApp(root)
+    app.run()
+    return 0
+
 
-root = tk.Tk()
-app = DrawingApp(root)
-app.run()
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,352 @@
+""" Tests for DrawingApp, run headless against small stand-ins for the Tk widgets it uses. """
+import sys
+
+import pytest
+
+import drawing_editor as de
+
+tk = pytest.importorskip("tkinter")
+from tkinter import filedialog, messagebox, simpledialog  # noqa: E402
+
+
+class FakeCanvas:
+    """ Keeps items, their coordinates and tags, and counts the calls that would reach Tk. """
+
+    def __init__(self, *args, **kwargs):
+        self.items = {}  # item -> [type, coords, options]
+        self.tags = {}  # tag -> set of items
+        self.next_item = 0
+        self.calls = 0
+
+    def pack(self, **kwargs):
+        pass
+
+    def bind(self, event, handler):
+        pass
+
+    def unbind(self, event):
+        pass
+
+    def _create(self, kind, coords, options):
+        self.calls += 1
+        self.next_item += 1
+        tags = options.get("tags") or ()
+        self.items[self.next_item] = [kind, list(coords), dict(options)]
+        for tag in ((tags,) if isinstance(tags, str) else tags):
+            self.tags.setdefault(tag, set()).add(self.next_item)
+        return self.next_item
+
+    def create_line(self, *coords, **options):
+        return self._create("line", coords, options)
+
+    def create_rectangle(self, *coords, **options):
+        return self._create("rectangle", coords, options)
+
+    def find(self, tag):
+        if isinstance(tag, int):
+            return [tag] if tag in self.items else []
+        if tag == "all":
+            return list(self.items)
+        if "||" in tag:
+            return sorted({item for part in tag.split("||") for item in self.find(part)})
+        if "&&" in tag:
+            first, *rest = tag.split("&&")
+            return [item for item in self.find(first) if all(item in self.find(other) for other in rest)]
+        return [item for item in self.tags.get(tag, ()) if item in self.items]
+
+    def coords(self, item, *coords):
+        self.calls += 1
+        item = self.find(item)[0]
+        if coords:
+            self.items[item][1] = list(coords[0] if len(coords) == 1 else coords)
+        return list(self.items[item][1])
+
+    def delete(self, *tags):
+        self.calls += 1
+        for tag in tags:
+            for item in self.find(tag):
+                del self.items[item]
+
+    def move(self, tag, dx, dy):
+        self.calls += 1
+        for item in self.find(tag):
+            coords = self.items[item][1]
+            coords[:] = [value + (dy if i % 2 else dx) for i, value in enumerate(coords)]
+
+    def scale(self, tag, x0, y0, sx, sy):
+        self.calls += 1
+        for item in self.find(tag):
+            coords = self.items[item][1]
+            coords[:] = [y0 + (value - y0) * sy if i % 2 else x0 + (value - x0) * sx
+                         for i, value in enumerate(coords)]
+
+    def itemconfig(self, tag, **options):
+        self.calls += 1
+        for item in self.find(tag):
+            self.items[item][2].update(options)
+
+    def addtag_withtag(self, new_tag, tag):
+        self.calls += 1
+        self.tags.setdefault(new_tag, set()).update(self.find(tag))
+
+    def dtag(self, tag, remove=None):
+        self.calls += 1
+        for item in self.find(tag):
+            self.tags.get(remove or tag, set()).discard(item)
+
+    def type(self, item):
+        return self.items[item][0] if item in self.items else None
+
+    def shown(self):
+        """ Items standing for shapes, leaving out LOD cells and previews. """
+        return [item for item in self.items if item not in self.tags.get("lod", ())]
+
+
+class FakeMenu:
+    commands = {}
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def add_command(self, label, command=None, **kwargs):
+        FakeMenu.commands[label] = command
+
+    def add_cascade(self, **kwargs):
+        pass
+
+    def add_separator(self):
+        pass
+
+    def add_checkbutton(self, **kwargs):
+        pass
+
+
+class FakeVar:
+    def __init__(self, master=None, value=None):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+class FakeRoot:
+    """ Queues after() callbacks until pump() runs them, like one pass of the event loop. """
+
+    def __init__(self):
+        self.pending = []
+        self.destroyed = False
+
+    def after(self, ms, callback=None, *args):
+        self.pending.append((callback, args))
+        return len(self.pending)
+
+    def after_idle(self, callback, *args):
+        return self.after(0, callback, *args)
+
+    def after_cancel(self, after_id):
+        if after_id and after_id <= len(self.pending):
+            self.pending[after_id - 1] = (None, ())
+
+    def pump(self):
+        while any(callback for callback, _ in self.pending):
+            pending, self.pending = self.pending, []
+            for callback, args in pending:
+                if callback:
+                    callback(*args)
+
+    def title(self, text):
+        pass
+
+    def config(self, **kwargs):
+        pass
+
+    def protocol(self, name, handler):
+        pass
+
+    def bind(self, *args):
+        pass
+
+    def unbind(self, *args):
+        pass
+
+    def mainloop(self):
+        pass
+
+    def quit(self):
+        pass
+
+    def destroy(self):
+        self.destroyed = True
+
+
+@pytest.fixture
+def dialogs(monkeypatch):
+    """ Answers for the modal dialogs, and a record of the messages shown. """
+    answers = {"save": "", "open": "", "yesnocancel": None, "yesno": False}
+    shown = []
+    monkeypatch.setattr(filedialog, "asksaveasfilename", lambda **kwargs: answers["save"])
+    monkeypatch.setattr(filedialog, "askopenfilename", lambda **kwargs: answers["open"])
+    monkeypatch.setattr(messagebox, "askyesnocancel", lambda *args: answers["yesnocancel"])
+    monkeypatch.setattr(messagebox, "askyesno", lambda *args: answers["yesno"])
+    for name in ("showinfo", "showwarning", "showerror"):
+        monkeypatch.setattr(messagebox, name, lambda *args, name=name: shown.append((name,) + args))
+    monkeypatch.setattr(simpledialog, "askfloat", lambda *args, **kwargs: answers.get("float"))
+    answers["shown"] = shown
+    return answers
+
+
+@pytest.fixture
+def make_app(monkeypatch, dialogs):
+    monkeypatch.setattr(tk, "Canvas", FakeCanvas)
+    monkeypatch.setattr(tk, "Menu", FakeMenu)
+    monkeypatch.setattr(tk, "BooleanVar", FakeVar)
+    monkeypatch.setattr(sys, "argv", ["drawing_editor.py"])
+    apps = []
+
+    def make_app(**kwargs):
+        kwargs.setdefault("autosave_path", None)
+        app = de.DrawingApp(FakeRoot(), **kwargs)
+        apps.append(app)
+        return app
+
+    yield make_app
+    for app in apps:
+        if app.autosave and app.autosave.thread.is_alive():
+            app.autosave.close()
+
+
+def add_shapes(app, count):
+    for i in range(count):
+        app.add_shape("line", i % 100 * 5, i // 100 * 5, i % 100 * 5 + 3, i // 100 * 5 + 3, "black")
+
+
+def test_exit_finishes_the_background_save(make_app, dialogs, tmp_path):
+    app = make_app(autosave_path=str(tmp_path / "autosave.drj"))
+    add_shapes(app, 2000)
+    dialogs["save"] = str(tmp_path / "drawing.drw")
+    app.save_file()
+    app.run()  # mainloop returns as after File > Exit or root.quit()
+    assert len(de.read_binary(dialogs["save"])) == 2000
+    assert not (tmp_path / "autosave.drj").exists()
+    assert not app.autosave.thread.is_alive()
+
+
+def test_exit_menu_goes_through_on_close(make_app, dialogs, tmp_path):
+    app = make_app(autosave_path=str(tmp_path / "autosave.drj"))
+    add_shapes(app, 10)
+    app.is_saved = False
+    FakeMenu.commands["Exit"]()  # Unsaved changes, and the prompt is cancelled
+    assert not app.root.destroyed
+    dialogs["yesnocancel"] = False
+    FakeMenu.commands["Exit"]()
+    assert app.root.destroyed
+    assert not (tmp_path / "autosave.drj").exists()  # Quitting without saving is a clean exit
+
+
+def test_close_keeps_window_and_journal_when_save_fails(make_app, dialogs, tmp_path):
+    journal = tmp_path / "autosave.drj"
+    app = make_app(autosave_path=str(journal))
+    add_shapes(app, 10)
+    app.is_saved = False
+    dialogs["yesnocancel"] = True
+    dialogs["save"] = str(tmp_path / "missing" / "drawing.drw")
+    app.on_close()
+    assert not app.root.destroyed
+    assert not app.is_saved
+    assert dialogs["shown"][-1][0] == "showerror"
+    app.autosave.flush()
+    app.autosave.wait()
+    assert len(de.read_journal(str(journal))) == 10
+
+
+def peak_items(app, monkeypatch):
+    """ Record the most canvas items standing for shapes at any one time. """
+    peak = [0]
+    render = app.render_shape
+
+    def render_shape(sid):
+        item = render(sid)
+        peak[0] = max(peak[0], len(app.items))
+        return item
+
+    monkeypatch.setattr(app, "render_shape", render_shape)
+    return peak
+
+
+def test_load_keeps_to_the_item_budget(make_app, monkeypatch, tmp_path):
+    app = make_app()
+    app.max_items = 500
+    path = tmp_path / "drawing.txt"
+    path.write_text("".join(f"line {i % 60 * 10} {i // 60 * 10} {i % 60 * 10 + 8} {i // 60 * 10 + 8} k\n"
+                            for i in range(3000)))
+    peak = peak_items(app, monkeypatch)
+    app.load_file(str(path))
+    app.root.pump()
+    assert len(app.document) == 3000
+    assert peak[0] <= app.max_items
+    assert len(app.items) == app.max_items
+    assert app.lod_items  # The shapes left without an item show as grey cells
+
+
+def test_undo_in_a_crowded_view_draws_only_large_shapes(make_app, monkeypatch):
+    app = make_app()
+    add_shapes(app, 3000)
+    app.delete_shapes(list(app.document))
+    app.overview_density = 0.001
+    app.sync_view()
+    peak = peak_items(app, monkeypatch)
+    app.undo()
+    assert peak[0] == 0
+    assert not app.items and app.lod_items
+
+
+def test_handlers_are_timed_without_their_dialogs(make_app, dialogs, tmp_path):
+    app = make_app()
+    add_shapes(app, 10)
+    dialogs["save"] = str(tmp_path / "drawing.txt")
+    app.save_file()
+    app.find_intersections()
+    handlers = app.instrumentation.report()["handlers"]
+    assert {"save_file", "find_intersections"}.isdisjoint(handlers)
+    assert handlers["write_file"]["count"] == handlers["select_intersections"]["count"] == 1
+
+
+def test_paste_draws_the_copies_selected(make_app):
+    app = make_app()
+    add_shapes(app, 300)
+    app.select_shapes(list(app.document))
+    app.copy_selection()
+    calls = app.canvas.calls
+    app.paste()
+    pasted = set(range(300, 600))
+    assert app.selection == pasted
+    assert {app.objects[item] for item in app.canvas.find("selected")} == pasted
+    assert all(app.canvas.items[item][2]["fill"] == "red" for item in app.canvas.find("selected"))
+    assert app.canvas.calls - calls <= 300 + 10  # One call per new item, plus clearing the old selection
+
+
+def test_load_stops_at_undecodable_text(make_app, dialogs, tmp_path):
+    app = make_app()
+    path = tmp_path / "drawing.txt"
+    path.write_bytes(b"line 0 0 10 10 k\n" * 6000 + b"line 0 0 \xff\xfe 10 k\n" + b"line 0 0 10 10 k\n" * 100)
+    app.load_file(str(path))
+    app.root.pump()
+    assert app.loader is None
+    assert 0 < len(app.document) <= 6000  # Shapes decoded before the bad bytes are kept
+    assert app.document.alive and app.index.query_rect(0, 0, 10, 10)
+    kind, title, message = dialogs["shown"][-1]
+    assert kind == "showwarning" and "unreadable file" in message
+
+
+def test_failed_open_keeps_the_drawing(make_app, dialogs, tmp_path):
+    app = make_app(autosave_path=str(tmp_path / "autosave.drj"))
+    add_shapes(app, 5)
+    app.history.record(de.AddShapes(range(5)))
+    app.load_file(str(tmp_path / "missing.txt"))
+    assert len(app.document) == 5 and len(app.items) == 5
+    assert app.history.can_undo()
+    assert dialogs["shown"][-1][0] == "showerror"
+    assert app.autosave.document is app.document
@@ -0,0 +1,481 @@
+""" Tests for the Tk-free core of drawing_editor. """
+import io
+import itertools
+import random
+from array import array
+
+import pytest
+
+import drawing_editor as de
+
+
+def sample_document(count=200, seed=0, whole=False):
+    """ Random lines and rectangles in palette colours, with a nested group and a deleted shape. """
+    rng = random.Random(seed)
+    colors = list(de.COLOR_CODES.values())
+    document = de.Document()
+    for _ in range(count):
+        coords = [rng.uniform(-500, 500) for _ in range(4)]
+        if whole:
+            coords = [float(round(value)) for value in coords]
+        shape_type = rng.choice(de.SHAPE_TYPES)
+        corner_style = rng.choice(de.CORNER_STYLES) if shape_type == "rectangle" else "square"
+        document.add(shape_type, *coords, rng.choice(colors), corner_style)
+    inner = document.groups.create(shape_ids=[1, 2, 3])
+    document.groups.create(shape_ids=[4], group_ids=[inner])
+    document.remove(5)
+    return document
+
+
+def shapes(document):
+    """ Everything a drawing shows, for comparing documents across formats. """
+    return list(document.records())
+
+
+def test_text_round_trip():
+    document = sample_document(whole=True)
+    buffer = io.StringIO()
+    de.write_text(document, buffer)
+    buffer.seek(0)
+    assert shapes(de.read_text(buffer)) == shapes(document)
+
+
+def test_binary_round_trip_keeps_columns_and_groups(tmp_path):
+    document = sample_document()
+    document.add("line", 0, 0, 1, 1, "#123456")  # A colour outside the default palette
+    path = tmp_path / "drawing.drw"
+    with open(path, "wb") as file:
+        de.write_binary(document, file)
+    loaded = de.read_binary(str(path))
+    assert shapes(loaded) == shapes(document)
+    assert loaded.palette == document.palette
+    live = list(document)
+    assert [loaded.group(sid) for sid in loaded] == [document.group(sid) for sid in live]
+    assert loaded.groups.parents == document.groups.parents
+
+
+def test_text_binary_conversion(tmp_path):
+    document = sample_document(whole=True)
+    text, binary, back = tmp_path / "a.txt", tmp_path / "a.drw", tmp_path / "b.txt"
+    with open(text, "w") as file:
+        de.write_text(document, file)
+    de.text_to_binary(str(text), str(binary))
+    de.binary_to_text(str(binary), str(back))
+    assert back.read_text() == text.read_text()
+
+
+def test_binary_rejects_other_files(tmp_path):
+    path = tmp_path / "drawing.drw"
+    path.write_bytes(b"line 0 0 10 10 k\n" * 4)
+    with pytest.raises(ValueError, match="bad magic"):
+        de.read_binary(str(path))
+
+
+def test_xml_round_trip():
+    document = sample_document()
+    buffer = io.StringIO()
+    de.write_xml(document, buffer, chunk_size=7)
+    loaded = de.read_xml(io.BytesIO(buffer.getvalue().encode("utf-8")))
+    assert shapes(loaded) == shapes(document)
+
+
+def test_xml_reports_malformed_shapes():
+    xml = (b"<Drawing><line><begin><x>1</x><y>2</y></begin><end><x>3</x><y>4</y></end></line>"
+           b"<line><begin><x>1</x></begin><end><x>3</x><y>4</y></end></line>"
+           b"<rectangle><upper-left><x>0</x><y>0</y></upper-left></rectangle></Drawing>")
+    errors = []
+    loaded = de.read_xml(io.BytesIO(xml), errors=errors)
+    assert shapes(loaded) == [("line", 1.0, 2.0, 3.0, 4.0, "black", "square")]
+    assert [number for number, _ in errors] == [2, 3]
+
+
+def write_journal(path, document, edits):
+    """ A snapshot of ``document`` followed by one delta frame per edit; returns each frame's end offset. """
+    ends = []
+    with open(path, "wb") as file:
+        de.write_journal_frame(de.encode_journal_batch(document), file)
+        ends.append(file.tell())
+        document.track_changes()
+        for edit in edits:
+            edit(document)
+            de.write_journal_frame(de.encode_journal_batch(document, document.take_changes()), file)
+            ends.append(file.tell())
+    return ends
+
+
+JOURNAL_EDITS = [
+    lambda document: document.add("rectangle", 10, 20, 30, 40, "red", "round"),
+    lambda document: document.set_coords(0, 1, 2, 3, 4),
+    lambda document: document.remove(1),
+    lambda document: document.set_color(2, "#abcdef"),
+]
+
+
+def test_journal_replay(tmp_path):
+    document = sample_document(50)
+    path = tmp_path / "autosave.drj"
+    write_journal(path, document, JOURNAL_EDITS)
+    replayed = de.read_journal(str(path))
+    assert shapes(replayed) == shapes(document)
+    assert replayed.groups.parents == document.groups.parents
+
+
+@pytest.mark.parametrize("damage", ["truncate", "corrupt"])
+def test_journal_stops_at_torn_frame(tmp_path, damage):
+    path = tmp_path / "autosave.drj"
+    expected = sample_document(50)
+    write_journal(tmp_path / "expected.drj", expected, JOURNAL_EDITS[:-1])
+    ends = write_journal(path, sample_document(50), JOURNAL_EDITS)
+    data = bytearray(path.read_bytes())
+    if damage == "truncate":
+        del data[ends[-1] - 3:]  # A crash in the middle of the last append
+    else:
+        data[ends[-1] - 1] ^= 0xFF  # The last frame no longer matches its CRC
+    path.write_bytes(bytes(data))
+    assert shapes(de.read_journal(str(path))) == shapes(expected)
+
+
+def test_journal_without_snapshot(tmp_path):
+    path = tmp_path / "autosave.drj"
+    path.write_bytes(b"DRWJ")
+    assert de.read_journal(str(path)) is None
+
+
+def _break_kind(document):
+    document.kinds[0] = len(de.SHAPE_TYPES)
+
+
+def _break_color(document):
+    document.colors[0] = len(document.palette)
+
+
+def _break_corner(document):
+    document.corners[0] = -1
+
+
+def _break_group(document):
+    document.group_ids[0] = 99
+
+
+def _break_parent(document):
+    document.groups.parents[0] = 99
+
+
+def _break_cycle(document):
+    document.groups.parents[1] = 0  # Group 0 already sits in group 1
+
+
+@pytest.mark.parametrize("damage", [_break_kind, _break_color, _break_corner, _break_group, _break_parent,
+                                    _break_cycle])
+def test_binary_rejects_corrupt_tables(tmp_path, damage):
+    document = sample_document(20)
+    damage(document)
+    path = tmp_path / "drawing.drw"
+    with open(path, "wb") as file:
+        de.write_binary(document, file)
+    with pytest.raises(ValueError, match="corrupt binary drawing"):
+        de.read_binary(str(path))
+
+
+def random_segments(rng, count, size):
+    """ Segments on a small integer grid, so shared ends, verticals and collinear overlaps are common. """
+    segments = []
+    for sid in range(count):
+        x1, y1, x2, y2 = (float(rng.randint(0, size)) for _ in range(4))
+        if rng.random() < 0.2:
+            x2 = x1
+        if rng.random() < 0.2:
+            y2 = y1
+        segments.append((sid, x1, y1, x2, y2))
+    return segments
+
+
+def brute_intersections(segments):
+    return sorted((a[0], b[0]) for a, b in itertools.combinations(segments, 2)
+                  if de.segments_intersect(*a[1:], *b[1:]))
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_sweep_segments_matches_brute_force(seed):
+    rng = random.Random(seed)
+    segments = random_segments(rng, rng.randint(2, 60), rng.choice([3, 10, 100]))
+    if seed % 2:
+        matrix = de.rotation(rng.uniform(0, 360), 50, 50)
+        segments = [(sid, *de.transform_coords(array('d', coords), matrix)) for sid, *coords in segments]
+    found = list(de.sweep_segments(segments))
+    assert len(found) == len(set(found))
+    assert sorted(found) == brute_intersections(segments)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_sweep_overlaps_matches_brute_force(seed):
+    rng = random.Random(seed)
+    boxes = []
+    for sid in range(150):
+        x, y = rng.uniform(0, 300), rng.uniform(0, 300)
+        boxes.append((sid, x, y, x + rng.choice([0, rng.uniform(0, 40), 300]), y + rng.uniform(0, 40)))
+    found = [tuple(sorted(pair)) for pair in de.sweep_overlaps(boxes, band=rng.choice([None, 1, 5]))]
+    brute = [(a[0], b[0]) for a, b in itertools.combinations(boxes, 2)
+             if a[1] <= b[3] and b[1] <= a[3] and a[2] <= b[4] and b[2] <= a[4]]
+    assert len(found) == len(set(found))
+    assert sorted(found) == sorted(brute)
+
+
+def test_line_intersections_on_long_hatching():
+    """ Parallel slanted lines make every bounding box overlap, which switches to the segment sweep. """
+    rng = random.Random(1)
+    document = de.Document()
+    for i in range(300):
+        document.add("line", i * 10, 0, i * 10 + 2000, 2000)
+    for _ in range(40):
+        document.add("line", *(rng.uniform(0, 3000) for _ in range(4)))
+    document.add("rectangle", 0, 0, 5000, 5000)
+    lines = [(sid, *document.get_coords(sid)) for sid in document if document.type(sid) == "line"]
+    assert de.line_intersections(document) == brute_intersections(lines)
+
+
+def test_rectangle_overlaps():
+    document = de.Document()
+    outer = document.add("rectangle", 0, 0, 10, 10)
+    inner = document.add("rectangle", 2, 2, 5, 5)
+    beside = document.add("rectangle", 10, 0, 20, 10)  # Shares an edge only
+    across = document.add("rectangle", 8, 8, 12, 12)
+    document.add("line", 0, 0, 10, 10)
+    assert de.rectangle_overlaps(document) == [(outer, inner, "contains"), (outer, across, "overlaps"),
+                                               (beside, across, "overlaps")]
+
+
+def test_cli_validate_reports_each_file(tmp_path, capsys):
+    (tmp_path / "good.txt").write_text("line 0 0 10 10 k\nrect 0 0 5 5 r round\n")
+    (tmp_path / "bad.txt").write_text("line 0 0 10 10 k\ncircle 1 2 3 4 k\n")
+    (tmp_path / "other.drw").write_bytes(b"not a drawing")
+    assert de.run_cli(["validate", "-j", "1", str(tmp_path)]) == 1
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[-1].startswith("3 file(s), 3 shapes in ")
+    assert lines[-1].endswith(", 2 with errors")
+
+
+def test_cli_convert_and_stats(tmp_path, capsys):
+    document = sample_document(50, whole=True)
+    with open(tmp_path / "a.txt", "w") as file:
+        de.write_text(document, file)
+    out = tmp_path / "out"
+    assert de.run_cli(["convert", "-j", "1", "--to", "drw", "-o", str(out), str(tmp_path / "a.txt")]) == 0
+    assert shapes(de.read_binary(str(out / "a.drw"))) == shapes(document)
+    capsys.readouterr()
+    assert de.run_cli(["stats", "-j", "1", "--json", str(out / "a.drw")]) == 0
+    assert '"shapes": 49' in capsys.readouterr().out
+
+
+def test_process_drawing_contains_unexpected_errors(tmp_path, monkeypatch):
+    def broken(source, errors=None):
+        raise KeyError(7)
+
+    path = tmp_path / "a.txt"
+    path.write_text("line 0 0 10 10 k\n")
+    monkeypatch.setattr(de, "iter_file_shapes", broken)
+    result = de.process_drawing("validate", str(path))
+    assert result["failed"] and result["errors"] == ["fatal: KeyError: 7"]
+
+
+def test_history_undo_redo_and_merge():
+    document = sample_document(20)
+    history = de.History()
+    before = shapes(document)
+    command = de.RemoveShapes([1, 2, 3])
+    command.apply(document)
+    history.record(command)
+    for _ in range(3):
+        move = de.MoveShapes([6, 7], 1, 2)
+        move.apply(document)
+        history.record(move, merge=True)
+    history.seal()
+    assert len(history.undo_stack) == 2
+    after = shapes(document)
+    history.undo(document)
+    history.undo(document)
+    assert shapes(document) == before
+    assert document.groups.members[0] == {1, 2, 3}
+    history.redo(document)
+    history.redo(document)
+    assert shapes(document) == after
+
+
+def test_history_bytes_match_what_is_kept():
+    document = sample_document(20)
+    history = de.History(limit=3)
+    for i in range(5):
+        sid = document.add("line", i, i, 10, 10)
+        history.record(de.AddShapes([sid]))  # Recorded after the fact, like paste does
+        history.undo(document)  # Undoing applies RemoveShapes, which makes size() grow
+        history.redo(document)
+    while history.can_undo():
+        history.undo(document)
+    move = de.MoveShapes([0], 1, 1)
+    history.record(move)  # Drops everything that was undone
+    assert history.bytes == move.size()
+
+
+def test_transform_coords():
+    values = array('d', [0, 0, 10, 5])
+    assert list(de.transform_coords(values, de.translation(3, -2))) == [3, -2, 13, 3]
+    assert list(de.transform_coords(values, de.scaling(2, -1, 5, 5))) == [-5, 10, 15, 5]
+    assert list(de.transform_coords(values, de.rotation(90, 5, 5))) == [10, 0, 5, 10]  # Quarter turns are exact
+    turned = de.transform_coords(values, de.rotation(30))
+    assert list(de.transform_coords(turned, de.rotation(-30))) == pytest.approx(list(values))
+
+
+def test_tilted_rectangles_keep_their_area():
+    document = de.Document()
+    square = document.add("rectangle", 0, 0, 10, 10)
+    line = document.add("line", 0, 0, 10, 10)
+    sids = [square, line]
+    old = de.gather_coords(document, sids)
+    matrix = de.rotation(45, 5, 5)
+    new = de.bound_rectangles(document, sids, old, de.transform_coords(old, matrix), matrix)
+    half = 50 ** 0.5
+    assert list(new[:4]) == pytest.approx([5 - half, 5 - half, 5 + half, 5 + half])
+    assert new[4] == pytest.approx(new[6])  # The line turns upright instead
+    matrix = de.rotation(180, 5, 5)
+    new = de.transform_coords(old, matrix)
+    assert de.bound_rectangles(document, sids, old, new, matrix) is new
+
+
+def test_align_and_distribute_move_units_together():
+    document = de.Document()
+    a = document.add("rectangle", 0, 0, 10, 10)
+    b = document.add("line", 30, 5, 40, 25)
+    c = document.add("rectangle", 32, 0, 34, 2)  # Moves with b
+    d = document.add("rectangle", 100, 50, 120, 60)
+    units = [[a], [b, c], [d]]
+    sids, coords = de.align_coords(document, units, "top")
+    assert sids == [a, b, c, d]
+    assert list(coords[1::4]) == [0, 5, 0, 0]
+    sids, coords = de.align_coords(document, units, "right")
+    assert [coords[i * 4 + 2] for i in range(4)] == [120, 120, 114, 120]
+    sids, coords = de.distribute_coords(document, units, 0)
+    centers = [(coords[0] + coords[2]) / 2, (coords[4] + coords[6]) / 2, (coords[12] + coords[14]) / 2]
+    assert centers == pytest.approx([5, 57.5, 110])
+    assert coords[8] - coords[4] == 2  # c keeps its place relative to b
+
+
+def stroke_touches(document, sid, left, top, right, bottom):
+    """ Brute force: whether a shape's drawn stroke enters a region. """
+    edges = [(left, top, right, top), (right, top, right, bottom), (left, bottom, right, bottom),
+             (left, top, left, bottom)]
+    for segment in de.shape_segments(document, sid):
+        x1, y1, x2, y2 = segment
+        if left <= x1 <= right and top <= y1 <= bottom:
+            return True
+        if any(de.segments_intersect(*segment, *edge) for edge in edges):
+            return True
+    return False
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_spatial_index_finds_every_stroke_in_a_region(seed):
+    rng = random.Random(seed)
+    document = sample_document(150, seed)
+    for _ in range(20):  # Long slanted lines whose bounding boxes cover most of the drawing
+        document.add("line", rng.uniform(-2000, 2000), rng.uniform(-2000, 2000),
+                     rng.uniform(-2000, 2000), rng.uniform(-2000, 2000))
+    index = de.SpatialIndex(document, max_stroke_cells=40)  # Files a few of the long lines as unfiled
+    index.build()
+    assert index.unfiled
+    for _ in range(20):
+        x, y = rng.uniform(-600, 600), rng.uniform(-600, 600)
+        region = (x, y, x + rng.uniform(0, 200), y + rng.uniform(0, 200))
+        found = set(index.query_rect(*region))
+        assert {sid for sid in document if stroke_touches(document, sid, *region)} <= found
+        assert all(index.in_rect(sid, *region) == (sid in found) for sid in document)
+
+
+def test_long_diagonal_is_filed_along_its_stroke():
+    document = de.Document()
+    diagonal = document.add("line", 0, 0, 6400, 6400)
+    frame = document.add("rectangle", 0, 0, 6400, 6400)
+    index = de.SpatialIndex(document, cell_size=64)
+    index.build()
+    assert len(index.cells) < 3 * 100 + 4 * 100  # Not the 10,000 cells under the bounding box
+    assert index.nearest(3200, 3201, halo=5) == diagonal
+    assert index.nearest(6399, 3000, halo=5) == frame
+    assert index.nearest(1000, 3000, halo=5) is None
+    assert index.query_rect(1000, 3000, 1100, 3100) == []  # Inside both boxes, away from both strokes
+    assert set(index.query_rect(3150, 3150, 3250, 3250)) == {diagonal}
+    document.set_coords(diagonal, 0, 6400, 6400, 0)
+    index.update(diagonal)
+    assert index.nearest(3200, 3201, halo=5) == diagonal
+    assert index.nearest(100, 100, halo=5) is None
+    index.remove(diagonal)
+    assert index.nearest(3200, 3201, halo=5) is None
+
+
+def test_nearest_prefers_the_shape_on_top():
+    document = de.Document()
+    below = document.add("line", 0, 0, 10, 0)
+    above = document.add("line", 0, 0, 10, 0)
+    index = de.SpatialIndex(document)
+    index.build()
+    assert index.nearest(5, 1) == above
+    index.remove(above)
+    assert index.nearest(5, 1) == below
+    assert index.within(below, 3) == []
+    document.add("rectangle", 0, 2, 10, 8)
+    index.insert(2)
+    assert index.within(below, 3) == [(2, 2.0)]
+
+
+def test_group_tree_nesting_and_tags():
+    document = de.Document()
+    for i in range(6):
+        document.add("line", i, 0, i, 10)
+    groups = document.groups
+    inner = groups.create(shape_ids=[0, 1])
+    outer = groups.create(shape_ids=[2], group_ids=[inner])
+    other = groups.create(shape_ids=[3])
+    assert groups.top_level(0) == outer and groups.top_level(3) == other and groups.top_level(4) is None
+    assert groups.ancestors(inner) == [inner, outer]
+    assert groups.shape_tags(1) == (de.GroupTree.tag(inner), de.GroupTree.tag(outer))
+    assert sorted(groups.shapes(outer)) == [0, 1, 2]
+    groups.dissolve(inner)
+    assert groups.parents == {outer: -1, other: -1}
+    assert document.group(0) == outer and groups.members[outer] == {0, 1, 2}
+    groups.delete(outer)
+    assert [document.group(sid) for sid in range(3)] == [-1, -1, -1]
+
+
+def test_group_tree_prunes_empty_groups_and_reinstates_them():
+    document = de.Document()
+    for i in range(3):
+        document.add("line", i, 0, i, 10)
+    groups = document.groups
+    inner = groups.create(shape_ids=[0])
+    outer = groups.create(group_ids=[inner])
+    lineage = groups.lineage(inner)
+    groups.discard_shape(0)
+    assert len(groups) == 0  # Both groups were left empty
+    groups.reinstate(lineage)
+    groups.add_shape(inner, 0)
+    assert groups.parents == {inner: outer, outer: -1}
+    assert groups.top_level(0) == outer
+    rebuilt = de.GroupTree(document)
+    rebuilt.rebuild(dict(groups.parents))
+    assert rebuilt.members == groups.members and rebuilt.children == groups.children
+
+
+def test_raster_tiles_match_across_processes():
+    document = sample_document(300)
+    document.add("rectangle", -50, -50, 50, 50, "red", "round")
+    serial = de.render_raster(document, width=300, tile_size=64, jobs=1)
+    pooled = de.render_raster(document, width=300, tile_size=64, jobs=2)
+    assert serial[:2] == pooled[:2] == (300, 300)
+    assert serial[2] == pooled[2]
+    assert serial[2] != bytes(de.RASTER_BACKGROUND) * 300 * 300
+
+
+def test_write_image_formats(tmp_path):
+    document = sample_document(20)
+    assert de.write_image(document, str(tmp_path / "a.ppm"), width=40) == (40, 40)
+    assert (tmp_path / "a.ppm").read_bytes().startswith(b"P6\n40 40\n255\n")
+    de.write_image(document, str(tmp_path / "a.png"), width=40)
+    assert (tmp_path / "a.png").read_bytes().startswith(b"\x89PNG\r\n\x1a\n")